@@ -16,7 +16,10 @@
 
 from subprocess import Popen, PIPE
 from threading import Event, Lock
+from collections import OrderedDict
 import os
+import re
+import json
 import time
 from sys import exc_info
 import traceback
@@ -41,6 +44,138 @@ except:
     except:
         pass # Ok if this fails, we can do without.
 
+class FolderScheduler(object):
+    """Order the folder syncs of an account by priority.
+
+    The folders of 'priorityfolders' come first, in this order. The others
+    go by the ratio of their urgency to their cost. The urgency is the
+    weight given by 'folderpriority', plus the changes per hour seen in the
+    previous syncs, plus the hours since the last sync. The cost is the
+    number of seconds the last syncs took. A folder which keeps being put
+    off sees its urgency grow until it comes first.
+
+    The history of the folders is kept in the folderstats file of the
+    account metadata."""
+
+    def __init__(self, account):
+        self.ui = account.ui
+        self.dryrun = account.dryrun
+        self.filename = os.path.join(account.getaccountmeta(), 'folderstats')
+        self.priorityfolders = account.getconflist('priorityfolders',
+            r',\s*', ['INBOX'])
+        self.folderpriority = lambda foldername: 0
+        if account.getconf('folderpriority', None):
+            self.folderpriority = account.getlocaleval().eval(
+                account.getconf('folderpriority'), {'re': re})
+        self.lock = Lock()
+        self.stats = None
+
+    def __getstats(self):
+        if self.stats is None:
+            self.stats = {}
+            if os.path.exists(self.filename):
+                try:
+                    with open(self.filename) as statsfd:
+                        self.stats = json.load(statsfd)
+                except (IOError, ValueError) as e:
+                    self.ui.warn("Ignoring the folder statistics in '%s': %s"%
+                        (self.filename, e))
+        return self.stats
+
+    def order(self, folders):
+        """Return the list of folders in the order to sync them."""
+
+        now = time.time()
+        with self.lock:
+            stats = self.__getstats()
+
+            def key(folder):
+                name = folder.getname()
+                if name in self.priorityfolders:
+                    return (0, self.priorityfolders.index(name))
+                stat = stats.get(name, {})
+                urgency = self.folderpriority(name) + stat.get('rate', 0.0) + \
+                    max(now - stat.get('synced', now), 0) / 3600.0
+                return (1, -urgency / (1.0 + stat.get('seconds', 0.0)))
+
+            # The sort is stable, folders of same priority keep their order.
+            return sorted(folders, key=key)
+
+    def record(self, foldername, changes, seconds):
+        """Record a sync of foldername which made changes in seconds."""
+
+        now = time.time()
+        with self.lock:
+            stat = self.__getstats().setdefault(foldername, {})
+            # Exponential moving averages of the previous syncs.
+            if 'synced' in stat and now > stat['synced']:
+                rate = changes * 3600.0 / (now - stat['synced'])
+                stat['rate'] = (stat.get('rate', rate) + rate) / 2
+            stat['seconds'] = (stat.get('seconds', seconds) + seconds) / 2
+            stat['synced'] = now
+
+    def save(self):
+        """Write the history of the folders out."""
+
+        if self.dryrun:
+            return
+        with self.lock:
+            if self.stats is None:
+                return
+            with open(self.filename + ".tmp", 'w') as statsfd:
+                json.dump(self.stats, statsfd)
+            os.rename(self.filename + ".tmp", self.filename)
+
+
+class WarmCache(object):
+    """Keep the data of the folders in memory between two syncs.
+
+    A folder is kept with the number of messages it holds in memory and the
+    function dropping them. When more than 'warmcachesize' messages are
+    kept, the folders synced the longest time ago are dropped first. A
+    folder is taken out of the cache while it is synced, so that it is not
+    dropped meanwhile."""
+
+    def __init__(self, account):
+        self.ui = account.ui
+        self.maxsize = account.getconfint('warmcachesize', 1000000)
+        self.lock = Lock()
+        self.folders = OrderedDict() # Key: (repository, folder) names.
+        self.size = 0
+
+    def __key(self, folder):
+        return (folder.getrepository().getname(), folder.getname())
+
+    def take(self, folder):
+        """Take folder out of the cache.
+
+        :returns: whether the data of this very folder instance were kept."""
+
+        with self.lock:
+            entry = self.folders.pop(self.__key(folder), None)
+            if entry is None:
+                return False
+            self.size -= entry[1]
+            return entry[0] is folder
+
+    def keep(self, folder, size, drop):
+        """Keep folder, holding size messages dropped by drop()."""
+
+        with self.lock:
+            key = self.__key(folder)
+            entry = self.folders.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+            self.folders[key] = (folder, size, drop)
+            self.size += size
+            while self.size > self.maxsize and self.folders:
+                key, entry = self.folders.popitem(last=False)
+                self.ui.debug('', "Dropping the warm cache of %s [%s]"%
+                    (key[1], key[0]))
+                self.size -= entry[1]
+                entry[2]()
+
+
 # FIXME: spaghetti code alert!
 def getaccountlist(customconfig):
     # Account names in a list.
@@ -229,6 +364,24 @@ class SyncableAccount(Account):
         self._lockfd = None
         self._lockfilepath = os.path.join(
             self.config.getmetadatadir(), "%s.lock"% self)
+        self.scheduler = None
+        if self.getconfboolean('schedulefolders', False):
+            self.scheduler = FolderScheduler(self)
+        self.warmcache = None
+        if self.getconfboolean('warmcache', False):
+            self.warmcache = WarmCache(self)
+        self.folderrefresh = None
+        if self.getconf('folderrefresh', None):
+            self.folderrefresh = self.localeval.eval(
+                self.getconf('folderrefresh'), {'re': re})
+
+    def getfolderrefresh(self, foldername):
+        """Return the number of minutes between two syncs of the remote
+        folder foldername, 0 to sync it every time."""
+
+        if self.folderrefresh is None:
+            return 0
+        return self.folderrefresh(foldername) or 0
 
     def __lock(self):
         """Lock the account, throwing an exception if it is locked already."""
@@ -321,6 +474,82 @@ class SyncableAccount(Account):
             remotefolder.getvisiblename().
             replace(self.remoterepos.getsep(), self.localrepos.getsep()))
 
+    def hydrate(self, uids=None):
+        """Download the bodies of the stubs of the local folders, see the
+        stubage and stubsize options.
+
+        Filtered folders are left alone, so that the folders to hydrate can
+        be selected with -f.
+
+        :param uids: if given, only hydrate the stubs with these UIDs.
+        :returns: 0 on success, 1 on errors."""
+
+        self.ui.registerthread(self)
+        self.remoterepos = Repository(self, 'remote')
+        self.localrepos  = Repository(self, 'local')
+        errors = 0
+        try:
+            self.__lock()
+            for remotefolder in self.remoterepos.getfolders():
+                if Account.abort_NOW_signal.is_set():
+                    break
+                if not remotefolder.sync_this:
+                    continue # Ignore filtered folder.
+                try:
+                    localfolder = self.get_local_folder(remotefolder)
+                except OfflineImapError as e:
+                    if e.severity > OfflineImapError.ERROR.FOLDER:
+                        raise
+                    continue # Not synced yet, no stubs.
+                if not localfolder.storesstubs():
+                    continue
+
+                localfolder.cachemessagelist()
+                try:
+                    errors += self.__hydratefolder(localfolder, remotefolder,
+                        uids)
+                finally:
+                    localfolder.dropmessagelistcache()
+        except OfflineImapError as e:
+            self.ui.error(e, exc_info()[2])
+            errors += 1
+        finally:
+            self._unlock()
+            self.localrepos.dropconnections()
+            self.remoterepos.dropconnections()
+        return 1 if errors else 0
+
+    def __hydratefolder(self, localfolder, remotefolder, uids):
+        """Hydrate the stubs of localfolder, see hydrate().
+
+        :returns: the number of messages which could not be hydrated."""
+
+        stubs = [uid for uid in localfolder.getmessageuidlist()
+                 if uid > 0 and (uids is None or uid in uids) and
+                 localfolder.isstub(uid)]
+        if not stubs:
+            return 0
+        if self.dryrun:
+            self.ui.info("[DRYRUN] Would hydrate %d messages of folder '%s'"%
+                (len(stubs), localfolder))
+            return 0
+        self.ui.info("Hydrating %d messages of folder '%s'"%
+            (len(stubs), localfolder))
+
+        errors = 0
+        for uid in stubs:
+            if Account.abort_NOW_signal.is_set():
+                break
+            try:
+                localfolder.replacemessagefrom(uid,
+                    lambda openfile: remotefolder.fetchmessage(uid, openfile))
+            except OfflineImapError as e:
+                if e.severity > OfflineImapError.ERROR.MESSAGE:
+                    raise
+                self.ui.error(e, exc_info()[2])
+                errors += 1
+        return errors
+
 
     # The syncrunner will loop on this method. This means it is called more than
     # once during the run.
@@ -377,8 +606,18 @@ class SyncableAccount(Account):
             if not localrepos.getconfboolean('readonly', False):
                 self.ui.syncfolders(remoterepos, localrepos)
 
+            # Get the state of all remote folders before the folder threads
+            # start, it is compared in quickchanged() and saved after sync.
+            # Only quick syncs look at it.
+            if quick:
+                remoterepos.cachefolderfingerprints()
+
+            folders = remoterepos.getfolders()
+            if self.scheduler is not None:
+                folders = self.scheduler.order(folders)
+
             # Iterate through all folders on the remote repo and sync.
-            for remotefolder in remoterepos.getfolders():
+            for remotefolder in folders:
                 # Check for CTRL-C or SIGTERM.
                 if Account.abort_NOW_signal.is_set():
                     break
@@ -423,6 +662,8 @@ class SyncableAccount(Account):
             # Wait for all threads to finish.
             for thr in folderthreads:
                 thr.join()
+            if self.scheduler is not None:
+                self.scheduler.save()
             if startedThread is True:
                 mbnames.writeIntermediateFile(self.name) # Write out mailbox names.
             else:
@@ -471,13 +712,16 @@ class SyncableAccount(Account):
 
 #XXX: This function should likely be refactored. This should not be passed the
 # account instance.
-def syncfolder(account, remotefolder, quick):
+def syncfolder(account, remotefolder, quick, force=False):
     """Synchronizes given remote folder for the specified account.
 
     Filtered folders on the remote side will not invoke this function.
 
     When called in concurrently for the same localfolder, syncs are
-    serialized."""
+    serialized.
+
+    Unless force is set, the folder is skipped if its folderrefresh period
+    has not elapsed since its last sync."""
 
     def acquire_mutex():
         account_name = account.getname()
@@ -592,8 +836,34 @@ def syncfolder(account, remotefolder, quick):
     localrepos = account.localrepos
     statusrepos = account.statusrepos
 
+    def refresh_due():
+        """Returns the number of minutes before the next sync of the
+        folder is due, 0 if it is due now."""
+
+        refresh = account.getfolderrefresh(remotefolder.getname())
+        lastsync = statusfolder.get_lastsync()
+        if refresh <= 0 or lastsync is None:
+            return 0
+        # Leave half a cycle of slack, else the folder could wait a whole
+        # autorefresh cycle more when the cycle comes a bit early.
+        slack = (account.refreshperiod or 0) / 2
+        due = (lastsync - starttime) / 60.0 + refresh - slack
+        return max(due, 0)
+
+    def record_sync(changes):
+        if account.folderrefresh is not None and not account.dryrun:
+            statusfolder.save_lastsync(starttime)
+        if account.scheduler is not None:
+            account.scheduler.record(remotefolder.getname(), changes,
+                time.time() - starttime)
+
     ui = getglobalui()
     ui.registerthread(account)
+    starttime = time.time()
+    changes = 0
+    warmcache = account.warmcache
+    statusloaded = False # Whether the status message list is loaded.
+    done = False # Whether the folder is in a consistent state.
     try:
         # Load local folder.
         localfolder = account.get_local_folder(remotefolder)
@@ -609,7 +879,24 @@ def syncfolder(account, remotefolder, quick):
         statusfolder = statusrepos.getfolder(remotefolder.getvisiblename().
             replace(remoterepos.getsep(), statusrepos.getsep()))
         statusfolder.openfiles()
-        statusfolder.cachemessagelist()
+        if warmcache is not None:
+            # The local folder data are kept on its repository.
+            warmcache.take(localfolder)
+            statusloaded = warmcache.take(statusfolder)
+
+        if not force:
+            due = refresh_due()
+            if due > 0:
+                ui.skippingfolder(remotefolder,
+                    "next refresh in %d minutes"% (due + 1))
+                done = True
+                return
+
+        # With the warm cache, the status message list of the last sync is
+        # still current: all the changes to the status folder go through it.
+        if not statusloaded:
+            statusfolder.cachemessagelist()
+            statusloaded = True
 
         # Load local folder.
         ui.syncingfolder(remoterepos, remotefolder, localrepos, localfolder)
@@ -650,28 +937,37 @@ def syncfolder(account, remotefolder, quick):
                     not remotefolder.quickchanged(statusfolder)):
                     ui.skippingfolder(remotefolder)
                     localrepos.restore_atime()
+                    record_sync(changes)
+                    done = True
                     return
             check_uid_validity()
-            remotefolder.cachemessagelist()
+            if not remotefolder.cachemessagelist_incremental(statusfolder):
+                remotefolder.cachemessagelist()
 
         # Synchronize remote changes.
         if not localrepos.getconfboolean('readonly', False):
             ui.syncingmessages(remoterepos, remotefolder, localrepos, localfolder)
-            remotefolder.syncmessagesto(localfolder, statusfolder)
+            changes += remotefolder.syncmessagesto(localfolder, statusfolder)
         else:
             ui.debug('', "Not syncing to read-only repository '%s'"%
                     localrepos.getname())
 
         # Synchronize local changes.
+        remotechanges = 0
         if not remoterepos.getconfboolean('readonly', False):
             ui.syncingmessages(localrepos, localfolder, remoterepos, remotefolder)
-            localfolder.syncmessagesto(remotefolder, statusfolder)
+            remotechanges = localfolder.syncmessagesto(remotefolder,
+                statusfolder)
+            changes += remotechanges
         else:
             ui.debug('', "Not syncing to read-only repository '%s'"%
                     remoterepos.getname())
 
         statusfolder.save()
+        remotefolder.record_folderstate(statusfolder, remotechanges > 0)
         localrepos.restore_atime()
+        record_sync(changes)
+        done = True
     except (KeyboardInterrupt, SystemExit):
         raise
     except OfflineImapError as e:
@@ -685,9 +981,20 @@ def syncfolder(account, remotefolder, quick):
         ui.error(e, msg="ERROR in syncfolder for %s folder %s: %s"%
             (account, remotefolder.getvisiblename(), traceback.format_exc()))
     finally:
+        keepwarm = warmcache is not None and done
         for folder in ["statusfolder", "localfolder", "remotefolder"]:
             if folder in locals():
+                if keepwarm and folder == "statusfolder":
+                    continue
                 locals()[folder].dropmessagelistcache()
         statusfolder.closefiles()
+        if keepwarm:
+            if statusloaded:
+                warmcache.keep(statusfolder, statusfolder.getmessagecount(),
+                    statusfolder.dropmessagelistcache)
+            warmcache.keep(localfolder, localfolder.getwarmsize(),
+                localfolder.dropwarmdata)
+        elif warmcache is not None and 'localfolder' in locals():
+            localfolder.dropwarmdata()
         # Release the mutex of this sync transaction.
         release_mutex()
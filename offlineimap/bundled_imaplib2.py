@@ -70,6 +70,11 @@ else:
 
 select_module = select
 
+try:
+    from ssl import SSLWantReadError, SSLWantWriteError
+except ImportError:
+    SSLWantReadError = SSLWantWriteError = None
+
 #       Globals
 
 CRLF = '\r\n'
@@ -238,6 +243,16 @@ class IMAP4(object):
     header of the response, and the second part contains the data (ie:
     'literal' value).
 
+    If 'literal_sink' is set, it is called as literal_sink(typ, dat, size)
+    for each literal received. If it returns a file-like object, the
+    literal is written to it instead, and the tuple contains that object.
+
+    If 'shared_io' is set before the connection is opened, no threads are
+    started for the connection. Its input is read and handled by a single
+    thread shared by all such connections (see _IOLoop), commands are sent
+    by the calling thread. Callbacks are then invoked from the shared
+    thread and must not block.
+
     Errors raise the exception class <instance>.error("<reason>").
     IMAP4 server errors raise <instance>.abort("<reason>"), which is
     a sub-class of 'error'. Mailbox status changes from READ-WRITE to
@@ -299,6 +314,8 @@ class IMAP4(object):
     class abort(error): pass        # Service errors - close and retry
     class readonly(abort): pass     # Mailbox status changed to READ-ONLY
 
+    shared_io = False               # Served by the shared _IOLoop thread
+
 
     # These must be encoded according to utf8 setting in _mode_xxx():
     _literal = br'.*{(?P<size>\d+)}$'
@@ -318,6 +335,7 @@ class IMAP4(object):
 
         self.state = NONAUTH            # IMAP4 protocol state
         self.literal = None             # A literal argument to a command
+        self.literal_sink = None        # Gives file to write literal data to
         self.tagged_commands = {}       # Tagged commands awaiting response
         self.untagged_responses = []    # [[typ: [data, ...]], ...]
         self.mailbox = None             # Current mailbox selected
@@ -329,6 +347,7 @@ class IMAP4(object):
         self._expecting_data_len = 0    # How many characters we expect
         self._accumulated_data = []     # Message data accumulated so far
         self._literal_expected = None   # Message data descriptor
+        self._literal_file = None       # File receiving message data
 
         self.compressor = None          # COMPRESS/DEFLATE if not None
         self.decompressor = None
@@ -379,24 +398,32 @@ class IMAP4(object):
         self.commands_lock = threading.Lock()
         self.idle_lock = threading.Lock()
 
-        self.ouq = queue.Queue(10)
-        self.inq = queue.Queue()
+        if self.shared_io:
+            self.ouq = _SharedIOSender(self)
+            self.send_lock = threading.Lock()
+            self._shared_io_stopped = threading.Event()
+            self._io_loop = _IOLoop.get()
+        else:
+            self.ouq = queue.Queue(10)
+            self.inq = queue.Queue()
 
-        self.wrth = threading.Thread(target=self._writer)
-        self.wrth.setDaemon(True)
-        self.wrth.start()
-        self.rdth = threading.Thread(target=self._reader)
-        self.rdth.setDaemon(True)
-        self.rdth.start()
-        self.inth = threading.Thread(target=self._handler)
-        self.inth.setDaemon(True)
-        self.inth.start()
+            self.wrth = threading.Thread(target=self._writer)
+            self.wrth.setDaemon(True)
+            self.wrth.start()
+            self._start_reader()
+            self.inth = threading.Thread(target=self._handler)
+            self.inth.setDaemon(True)
+            self.inth.start()
 
         # Get server welcome message,
         # request and store CAPABILITY response.
 
         try:
-            self.welcome = self._request_push(name='welcome', tag='continuation').get_response('IMAP4 protocol error: %s')[1]
+            rqb = self._request_push(name='welcome', tag='continuation')
+            if self.shared_io:
+                # Not before the welcome message is expected.
+                self._start_reader()
+            self.welcome = rqb.get_response('IMAP4 protocol error: %s')[1]
 
             if self._get_untagged_response('PREAUTH'):
                 self.state = AUTH
@@ -603,10 +630,13 @@ class IMAP4(object):
             data = self.compressor.compress(data)
             data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
 
-        if bytes != str:
-            data = bytes(data, 'ASCII')
+        if bytes != str and not isinstance(data, bytes):
+            data = bytes(data, 'utf8')
 
-        self.sock.sendall(data)
+        if self.shared_io:
+            self._shared_io_sendall(data)
+        else:
+            self.sock.sendall(data)
 
 
     def shutdown(self):
@@ -710,8 +740,15 @@ class IMAP4(object):
             date_time = Time2Internaldate(date_time)
         else:
             date_time = None
-        literal = self.mapCRLF_cre.sub(CRLF, message)
+        if isinstance(message, string_types):
+            literal = self.mapCRLF_cre.sub(CRLF, message)
+        else:
+            # Bytes, or a sized iterable of bytes, of the message data
+            # with CRLF line endings.
+            literal = message
         if self.utf8_enabled:
+            if not isinstance(literal, (bytes, string_types)):
+                literal = b''.join(literal)
             literal = b'UTF8 (' + literal + b')'
         self.literal = literal
         try:
@@ -1184,15 +1221,13 @@ class IMAP4(object):
             typ, dat = self._simple_command(name)
         finally:
             self._release_state_change()
-            self.rdth.join()
+            self._join_reader()
             self.TerminateReader = False
             self.read_size = READ_SIZE
 
         if typ != 'OK':
             # Restart reader thread and error
-            self.rdth = threading.Thread(target=self._reader)
-            self.rdth.setDaemon(True)
-            self.rdth.start()
+            self._start_reader()
             raise self.error("Couldn't establish TLS session: %s" % dat)
 
         self.keyfile = keyfile
@@ -1206,9 +1241,7 @@ class IMAP4(object):
             self.ssl_wrap_socket()
         finally:
             # Restart reader thread
-            self.rdth = threading.Thread(target=self._reader)
-            self.rdth.setDaemon(True)
-            self.rdth.start()
+            self._start_reader()
 
         typ, dat = self.capability()
         if dat == [None]:
@@ -1435,8 +1468,16 @@ class IMAP4(object):
         literal = self.literal
         if literal is not None:
             self.literal = None
-            if isinstance(literal, string_types):
+            if not callable(literal):
+                # A string, or an iterable of strings of known len(),
+                # which is sent piecewise (see _send_data()).
                 literator = None
+                if self._nonsync_literal(len(literal)):
+                    # No continuation response to wait for (RFC 7888).
+                    if __debug__: self._log(4, 'data=%s {%s+}' % (data, len(literal)))
+                    rqb.data = self._literal_data('%s {%s+}%s' % (data, len(literal), CRLF), literal)
+                    self.ouq.put(rqb)
+                    return rqb
                 data = '%s {%s}' % (data, len(literal))
             else:
                 literator = literal
@@ -1481,7 +1522,7 @@ class IMAP4(object):
                 crqb = self._request_push(name=name, tag='continuation')
 
             if __debug__: self._log(4, 'write literal size %s' % len(literal))
-            crqb.data = '%s%s' % (literal, CRLF)
+            crqb.data = self._literal_data('', literal)
             self.ouq.put(crqb)
 
             if literator is None:
@@ -1596,13 +1637,22 @@ class IMAP4(object):
             if __debug__: self._log(5, '_put_response expecting data len %s, got %s' % (self._expecting_data_len, rlen))
             self._expecting_data_len -= dlen
             self._expecting_data = (self._expecting_data_len != 0)
-            if rlen <= dlen:
+            if self._literal_file is not None:
+                self._literal_file.write(resp[:dlen])
+                if rlen <= dlen:
+                    return
+            elif rlen <= dlen:
                 self._accumulated_data.append(resp)
                 return
-            self._accumulated_data.append(resp[:dlen])
+            else:
+                self._accumulated_data.append(resp[:dlen])
             resp = resp[dlen:]
 
-        if self._accumulated_data:
+        if self._literal_file is not None:
+            typ, dat = self._literal_expected
+            self._append_untagged(typ, (dat, self._literal_file))
+            self._literal_file = None
+        elif self._accumulated_data:
             typ, dat = self._literal_expected
             self._append_untagged(typ, (dat, ''.join(self._accumulated_data)))
             self._accumulated_data = []
@@ -1623,6 +1673,7 @@ class IMAP4(object):
                 self._expecting_data = True
                 self._expecting_data_len = int(self.mo.group('size'))
                 if __debug__: self._log(4, 'expecting literal size %s' % self._expecting_data_len)
+                self._open_literal_file(self._literal_expected[0], dat)
                 return
             typ = self._literal_expected[0]
             self._literal_expected = None
@@ -1675,6 +1726,7 @@ class IMAP4(object):
                     self._expecting_data_len = int(self.mo.group('size'))
                     if __debug__: self._log(4, 'read literal size %s' % self._expecting_data_len)
                     self._literal_expected = [typ, dat]
+                    self._open_literal_file(typ, dat)
                     return
 
                 self._append_untagged(typ, dat)
@@ -1697,6 +1749,50 @@ class IMAP4(object):
             if __debug__: self._log(1, '%s response: %s' % (typ, dat))
 
 
+    def _open_literal_file(self, typ, dat):
+
+        # Ask 'literal_sink' for a file to write the data of the literal
+        # announced by 'dat' to, instead of accumulating it in memory.
+        # The untagged response then holds the file in place of the data.
+
+        self._literal_file = None
+        if self.literal_sink is not None:
+            self._literal_file = self.literal_sink(typ, dat, self._expecting_data_len)
+
+
+    def _literal_data(self, prefix, literal):
+
+        # Request data for 'literal' following 'prefix'. Literals which are
+        # not strings are kept as is in a list of the parts to send.
+
+        if isinstance(literal, string_types):
+            return '%s%s%s' % (prefix, literal, CRLF)
+        return [prefix, literal, CRLF]
+
+
+    def _send_data(self, data):
+
+        # Send request data, see _literal_data(). Parts which are not
+        # strings are iterated, their own parts may be iterables too
+        # (eg: messages read from files among the literals of an APPEND).
+
+        if isinstance(data, (bytes, string_types)):
+            if data: self.send(data)
+        else:
+            for part in data:
+                self._send_data(part)
+
+
+    def _nonsync_literal(self, size):
+
+        # May a literal of 'size' octets be sent without waiting for the
+        # server's continuation response? (RFC 7888 LITERAL+ / LITERAL-)
+        # Offlineimap decides in UsefulIMAPMixIn.literal_plus().
+
+        literal_plus = getattr(self, 'literal_plus', None)
+        return literal_plus is not None and literal_plus(size)
+
+
     def _quote(self, arg):
 
         return '"%s"' % arg.replace('\\', '\\\\').replace('"', '\\"')
@@ -1768,10 +1864,35 @@ class IMAP4(object):
     #       Threads
 
 
+    def _start_reader(self):
+
+        if self.shared_io:
+            self._shared_io_stopped.clear()
+            self._io_loop.register(self)
+            return
+        self.rdth = threading.Thread(target=self._reader)
+        self.rdth.setDaemon(True)
+        self.rdth.start()
+
+
+    def _join_reader(self):
+
+        if self.shared_io:
+            self._shared_io_stopped.wait()
+            return
+        self.rdth.join()
+
+
     def _close_threads(self):
 
         if __debug__: self._log(1, '_close_threads')
 
+        if self.shared_io:
+            self._io_loop.unregister(self)
+            if __debug__: self._log(1, 'call shutdown')
+            self.shutdown()
+            return
+
         self.ouq.put(None)
         self.wrth.join()
 
@@ -1837,6 +1958,13 @@ class IMAP4(object):
                 typ, val = self.error, 'program error: %s - %s' % sys.exc_info()[:2]
                 break
 
+        self._terminate(typ, val)
+
+
+    def _terminate(self, typ, val):
+
+        # Abort all queued and pending commands with exception 'typ'.
+
         self.Terminate = True
 
         if __debug__: self._log(1, 'terminating: %s' % repr(val))
@@ -2029,6 +2157,191 @@ class IMAP4(object):
         if __debug__: self._log(1, 'finished')
 
 
+    def _shared_io_send(self, rqb):
+
+        # Send request from the calling thread (shared_io connections).
+
+        if self.Terminate:
+            rqb.abort(self.abort, 'connection closed')
+            return
+        self.send_lock.acquire()
+        try:
+            try:
+                self._send_data(rqb.data)
+                if __debug__: self._log(4, '> %s' % rqb.data)
+            except:
+                reason = 'socket error: %s - %s' % sys.exc_info()[:2]
+                if __debug__:
+                    if not self.Terminate:
+                        self._print_log()
+                        if self.debug: self.debug += 4          # Output all
+                        self._log(1, reason)
+                rqb.abort(self.abort, reason)
+                self._io_loop.fail(self, (self.abort, reason))
+        finally:
+            self.send_lock.release()
+
+
+    def _shared_io_started(self):
+
+        # Called by _IOLoop thread when the connection is registered.
+
+        if bytes != str:
+            self._line_part = b''
+        else:
+            self._line_part = ''
+        self._rxzero = 0
+        self._last_input = time.time()
+        # Reads must not block the other connections.
+        self._shared_io_blocking(False)
+
+
+    def _shared_io_blocking(self, flag):
+
+        # Switch the socket between blocking and non-blocking mode, if
+        # there is one (not for IMAP4_stream).
+
+        sock = getattr(self, 'sock', None)
+        if sock is not None:
+            sock.setblocking(flag)
+
+
+    def _shared_io_sendall(self, data):
+
+        # Send all of 'data' on the non-blocking socket, waiting for it
+        # to become ready when it would block.
+
+        while data:
+            try:
+                if hasattr(self.sock, 'send'):
+                    sent = self.sock.send(data)
+                else:
+                    sent = self.sock.write(data)
+            except Exception as e:
+                wait = _would_block(e)
+                if wait is None:
+                    raise
+                if wait == 'read':
+                    select.select([self.sock], [], [], 1)
+                else:
+                    select.select([], [self.sock], [], 1)
+                continue
+            data = data[sent:]
+
+
+    def _shared_io_read(self):
+
+        # Called by _IOLoop thread when input is available.
+        # Returns False when the connection should not be watched anymore.
+
+        try:
+            while True:
+                try:
+                    data = self.read(self.read_size)
+                except Exception as e:
+                    # No complete data yet, e.g. a partial TLS record.
+                    if _would_block(e) is not None:
+                        return True
+                    raise
+                dlen = len(data)
+                if __debug__: self._log(5, 'rcvd %s' % dlen)
+                if dlen == 0:
+                    self._rxzero += 1
+                    if self._rxzero > 5:
+                        raise IOError("Too many read 0")
+                    return True                                 # Try again
+                self._rxzero = 0
+
+                start = 0
+                while True:
+                    if bytes != str:
+                        stop = data.find(b'\n', start)
+                        if stop < 0:
+                            self._line_part += data[start:]
+                            break
+                        stop += 1
+                        line = (self._line_part + data[start:stop]).decode(errors='ignore')
+                        self._line_part, start = b'', stop
+                    else:
+                        stop = data.find('\n', start)
+                        if stop < 0:
+                            self._line_part += data[start:]
+                            break
+                        stop += 1
+                        line = self._line_part + data[start:stop]
+                        self._line_part, start = '', stop
+                    if __debug__: self._log(4, '< %s' % line)
+                    if not self._shared_io_line(line):
+                        return False
+                    if self.TerminateReader:
+                        return False
+
+                # Decompressed or decrypted data may be waiting without
+                # the descriptor becoming readable.
+                if not self._shared_io_buffered():
+                    return True
+        except:
+            reason = 'socket error: %s - %s' % sys.exc_info()[:2]
+            if __debug__:
+                if not self.Terminate:
+                    self._print_log()
+                    if self.debug: self.debug += 4          # Output all
+                    self._log(1, reason)
+            self._terminate(self.abort, reason)
+            return False
+
+
+    def _shared_io_buffered(self):
+
+        if self.decompressor is not None and self.decompressor.unconsumed_tail:
+            return True
+        pending = getattr(getattr(self, 'sock', None), 'pending', None)
+        return pending is not None and pending() > 0
+
+
+    def _shared_io_line(self, line):
+
+        self._last_input = time.time()
+        try:
+            self._put_response(line)
+        except:
+            self._terminate(self.error, 'program error: %s - %s' % sys.exc_info()[:2])
+            return False
+        return True
+
+
+    def _shared_io_deadline(self):
+
+        # Time at which _shared_io_timeout() is due, or None.
+
+        self.idle_lock.acquire()
+        try:
+            if self.idle_timeout is not None:
+                return self.idle_timeout
+        finally:
+            self.idle_lock.release()
+        if self.resp_timeout is None:
+            return None
+        return self._last_input + self.resp_timeout
+
+
+    def _shared_io_timeout(self, now):
+
+        # As the handler thread when no input arrived in time.
+
+        if self.idle_rqb is None:
+            if self.resp_timeout is not None and self.tagged_commands:
+                if __debug__: self._log(1, 'response timeout')
+                self._terminate(self.abort, 'no response after %s secs' % self.resp_timeout)
+                return False
+            self._last_input = now
+            return True
+        if self.idle_timeout > now:
+            return True
+        if __debug__: self._log(2, 'server IDLE timedout')
+        return self._shared_io_line(IDLE_TIMEOUT_RESPONSE)
+
+
     def _writer(self):
 
         threading.currentThread().setName(self.identifier + 'writer')
@@ -2043,7 +2356,7 @@ class IMAP4(object):
                 break   # Outq flushed
 
             try:
-                self.send(rqb.data)
+                self._send_data(rqb.data)
                 if __debug__: self._log(4, '> %s' % rqb.data)
             except:
                 reason = 'socket error: %s - %s' % sys.exc_info()[:2]
@@ -2227,10 +2540,12 @@ class IMAP4_SSL(IMAP4):
             data = self.compressor.compress(data)
             data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
 
-        if bytes != str:
+        if bytes != str and not isinstance(data, bytes):
             data = bytes(data, 'utf8')
 
-        if hasattr(self.sock, "sendall"):
+        if self.shared_io:
+            self._shared_io_sendall(data)
+        elif hasattr(self.sock, "sendall"):
             self.sock.sendall(data)
         else:
             dlen = len(data)
@@ -2313,7 +2628,7 @@ class IMAP4_stream(IMAP4):
             data = self.compressor.compress(data)
             data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
 
-        if bytes != str:
+        if bytes != str and not isinstance(data, bytes):
             data = bytes(data, 'utf8')
 
         self.writefile.write(data)
@@ -2327,6 +2642,195 @@ class IMAP4_stream(IMAP4):
         self.writefile.close()
 
 
+def _would_block(e):
+
+    # Whether exception 'e' from a non-blocking socket means that the
+    # operation must be retried once the socket is ready: returns 'read' or
+    # 'write', the readiness to wait for, else None.
+
+    if SSLWantReadError is not None and isinstance(e, SSLWantReadError):
+        return 'read'
+    if SSLWantWriteError is not None and isinstance(e, SSLWantWriteError):
+        return 'write'
+    if isinstance(e, socket.error) and \
+            e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return 'write'
+    return None
+
+
+
+class _SharedIOSender(object):
+
+    """Private class standing in for the output queue
+    of connections served by _IOLoop."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def put(self, rqb):
+        if rqb is not None:
+            self.conn._shared_io_send(rqb)
+
+    def empty(self):
+        return True
+
+
+
+class _IOLoop(object):
+
+    """Private class to read and handle the input of all shared_io
+    connections in a single thread, in place of their reader and handler
+    threads. Use _IOLoop.get() to obtain the instance."""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        cls._instance_lock.acquire()
+        try:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+        finally:
+            cls._instance_lock.release()
+
+    def __init__(self):
+        self.conns = {}                 # read_fd: connection
+        self.changes = []               # (action, connection, arg)
+        self.lock = threading.Lock()
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread = threading.Thread(target=self._run, name='imaplib2 io')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def register(self, conn):
+        self._change('register', conn, None)
+
+    def unregister(self, conn):
+        """Stop serving conn, aborting its pending commands."""
+
+        if threading.currentThread() is self.thread:
+            self._remove(conn, (conn.abort, 'Terminated'))
+            return
+        done = threading.Event()
+        self._change('unregister', conn, done)
+        done.wait()
+
+    def fail(self, conn, error):
+        """Stop serving conn after error (typ, val) occurred."""
+
+        if threading.currentThread() is self.thread:
+            self._remove(conn, error)
+            return
+        self._change('fail', conn, error)
+
+    def _change(self, action, conn, arg):
+        self.lock.acquire()
+        self.changes.append((action, conn, arg))
+        self.lock.release()
+        os.write(self.wake_w, b'x')
+
+    def _remove(self, conn, error):
+        if self.conns.get(conn.read_fd) is conn:
+            del self.conns[conn.read_fd]
+            try:
+                # E.g. for the TLS handshake after STARTTLS.
+                conn._shared_io_blocking(True)
+            except socket.error:
+                pass                    # Closed already
+        if error is not None and not conn.Terminate:
+            conn._terminate(*error)
+        conn._shared_io_stopped.set()
+
+    def _remove_broken(self, error):
+        # Stop serving the connections whose descriptor can't be watched
+        # anymore. Returns whether there was one.
+        removed = False
+        for fd, conn in list(self.conns.items()):
+            try:
+                os.fstat(fd)
+            except OSError:
+                reason = 'socket error: %s' % error
+                if __debug__: conn._log(1, reason)
+                self._remove(conn, (conn.abort, reason))
+                removed = True
+        return removed
+
+    def _apply_changes(self):
+        self.lock.acquire()
+        changes, self.changes = self.changes, []
+        self.lock.release()
+        for action, conn, arg in changes:
+            if action == 'register':
+                try:
+                    conn._shared_io_started()
+                except socket.error as e:
+                    reason = 'socket error: %s' % e
+                    if __debug__: conn._log(1, reason)
+                    self._remove(conn, (conn.abort, reason))
+                    continue
+                self.conns[conn.read_fd] = conn
+            elif action == 'unregister':
+                self._remove(conn, (conn.abort, 'Terminated'))
+                arg.set()
+            else:
+                self._remove(conn, arg)
+
+    def _wait(self, timeout):
+        # Returns the readable descriptors.
+        fds = [self.wake_r] + list(self.conns.keys())
+        if hasattr(select_module, "poll"):
+            poll = select.poll()
+            for fd in fds:
+                poll.register(fd, select.POLLIN)
+            if timeout is not None:
+                timeout = timeout * 1000        # poll() timeout is in millisecs
+            # Errors are noticed by the following read.
+            return [fd for fd, state in poll.poll(timeout)]
+        return select.select(fds, [], [], timeout)[0]
+
+    def _run(self):
+        while True:
+            self._apply_changes()
+
+            now = time.time()
+            timeout = None
+            for conn in list(self.conns.values()):
+                deadline = conn._shared_io_deadline()
+                if deadline is None:
+                    continue
+                if deadline <= now:
+                    if not conn._shared_io_timeout(now):
+                        self._remove(conn, None)
+                    continue
+                if timeout is None or deadline - now < timeout:
+                    timeout = deadline - now
+
+            try:
+                readable = self._wait(timeout)
+            except (select.error, socket.error, ValueError) as e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                # A descriptor was closed under our feet, don't let its
+                # connection take all the others down.
+                if not self._remove_broken(e):
+                    reason = 'socket error: %s' % e
+                    for conn in list(self.conns.values()):
+                        if __debug__: conn._log(1, reason)
+                        self._remove(conn, (conn.abort, reason))
+                continue
+
+            for fd in readable:
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                    continue
+                conn = self.conns.get(fd)
+                if conn is not None and not conn._shared_io_read():
+                    self._remove(conn, None)
+
+
+
 class _Authenticator(object):
 
     """Private class to provide en/de-coding
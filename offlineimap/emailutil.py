@@ -34,3 +34,64 @@ def get_message_date(content, header='Date'):
     if datetuple is None:
         return None
     return email.utils.mktime_tz(datetuple)
+
+def decode_message(data):
+    """Returns the message read from a file in binary mode as a string with
+    '\\n' line endings.
+
+    Bytes which are not valid UTF-8 are kept as surrogates on Python 3."""
+
+    if not isinstance(data, str):
+        data = data.decode('utf-8', 'surrogateescape')
+    if '\r\n' in data:
+        data = data.replace('\r\n', '\n')
+    return data
+
+# Header marking a message whose body was not downloaded, see make_stub().
+STUB_HEADER = 'X-OfflineIMAP-Stub'
+
+def make_stub(headers, size=None):
+    """Returns a stub of a message made of its headers, marked with the
+    STUB_HEADER header, and a short text body in place of its own.
+
+    :param headers: the header part of the message, '\\n' line endings;
+    :param size: the size of the message, recorded in the stub if known.
+    """
+
+    # The body is replaced by plain text, drop the headers describing it.
+    lines = []
+    skip = False
+    for line in headers.rstrip('\n').split('\n'):
+        if line[:1] not in (' ', '\t'):
+            name = line.split(':', 1)[0].strip().lower()
+            skip = name in ('content-type', 'content-transfer-encoding')
+        if not skip:
+            lines.append(line)
+    lines.append("%s: %s"% (STUB_HEADER, 'unknown' if size is None else size))
+    return ("%s\n\n"
+        "The body of this message has not been downloaded yet.\n"
+        "Run 'offlineimap --hydrate' to download it.\n"% '\n'.join(lines))
+
+def read_headers(msgfile):
+    """Returns the header part of the message read from msgfile, a file in
+    binary mode, as decode_message() does. The file is left positioned
+    after the headers."""
+
+    headers = []
+    for line in iter(msgfile.readline, b''):
+        if not line.strip():
+            break
+        headers.append(line)
+    return decode_message(b''.join(headers))
+
+def is_stub(headers):
+    """Returns True if the header part of a message is the one of a stub,
+    see make_stub(). A whole message may be given as well."""
+
+    prefix = STUB_HEADER.lower() + ':'
+    for line in headers.split('\n'):
+        if not line.strip():
+            break
+        if line.lower().startswith(prefix):
+            return True
+    return False
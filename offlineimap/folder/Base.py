@@ -15,16 +15,379 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
+import io
 import os.path
 import re
+import string
 import time
+from array import array
+from bisect import bisect_left
 from sys import exc_info
+try:
+    from collections.abc import MutableMapping
+except ImportError: # Python 2.
+    from collections import MutableMapping
 
-from offlineimap import threadutil
+import six
+
+from offlineimap import threadutil, emailutil
 from offlineimap.ui import getglobalui
 from offlineimap.error import OfflineImapError
 import offlineimap.accounts
 
+try:
+    array('q')
+    _int64 = 'q'
+except ValueError: # Python 2, long is 64-bit on most platforms.
+    _int64 = 'l'
+_intmax = 2 ** (8 * array(_int64).itemsize - 1) - 1
+# Marker of the arrays of a MessageList: no value, or a value that does
+# not fit and is kept in the side table of the field.
+_ABSENT = -_intmax - 1
+# One bit per maildir flag letter.
+_flagbits = dict((flag, 1 << i) for i, flag in enumerate(string.ascii_letters))
+# Suffix of the namespace of the worker copying the large messages, see
+# getlargemessages().
+LARGE_NAMESPACE = '_LARGE'
+
+
+def flagmask(flags):
+    """Return the bitmask of the flags, or None if a flag has no bit."""
+
+    mask = 0
+    for flag in flags:
+        if flag not in _flagbits:
+            return None
+        mask |= _flagbits[flag]
+    return mask if mask <= _intmax else None
+
+
+class MessageList(MutableMapping):
+    """Compact messagelist, mapping UIDs to dict-like message items.
+
+    Each message gets a slot in arrays: the flags are kept as bitmasks, the
+    intfields as integers in one array each. The other fields, and values
+    that do not fit the arrays, are kept in sparse side tables by slot.
+    Equal set values are stored once.
+
+    The UIDs are kept in a sorted array, searched with bisect, along with
+    the array of their slots. New UIDs wait in a small dict until they are
+    merged into the arrays, so that unordered additions are not quadratic.
+
+    The set values are returned as frozensets: changing a set read from an
+    item fails, a new value must be assigned back (augmented assignments do
+    that)."""
+
+    intfields = ('uid', 'time', 'mtime', 'size')
+    # Minimum number of new UIDs merged at once into the sorted arrays.
+    mergesize = 256
+
+    def __init__(self):
+        self._uids = array(_int64)      # Sorted UIDs.
+        self._uidslots = array('L')     # Slots of the UIDs of self._uids.
+        self._newslots = {}     # uid -> slot, not merged yet.
+        self._freeslots = []
+        self._size = 0          # Length of the arrays.
+        self._flags = array(_int64)
+        self._ints = {}         # field -> array of the values by slot.
+        self._others = {}       # field -> {slot: value}
+        self._flagsets = {}     # bitmask -> frozenset of the flags.
+        self._interned = {}     # Stored frozensets of the set values.
+
+    def _slot(self, uid):
+        """Return the slot of uid, or None."""
+
+        slot = self._newslots.get(uid)
+        if slot is None:
+            i = bisect_left(self._uids, uid)
+            if i < len(self._uids) and self._uids[i] == uid:
+                slot = self._uidslots[i]
+        return slot
+
+    def __merge(self):
+        if self._newslots:
+            # Both parts are sorted: sorting their concatenation merges them.
+            newuids = sorted(self._newslots)
+            uids = self._uids.tolist() + newuids
+            slots = self._uidslots.tolist() + \
+                [self._newslots[uid] for uid in newuids]
+            order = sorted(range(len(uids)), key=uids.__getitem__)
+            self._uids = array(_int64, map(uids.__getitem__, order))
+            self._uidslots = array('L', map(slots.__getitem__, order))
+            self._newslots = {}
+
+    def __contains__(self, uid):
+        return self._slot(uid) is not None
+
+    def __getitem__(self, uid):
+        if self._slot(uid) is None:
+            raise KeyError(uid)
+        return MessageItem(self, uid)
+
+    def __setitem__(self, uid, item):
+        slot = self._slot(uid)
+        if slot is None:
+            slot = self.__allocslot()
+            self._newslots[uid] = slot
+            pending = len(self._newslots)
+            if pending > self.mergesize and pending > len(self._uids) // 8:
+                self.__merge()
+        else:
+            self.__clearslot(slot)
+        for field, value in item.items():
+            self._setfield(slot, field, value)
+
+    def __delitem__(self, uid):
+        slot = self._newslots.pop(uid, None)
+        if slot is None:
+            i = bisect_left(self._uids, uid)
+            if i == len(self._uids) or self._uids[i] != uid:
+                raise KeyError(uid)
+            slot = self._uidslots[i]
+            del self._uids[i]
+            del self._uidslots[i]
+        self.__clearslot(slot)
+        self._freeslots.append(slot)
+
+    def __iter__(self):
+        self.__merge()
+        return iter(array(_int64, self._uids))
+
+    def __len__(self):
+        return len(self._uids) + len(self._newslots)
+
+    def __repr__(self):
+        return repr(dict((uid, dict(item)) for uid, item in self.items()))
+
+    def flagmasks(self):
+        """Return a dict mapping the UIDs to the bitmask of their flags.
+
+        The bitmask is None for messages whose flags are not kept as a
+        bitmask."""
+
+        self.__merge()
+        flags = self._flags
+        return dict((uid, None if flags[slot] == _ABSENT else flags[slot])
+                    for uid, slot in zip(self._uids, self._uidslots))
+
+    def __allocslot(self):
+        if self._freeslots:
+            return self._freeslots.pop()
+        self._flags.append(_ABSENT)
+        for values in self._ints.values():
+            values.append(_ABSENT)
+        self._size += 1
+        return self._size - 1
+
+    def __clearslot(self, slot):
+        self._flags[slot] = _ABSENT
+        for values in self._ints.values():
+            values[slot] = _ABSENT
+        for table in self._others.values():
+            table.pop(slot, None)
+
+    def _getfield(self, slot, field):
+        if field == 'flags':
+            mask = self._flags[slot]
+            if mask != _ABSENT:
+                flags = self._flagsets.get(mask)
+                if flags is None:
+                    flags = frozenset(flag for flag, bit in _flagbits.items()
+                                      if mask & bit)
+                    self._flagsets[mask] = flags
+                return flags
+        elif field in self._ints:
+            value = self._ints[field][slot]
+            if value != _ABSENT:
+                return value
+        value = self._others.get(field, {}).get(slot, _ABSENT)
+        if value is _ABSENT:
+            raise KeyError(field)
+        return value
+
+    def _setfield(self, slot, field, value):
+        self._delfield(slot, field)
+        if field == 'flags':
+            mask = flagmask(value)
+            if mask is not None:
+                self._flags[slot] = mask
+                return
+        elif field in self.intfields:
+            if isinstance(value, six.integer_types) and \
+                    not isinstance(value, bool) and _ABSENT < value <= _intmax:
+                if field not in self._ints:
+                    self._ints[field] = array(_int64, [_ABSENT]) * self._size
+                self._ints[field][slot] = value
+                return
+        if isinstance(value, (set, frozenset)):
+            value = frozenset(value)
+            value = self._interned.setdefault(value, value)
+        self._others.setdefault(field, {})[slot] = value
+
+    def _delfield(self, slot, field):
+        present = False
+        if field == 'flags':
+            present = self._flags[slot] != _ABSENT
+            self._flags[slot] = _ABSENT
+        elif field in self._ints:
+            present = self._ints[field][slot] != _ABSENT
+            self._ints[field][slot] = _ABSENT
+        if self._others.get(field, {}).pop(slot, _ABSENT) is not _ABSENT:
+            present = True
+        return present
+
+    def _fields(self, slot):
+        fields = set()
+        if self._flags[slot] != _ABSENT:
+            fields.add('flags')
+        for field, values in self._ints.items():
+            if values[slot] != _ABSENT:
+                fields.add(field)
+        for field, table in self._others.items():
+            if slot in table:
+                fields.add(field)
+        return fields
+
+
+class MessageItem(MutableMapping):
+    """Dict-like message item of a MessageList."""
+
+    def __init__(self, messagelist, uid):
+        self._messagelist = messagelist
+        self._uid = uid
+
+    def __slot(self):
+        slot = self._messagelist._slot(self._uid)
+        if slot is None:
+            raise KeyError(self._uid)
+        return slot
+
+    def __getitem__(self, field):
+        return self._messagelist._getfield(self.__slot(), field)
+
+    def __setitem__(self, field, value):
+        self._messagelist._setfield(self.__slot(), field, value)
+
+    def __delitem__(self, field):
+        if not self._messagelist._delfield(self.__slot(), field):
+            raise KeyError(field)
+
+    def __iter__(self):
+        return iter(self._messagelist._fields(self.__slot()))
+
+    def __len__(self):
+        return len(self._messagelist._fields(self.__slot()))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return dict(self)
+
+
+class SyncPlan(object):
+    """The work of the passes of syncmessagesto() for a folder pair.
+
+    The work lists are computed with set operations on the UID lists of the
+    folders, and the flags are compared as bitmasks when the folders keep
+    them in a MessageList. Each pass changes the folders, so each list is
+    computed from their state when it is requested. The number of changes
+    found is counted in self.changes."""
+
+    def __init__(self, srcfolder, dstfolder, statusfolder):
+        self.srcfolder = srcfolder
+        self.dstfolder = dstfolder
+        self.statusfolder = statusfolder
+        self.changes = 0
+
+    def copylist(self, ignoreuids=None):
+        """Return the sorted list of the UIDs to copy from srcfolder, and
+        the list of those to ignore from ignoreuids."""
+
+        statusuids = set(self.statusfolder.getmessageuidlist())
+        copylist = [uid for uid in self.srcfolder.getmessageuidlist()
+                    if uid not in statusuids]
+        ignored = []
+        if ignoreuids:
+            ignoreuids = set(ignoreuids)
+            ignored = [uid for uid in copylist if uid in ignoreuids]
+            if ignored:
+                copylist = [uid for uid in copylist if uid not in ignoreuids]
+        self.changes += len(copylist)
+        return copylist, ignored
+
+    def deletelist(self, sync_deletes=True):
+        """Return the list of the UIDs to delete from statusfolder, and
+        the list of those to delete from dstfolder.
+
+        These are the messages of statusfolder deleted in srcfolder. If
+        sync_deletes is False, only the messages also missing in dstfolder
+        are removed from statusfolder."""
+
+        srcuids = set(self.srcfolder.getmessageuidlist())
+        dstuids = set(self.dstfolder.getmessageuidlist())
+        deletelist = [uid for uid in self.statusfolder.getmessageuidlist()
+                      if uid >= 0 and uid not in srcuids and
+                      (sync_deletes or uid not in dstuids)]
+        self.changes += len(deletelist)
+        return deletelist, [uid for uid in deletelist if uid in dstuids]
+
+    def flagchanges(self):
+        """Return two dicts mapping the flags to the lists of the UIDs to
+        which they must be added, and from which they must be removed.
+
+        Only the messages with a valid UID that exist in dstfolder are
+        considered."""
+
+        srcfolder, dstfolder = self.srcfolder, self.dstfolder
+        dstuids = set(dstfolder.getmessageuidlist())
+        srcmasks = statusmasks = None
+        try:
+            keywordmap = dstfolder.getrepository().getkeywordmap()
+        except NotImplementedError:
+            keywordmap = None
+        if keywordmap is None:
+            # Without keywords, the flags to sync are the flags of srcfolder.
+            srcmasks = srcfolder.getmessageflagmasks()
+            statusmasks = self.statusfolder.getmessageflagmasks()
+
+        addflaglist = {}
+        delflaglist = {}
+        for uid in srcfolder.getmessageuidlist():
+            # Ignore messages with negative UIDs missed by pass 1 and
+            # don't do anything if the message has been deleted remotely
+            if uid < 0 or uid not in dstuids:
+                continue
+
+            if srcmasks is not None and statusmasks is not None:
+                srcmask = srcmasks.get(uid)
+                statusmask = statusmasks.get(uid, 0)
+                if srcmask is not None and statusmask is not None:
+                    if srcmask != statusmask:
+                        self.__addchanges(addflaglist, uid,
+                            srcmask & ~statusmask)
+                        self.__addchanges(delflaglist, uid,
+                            statusmask & ~srcmask)
+                    continue
+
+            if self.statusfolder.uidexists(uid):
+                statusflags = self.statusfolder.getmessageflags(uid)
+            else:
+                statusflags = set()
+            selfflags = srcfolder.combine_flags_and_keywords(uid, dstfolder)
+            for flag in selfflags - statusflags:
+                addflaglist.setdefault(flag, []).append(uid)
+            for flag in statusflags - selfflags:
+                delflaglist.setdefault(flag, []).append(uid)
+        self.changes += len(set(uid for uids in list(addflaglist.values()) +
+            list(delflaglist.values()) for uid in uids))
+        return addflaglist, delflaglist
+
+    def __addchanges(self, flaglist, uid, mask):
+        for flag, bit in _flagbits.items():
+            if mask & bit:
+                flaglist.setdefault(flag, []).append(uid)
+
 
 class BaseFolder(object):
     __hash__ = None
@@ -36,7 +399,7 @@ class BaseFolder(object):
         """
 
         self.ui = getglobalui()
-        self.messagelist = {}
+        self.messagelist = MessageList()
         # Save original name for folderfilter operations.
         self.ffilter_name = name
         # Top level dir name is always ''.
@@ -48,6 +411,7 @@ class BaseFolder(object):
             self.newmail_hook = repository.newmail_hook
         self.have_newmail = False
         self.copy_ignoreUIDs = None # List of UIDs to ignore.
+        self.syncplan = None # SyncPlan of the running syncmessagesto().
         self.repository = repository
         self.visiblename = repository.nametrans(name)
         # In case the visiblename becomes '.' or '/' (top-level) we use
@@ -167,6 +531,13 @@ class BaseFolder(object):
 
         return 1
 
+    def storesstubs(self):
+        """Should be true for backends which can store a stub in place of a
+        message, see getmessagestub(), and replace it with the message
+        later, see replacemessagefrom()."""
+
+        return False
+
     def getvisiblename(self):
         """The nametrans-transposed name of the folder's name."""
 
@@ -283,6 +654,26 @@ class BaseFolder(object):
 
         raise NotImplementedError
 
+    def cachemessagelist_incremental(self, statusfolder):
+        """Cache the list of messages based on the last known folder state.
+
+        Backends which can ask for the changes since the last sync only
+        implement this. Callers fall back to cachemessagelist() if False is
+        returned.
+
+        :param statusfolder: keeps track of the last known folder state.
+        :returns: True if the message list was cached."""
+
+        return False
+
+    def record_folderstate(self, statusfolder, changed=False):
+        """Save the state needed by cachemessagelist_incremental() and
+        quickchanged() to statusfolder after a successful sync.
+
+        :param changed: whether the sync changed this folder."""
+
+        pass
+
     def ismessagelistempty(self):
         """Is the list of messages empty."""
 
@@ -293,7 +684,18 @@ class BaseFolder(object):
     def dropmessagelistcache(self):
         """Empty everythings we know about messages."""
 
-        self.messagelist = {}
+        self.messagelist = MessageList()
+
+    def getwarmsize(self):
+        """Return the number of messages of which the folder keeps data in
+        memory between syncs with the warm cache, see dropwarmdata()."""
+
+        return 0
+
+    def dropwarmdata(self):
+        """Drop the data kept in memory between syncs, if any."""
+
+        pass
 
     def getmessagelist(self):
         """Gets the current message list.
@@ -323,6 +725,16 @@ class BaseFolder(object):
 
         return sorted(self.getmessagelist().keys())
 
+    def getmessageflagmasks(self):
+        """Returns a dict mapping the UIDs to the bitmask of their flags
+        (None for a message without one), or None if the folder does not
+        keep its flags as bitmasks."""
+
+        messagelist = self.getmessagelist()
+        if isinstance(messagelist, MessageList):
+            return messagelist.flagmasks()
+        return None
+
     def getmessagecount(self):
         """Gets the number of messages."""
 
@@ -333,6 +745,50 @@ class BaseFolder(object):
 
         raise NotImplementedError
 
+    def fetchmessage(self, uid, openfile):
+        """Returns the content of the specified message like getmessage(),
+        or writes it to the file returned by openfile() and returns None.
+
+        Folders that can stream large messages override this. openfile()
+        may return None, the content must be returned then."""
+
+        return self.getmessage(uid)
+
+    def wantsstub(self, uid):
+        """Returns True if only a stub of the message should be copied to
+        folders storing stubs, see storesstubs()."""
+
+        return False
+
+    def getmessagestub(self, uid):
+        """Returns a stub of the specified message, made of its headers,
+        see emailutil.make_stub()."""
+
+        raise NotImplementedError
+
+    def isstub(self, uid):
+        """Returns True if the specified message is a stub."""
+
+        return False
+
+    def replacemessagefrom(self, uid, fetchmessage):
+        """Replaces the content of the specified message by the one provided
+        by fetchmessage(openfile), see savemessagefrom(), keeping its flags.
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a
+        dryrun mode."""
+
+        raise NotImplementedError
+
+    def openmessagefile(self, uid):
+        """Returns the file of the specified message opened in binary mode,
+        or None if the folder does not keep messages in files.
+
+        The caller closes the file."""
+
+        return None
+
     def getmaxage(self):
         """Return maxage.
 
@@ -419,6 +875,52 @@ class BaseFolder(object):
             raise IOError("Can't read %s"% uidfile)
 
 
+    def getsavebatchsize(self):
+        """Returns the maximum number of messages to pass to
+        savemessages() at once."""
+
+        return 1
+
+    def getsavebatchbytes(self):
+        """Returns the maximum size of the messages to pass to
+        savemessages() at once."""
+
+        return 0
+
+    def savemessages(self, messages):
+        """Writes a batch of new messages.
+
+        Backends which can save several messages in one go implement this
+        and getsavebatchsize(). Note that savemessages() does not check
+        against dryrun settings.
+
+        :param messages: list of (uid, content, flags, rtime) tuples, as the
+            arguments of savemessage(). Content may also be the bytes read
+            from the file of the message, see openmessagefile().
+        :returns: the list of the new UIDs in the order of messages, as
+            savemessage() returns them, or None if no message was saved. The
+            caller must then save them one by one."""
+
+        return None
+
+    def getmessagebatches(self, uidlist):
+        """Split uidlist in consecutive batches of messages which are worth
+        fetching together with prefetchmessages()."""
+
+        return [uidlist]
+
+    def getlargemessages(self, uidlist):
+        """Return the set of the UIDs of uidlist which are large enough to
+        be copied after the other messages, one by one."""
+
+        return set()
+
+    def prefetchmessages(self, uidlist):
+        """Announce that the messages of uidlist are about to be retrieved
+        with getmessage(), so that backends can fetch them in one go."""
+
+        pass
+
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
 
@@ -443,6 +945,25 @@ class BaseFolder(object):
 
         raise NotImplementedError
 
+    def savemessagefrom(self, uid, fetchmessage, flags, rtime):
+        """Writes a new message like savemessage(), its content being
+        provided by fetchmessage(openfile), see fetchmessage().
+
+        Folders that can save messages from a file override this, so that
+        large messages need not be held in memory."""
+
+        return self.savemessage(uid, fetchmessage(lambda: None), flags, rtime)
+
+    def savemessagefile(self, uid, msgfile, flags, rtime):
+        """Writes a new message like savemessage(), its content being read
+        from msgfile, see openmessagefile().
+
+        Folders that can send a message straight from its file override
+        this, so that large messages need not be held in memory."""
+
+        content = emailutil.decode_message(msgfile.read())
+        return self.savemessage(uid, content, flags, rtime)
+
     def getmessagetime(self, uid):
         """Return the received time for the specified message."""
 
@@ -517,6 +1038,22 @@ class BaseFolder(object):
         for uid in uidlist:
             self.deletemessageflags(uid, flags)
 
+    def changemessagesflags(self, changes):
+        """Apply several flag changes at once.
+
+        :param changes: list of (operation, uidlist, flags) where operation
+            is '+' to add and '-' to remove flags, applied in this order.
+
+        Note that this function does not check against dryrun settings,
+        so you need to ensure that it is never called in a
+        dryrun mode."""
+
+        for operation, uidlist, flags in changes:
+            if operation == '+':
+                self.addmessagesflags(uidlist, flags)
+            else:
+                self.deletemessagesflags(uidlist, flags)
+
     def getmessagelabels(self, uid):
         """Returns the labels for the specified message."""
 
@@ -834,37 +1371,29 @@ class BaseFolder(object):
             rtime = self.getmessagetime(uid)
 
             # If any of the destinations actually stores the message body,
-            # load it up.
+            # load it up. The message may be passed on as a file instead.
             if dstfolder.storesmessages():
-                message = self.getmessage(uid)
-            # Succeeded? -> IMAP actually assigned a UID. If newid
-            # remained negative, no server was willing to assign us an
-            # UID. If newid is 0, saving succeeded, but we could not
-            # retrieve the new UID. Ignore message in this case.
-            new_uid = dstfolder.savemessage(uid, message, flags, rtime)
-            if new_uid > 0:
-                if new_uid != uid:
-                    # Got new UID, change the local uid to match the new one.
-                    self.change_message_uid(uid, new_uid)
-                    statusfolder.deletemessage(uid)
-                    # Got new UID, change the local uid.
-                # Save uploaded status in the statusfolder.
-                statusfolder.savemessage(new_uid, message, flags, rtime)
-                # Check whether the mail has been seen.
-                if 'S' not in flags:
-                    self.have_newmail = True
-            elif new_uid == 0:
-                # Message was stored to dstfolder, but we can't find it's UID
-                # This means we can't link current message to the one created
-                # in IMAP. So we just delete local message and on next run
-                # we'll sync it back
-                # XXX This could cause infinite loop on syncing between two
-                # IMAP servers ...
-                self.deletemessage(uid)
+                if dstfolder.storesstubs() and self.wantsstub(uid):
+                    # Only the headers are copied for now.
+                    self.__checknotstub(uid)
+                    new_uid = dstfolder.savemessage(uid,
+                        self.getmessagestub(uid), flags, rtime)
+                else:
+                    msgfile = self.openmessagefile(uid)
+                    if msgfile is not None:
+                        with msgfile:
+                            self.__checknotstub(uid, msgfile=msgfile)
+                            new_uid = dstfolder.savemessagefile(uid, msgfile,
+                                flags, rtime)
+                    else:
+                        self.__checknotstub(uid)
+                        new_uid = dstfolder.savemessagefrom(uid,
+                            lambda openfile: self.fetchmessage(uid, openfile),
+                            flags, rtime)
             else:
-                raise OfflineImapError("Trying to save msg (uid %d) on folder "
-                    "%s returned invalid uid %d"% (uid, dstfolder.getvisiblename(),
-                    new_uid), OfflineImapError.ERROR.MESSAGE)
+                new_uid = dstfolder.savemessage(uid, message, flags, rtime)
+            self.__copiedmessage(uid, new_uid, message, flags, rtime,
+                dstfolder, statusfolder)
         except (KeyboardInterrupt): # Bubble up CTRL-C.
             raise
         except OfflineImapError as e:
@@ -876,6 +1405,149 @@ class BaseFolder(object):
               msg = "Copying message %s [acc: %s]"% (uid, self.accountname))
             raise  # Raise on unknown errors, so we can fix those.
 
+    def copymessagesto(self, uidlist, dstfolder, statusfolder, register=1):
+        """Copies the messages of uidlist from self to dst like
+        copymessageto(), letting dstfolder save them with savemessages().
+
+        The messages are loaded until getsavebatchbytes() is reached, then
+        saved as a batch. If dstfolder could not save the batch, the
+        messages are saved one by one. If a message fails to load, the
+        messages of its batch are left for the next sync.
+
+        :param uidlist: uids of the messages to be copied.
+        :param dstfolder: A BaseFolder-derived instance storing messages.
+        :param statusfolder: A LocalStatusFolder instance
+        :param register: whether we should register a new thread."
+        :returns: Nothing on success, or raises an Exception."""
+
+        if register: # Output that we start a new thread.
+            self.ui.registerthread(self.repository.account)
+
+        maxbytes = dstfolder.getsavebatchbytes()
+        pos = 0
+        while pos < len(uidlist):
+            # Bail out on CTRL-C or SIGTERM.
+            if offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                break
+            try:
+                messages, batchbytes = [], 0
+                for uid in uidlist[pos:]:
+                    pos += 1
+                    if dstfolder.storesstubs() and self.wantsstub(uid):
+                        self.__checknotstub(uid)
+                        message = self.getmessagestub(uid)
+                    else:
+                        message = self.__loadmessage(uid)
+                    messages.append((uid, message, self.getmessageflags(uid),
+                        self.getmessagetime(uid)))
+                    batchbytes += len(message)
+                    if batchbytes >= maxbytes:
+                        break
+                self.__savemessagebatch(messages, dstfolder, statusfolder)
+            except (KeyboardInterrupt): # Bubble up CTRL-C.
+                raise
+            except OfflineImapError as e:
+                if e.severity > OfflineImapError.ERROR.MESSAGE:
+                    raise # Bubble severe errors up.
+                self.ui.error(e, exc_info()[2])
+            except Exception as e:
+                self.ui.error(e, exc_info()[2],
+                  msg = "Copying message %s [acc: %s]"% (uid, self.accountname))
+                raise  # Raise on unknown errors, so we can fix those.
+
+    def __loadmessage(self, uid):
+        """Return the content of message uid to be copied, checking that it
+        is not a stub.
+
+        The raw bytes of the file are returned if the folder keeps messages
+        in files, so that they are not decoded, see openmessagefile()."""
+
+        msgfile = self.openmessagefile(uid)
+        if msgfile is None:
+            message = self.getmessage(uid)
+            self.__checknotstub(uid, message=message)
+            return message
+        with msgfile:
+            self.__checknotstub(uid, msgfile=msgfile)
+            return msgfile.read()
+
+    def __savemessagebatch(self, messages, dstfolder, statusfolder):
+        """Save messages to dstfolder, as a batch if possible."""
+
+        new_uids = None
+        if len(messages) > 1:
+            new_uids = dstfolder.savemessages(messages)
+        if new_uids is None:
+            for uid, message, flags, rtime in messages:
+                if isinstance(message, bytes):
+                    new_uid = dstfolder.savemessagefile(uid,
+                        io.BytesIO(message), flags, rtime)
+                else:
+                    new_uid = dstfolder.savemessage(uid, message, flags,
+                        rtime)
+                self.__copiedmessage(uid, new_uid, message, flags, rtime,
+                    dstfolder, statusfolder)
+            return
+        for (uid, message, flags, rtime), new_uid in zip(messages, new_uids):
+            self.__copiedmessage(uid, new_uid, message, flags, rtime,
+                dstfolder, statusfolder)
+
+    def __checknotstub(self, uid, message=None, msgfile=None):
+        """Raise an OfflineImapError if message uid is a stub, which must
+        not be copied in place of the message.
+
+        When the content of the message or its open file is at hand, its
+        headers are checked instead of calling isstub(). The file is
+        rewound."""
+
+        if not self.storesstubs():
+            return
+        if message is not None:
+            stub = emailutil.is_stub(message)
+        elif msgfile is not None:
+            stub = emailutil.is_stub(emailutil.read_headers(msgfile))
+            msgfile.seek(0)
+        else:
+            stub = self.isstub(uid)
+        if stub:
+            raise OfflineImapError("Message %s of folder %s is a stub, its "
+                "body has not been downloaded. Run offlineimap with "
+                "--hydrate before copying it to another folder."%
+                (uid, self.getvisiblename()), OfflineImapError.ERROR.MESSAGE)
+
+    def __copiedmessage(self, uid, new_uid, message, flags, rtime,
+                        dstfolder, statusfolder):
+        """Update self and statusfolder after message uid was saved as
+        new_uid in dstfolder."""
+
+        # Succeeded? -> IMAP actually assigned a UID. If newid
+        # remained negative, no server was willing to assign us an
+        # UID. If newid is 0, saving succeeded, but we could not
+        # retrieve the new UID. Ignore message in this case.
+        if new_uid > 0:
+            if new_uid != uid:
+                # Got new UID, change the local uid to match the new one.
+                self.change_message_uid(uid, new_uid)
+                statusfolder.deletemessage(uid)
+                # Got new UID, change the local uid.
+            # Save uploaded status in the statusfolder.
+            statusfolder.savemessage(new_uid, message, flags, rtime)
+            # Check whether the mail has been seen.
+            if 'S' not in flags:
+                self.have_newmail = True
+        elif new_uid == 0:
+            # Message was stored to dstfolder, but we can't find it's UID
+            # This means we can't link current message to the one created
+            # in IMAP. So we just delete local message and on next run
+            # we'll sync it back
+            # XXX This could cause infinite loop on syncing between two
+            # IMAP servers ...
+            self.deletemessage(uid)
+        else:
+            raise OfflineImapError("Trying to save msg (uid %d) on folder "
+                "%s returned invalid uid %d"% (uid, dstfolder.getvisiblename(),
+                new_uid), OfflineImapError.ERROR.MESSAGE)
+
     def __syncmessagesto_copy(self, dstfolder, statusfolder):
         """Pass1: Copy locally existing messages not on the other side.
 
@@ -892,18 +1564,17 @@ class BaseFolder(object):
         # We have no new mail yet.
         self.have_newmail = False
 
-        threads = []
-
-        copylist = [uid for uid in self.getmessageuidlist()
-            if not statusfolder.uidexists(uid)]
-        num_to_copy = len(copylist)
+        # Copy jobs are run by the workers of the pool of the namespace.
+        pool = None
+        if self.suggeststhreads():
+            pool = threadutil.getWorkerPool(self.getinstancelimitnamespace())
+            jobs = threadutil.JobGroup()
 
         # Honor 'copy_ignore_eval' configuration option.
-        if self.copy_ignoreUIDs is not None:
-            for uid in self.copy_ignoreUIDs:
-                if uid in copylist:
-                    copylist.remove(uid)
-                    self.ui.ignorecopyingmessage(uid, self, dstfolder)
+        copylist, ignored = self.syncplan.copylist(self.copy_ignoreUIDs)
+        num_to_copy = len(copylist) + len(ignored)
+        for uid in ignored:
+            self.ui.ignorecopyingmessage(uid, self, dstfolder)
 
         if num_to_copy > 0 and self.repository.account.dryrun:
             self.ui.info("[DRYRUN] Copy {} messages from {}[{}] to {}".format(
@@ -911,12 +1582,44 @@ class BaseFolder(object):
             )
             return
 
+        # Small messages are copied first, so that new mail shows up
+        # quickly. Large messages are then copied one by one, on a lane of
+        # their own if there is a pool, so that they do not hold up the
+        # workers shared with the other folders.
+        large = set()
+        if dstfolder.storesmessages():
+            large = self.getlargemessages(copylist)
+        nsmall = len(copylist) - len(large)
+        if large:
+            copylist = [uid for uid in copylist if uid not in large] + \
+                [uid for uid in copylist if uid in large]
+            if pool is not None:
+                largepool = threadutil.getWorkerPool(
+                    self.getinstancelimitnamespace() + LARGE_NAMESPACE)
+
+        # Index in copylist of the first message of each batch to prefetch.
+        batches = {}
+        if dstfolder.storesmessages():
+            start = 0
+            for batch in self.getmessagebatches(copylist[:nsmall]):
+                batches[start] = batch
+                start += len(batch)
+
+        # Messages saved as a batch, if dstfolder supports it.
+        savebatchsize = dstfolder.getsavebatchsize()
+        pending = []
+
         with self:
             for num, uid in enumerate(copylist):
                 # Bail out on CTRL-C or SIGTERM.
                 if offlineimap.accounts.Account.abort_NOW_signal.is_set():
                     break
 
+                if num in batches:
+                    self.prefetchmessages([u for u in batches[num]
+                        if not (u > 0 and dstfolder.uidexists(u)) and
+                        not (dstfolder.storesstubs() and self.wantsstub(u))])
+
                 if uid == 0:
                     self.ui.warn("Assertion that UID != 0 failed; ignoring message.")
                     continue
@@ -929,21 +1632,39 @@ class BaseFolder(object):
                     continue
 
                 self.ui.copyingmessage(uid, num+1, num_to_copy, self, dstfolder)
+                lane = pool
+                if num >= nsmall:
+                    target = self.copymessageto
+                    args = (uid, dstfolder, statusfolder)
+                    if pool is not None:
+                        lane = largepool
+                elif savebatchsize > 1:
+                    pending.append(uid)
+                    if len(pending) < savebatchsize and num + 1 < nsmall:
+                        continue
+                    target = self.copymessagesto
+                    args = (pending, dstfolder, statusfolder)
+                    pending = []
+                else:
+                    target = self.copymessageto
+                    args = (uid, dstfolder, statusfolder)
                 # Exceptions are caught in copymessageto().
-                if self.suggeststhreads():
+                if lane is not None:
                     self.waitforthread()
-                    thread = threadutil.InstanceLimitedThread(
-                        self.getinstancelimitnamespace(),
-                        target=self.copymessageto,
-                        name="Copy message from %s:%s"% (self.repository, self),
-                        args=(uid, dstfolder, statusfolder)
-                    )
-                    thread.start()
-                    threads.append(thread)
+                    lane.submit(jobs, target, *args)
                 else:
-                    self.copymessageto(uid, dstfolder, statusfolder, register=0)
-            for thread in threads:
-                thread.join() # Block until all "copy" threads are done.
+                    target(*args, register=0)
+            # The last messages of copylist may have been skipped.
+            if pending and \
+                    not offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                self.copymessagesto(pending, dstfolder, statusfolder, register=0)
+            if pool is not None:
+                # Block until all "copy" jobs are done.
+                rate = jobs.wait()
+                self.ui.debug('thread', "Copied %d jobs from %s:%s at %.1f/s, "
+                    "%d jobs queued in %s (at most %d)"% (jobs.done,
+                    self.repository, self, rate, pool.qsize(), pool.name,
+                    pool.maxqueued))
 
         # Execute new mail hook if we have new mail.
         if self.have_newmail:
@@ -962,10 +1683,7 @@ class BaseFolder(object):
         # The list of messages to delete. If sync of deletions is disabled we
         # still remove stale entries from statusfolder (neither in local nor
         # remote).
-        deletelist = [uid for uid in statusfolder.getmessageuidlist()
-                      if uid >= 0 and
-                      not self.uidexists(uid) and
-                      (self._sync_deletes or not dstfolder.uidexists(uid))]
+        deletelist, dstdeletelist = self.syncplan.deletelist(self._sync_deletes)
 
         if len(deletelist):
             # Delete in statusfolder first to play safe. In case of abort, we
@@ -975,7 +1693,7 @@ class BaseFolder(object):
             if not self.repository.account.dryrun:
                 statusfolder.deletemessages(deletelist)
             # Filter out untracked messages.
-            deletelist = [uid for uid in deletelist if dstfolder.uidexists(uid)]
+            deletelist = dstdeletelist
             if len(deletelist):
                 self.ui.deletingmessages(deletelist, [dstfolder])
                 if not self.repository.account.dryrun:
@@ -1028,50 +1746,29 @@ class BaseFolder(object):
         This function checks and protects us from action in ryrun mode.
         """
 
-        # For each flag, we store a list of uids to which it should be
+        # For each flag, we get a list of uids to which it should be
         # added.  Then, we can call addmessagesflags() to apply them in
         # bulk, rather than one call per message.
-        addflaglist = {}
-        delflaglist = {}
-        for uid in self.getmessageuidlist():
-            # Ignore messages with negative UIDs missed by pass 1 and
-            # don't do anything if the message has been deleted remotely
-            if uid < 0 or not dstfolder.uidexists(uid):
-                continue
-
-            if statusfolder.uidexists(uid):
-                statusflags = statusfolder.getmessageflags(uid)
-            else:
-                statusflags = set()
-
-            selfflags = self.combine_flags_and_keywords(uid, dstfolder)
-
-            addflags = selfflags - statusflags
-            delflags = statusflags - selfflags
-
-            for flag in addflags:
-                if not flag in addflaglist:
-                    addflaglist[flag] = []
-                addflaglist[flag].append(uid)
-
-            for flag in delflags:
-                if not flag in delflaglist:
-                    delflaglist[flag] = []
-                delflaglist[flag].append(uid)
+        addflaglist, delflaglist = self.syncplan.flagchanges()
 
+        # All the changes are handed over at once, so that dstfolder can
+        # apply them together.
+        changes = []
         for flag, uids in addflaglist.items():
             self.ui.addingflags(uids, flag, dstfolder)
             if self.repository.account.dryrun:
                 continue # Don't actually add in a dryrun.
-            dstfolder.addmessagesflags(uids, set(flag))
-            statusfolder.addmessagesflags(uids, set(flag))
+            changes.append(('+', uids, set(flag)))
 
         for flag, uids in delflaglist.items():
             self.ui.deletingflags(uids, flag, dstfolder)
             if self.repository.account.dryrun:
                 continue # Don't actually remove in a dryrun.
-            dstfolder.deletemessagesflags(uids, set(flag))
-            statusfolder.deletemessagesflags(uids, set(flag))
+            changes.append(('-', uids, set(flag)))
+
+        if changes:
+            dstfolder.changemessagesflags(changes)
+            statusfolder.changemessagesflags(changes)
 
     def syncmessagesto(self, dstfolder, statusfolder):
         """Syncs messages in this folder to the destination dstfolder.
@@ -1106,25 +1803,32 @@ class BaseFolder(object):
 
         :param dstfolder: Folderinstance to sync the msgs to.
         :param statusfolder: LocalStatus instance to sync against.
+        :returns: the number of messages copied, deleted or with flags
+            changed.
         """
 
-        for action in self.syncmessagesto_passes:
-            # Bail out on CTRL-C or SIGTERM.
-            if offlineimap.accounts.Account.abort_NOW_signal.is_set():
-                break
-            try:
-                action(dstfolder, statusfolder)
-            except (KeyboardInterrupt):
-                raise
-            except OfflineImapError as e:
-                if e.severity > OfflineImapError.ERROR.FOLDER:
+        self.syncplan = SyncPlan(self, dstfolder, statusfolder)
+        try:
+            for action in self.syncmessagesto_passes:
+                # Bail out on CTRL-C or SIGTERM.
+                if offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                    break
+                try:
+                    action(dstfolder, statusfolder)
+                except (KeyboardInterrupt):
                     raise
-                self.ui.error(e, exc_info()[2], "while syncing %s [account %s]"%
-                                                (self, self.accountname))
-            except Exception as e:
-                self.ui.error(e, exc_info()[2], "while syncing %s [account %s]"%
-                                                (self, self.accountname))
-                raise # Raise unknown Exceptions so we can fix them.
+                except OfflineImapError as e:
+                    if e.severity > OfflineImapError.ERROR.FOLDER:
+                        raise
+                    self.ui.error(e, exc_info()[2], "while syncing %s [account %s]"%
+                                                    (self, self.accountname))
+                except Exception as e:
+                    self.ui.error(e, exc_info()[2], "while syncing %s [account %s]"%
+                                                    (self, self.accountname))
+                    raise # Raise unknown Exceptions so we can fix them.
+            return self.syncplan.changes
+        finally:
+            self.syncplan = None
 
     def __eq__(self, other):
         """Comparisons work either on string comparing folder names or
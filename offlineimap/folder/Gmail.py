@@ -23,6 +23,7 @@ from sys import exc_info
 
 from offlineimap import imaputil, imaplibutil, OfflineImapError
 import offlineimap.accounts
+from .Base import BaseFolder
 from .IMAP import IMAPFolder
 
 
@@ -54,6 +55,7 @@ class GmailFolder(IMAPFolder):
         # if synclabels is enabled, add a 4th pass to sync labels
         if self.synclabels:
             self.imap_query.insert(0, 'X-GM-LABELS')
+            self.stub_query.insert(0, 'X-GM-LABELS')
             self.syncmessagesto_passes.append(self.syncmessagesto_labels)
 
         # Labels to be left alone
@@ -61,15 +63,10 @@ class GmailFolder(IMAPFolder):
         self.ignorelabels = set([l for l in re.split(r'\s*,\s*', ignorelabels) if len(l)])
 
 
-    def getmessage(self, uid):
-        """Retrieve message with UID from the IMAP server (incl body).  Also
-           gets Gmail labels and embeds them into the message.
-
-        :returns: the message body or throws and OfflineImapError
-                  (probably severity MESSAGE) if e.g. no message with
-                  this UID could be found.
-        """
-        data = self._fetch_from_imap(str(uid), self.retrycount)
+    def _messagecontent(self, uid, data):
+        """Return the message body from the FETCH data of message uid, see
+        IMAPFolder.getmessage(). Also embeds the Gmail labels into the
+        message."""
 
         # data looks now e.g.
         #[('320 (X-GM-LABELS (...) UID 17061 BODY[] {2565}','msgbody....')]
@@ -101,6 +98,16 @@ class GmailFolder(IMAPFolder):
                       (uid, dbg_output))
         return body
 
+    def fetchmessage(self, uid, openfile):
+        """Retrieve message with UID from the IMAP server, see
+        IMAPFolder.fetchmessage().
+
+        Messages are not streamed if labels have to be embedded."""
+
+        if self.synclabels:
+            return self.getmessage(uid)
+        return super(GmailFolder, self).fetchmessage(uid, openfile)
+
     def getmessagelabels(self, uid):
         if 'labels' in self.messagelist[uid]:
             return self.messagelist[uid]['labels']
@@ -134,7 +141,7 @@ class GmailFolder(IMAPFolder):
             #
             # NB: msgsToFetch are sequential numbers, not UID's
             res_type, response = imapobj.fetch("'%s'"% msgsToFetch,
-              '(FLAGS X-GM-LABELS UID)')
+              '(FLAGS X-GM-LABELS UID RFC822.SIZE)')
             if res_type != 'OK':
                 six.reraise(OfflineImapError,
                             OfflineImapError(
@@ -172,6 +179,16 @@ class GmailFolder(IMAPFolder):
                 labels = labels - self.ignorelabels
                 rtime = imaplibutil.Internaldate2epoch(messagestr)
                 self.messagelist[uid] = {'uid': uid, 'flags': flags, 'labels': labels, 'time': rtime}
+                if 'RFC822.SIZE' in options:
+                    self.messagelist[uid]['size'] = int(options['RFC822.SIZE'])
+
+    # Interface from BaseFolder
+    def cachemessagelist_incremental(self, statusfolder):
+        # Label changes are not fetched incrementally.
+        if self.synclabels:
+            return False
+        return super(GmailFolder, self).cachemessagelist_incremental(
+            statusfolder)
 
     def savemessage(self, uid, content, flags, rtime):
         """Save the message on the Server
@@ -202,14 +219,43 @@ class GmailFolder(IMAPFolder):
         self.savemessagelabels(ret, labels)
         return ret
 
+    # Interface from BaseFolder
+    def savemessagefile(self, uid, msgfile, flags, rtime):
+        # The labels are read from the whole message in savemessage().
+        if self.synclabels:
+            return BaseFolder.savemessagefile(self, uid, msgfile, flags, rtime)
+        return super(GmailFolder, self).savemessagefile(uid, msgfile, flags,
+            rtime)
+
+    # Interface from BaseFolder
+    def savemessages(self, messages):
+        # Labels are stored message by message in savemessage().
+        if self.synclabels:
+            return None
+        return super(GmailFolder, self).savemessages(messages)
+
+    def __labelstring(self, imapobj, label):
+        """Return label as IMAP string for a STORE command.
+
+        Labels with line breaks or 8-bit characters can't be quoted. They
+        are sent as non-synchronizing literals if the server allows it."""
+
+        if [c for c in label if c in '\r\n' or ord(c) > 127]:
+            literal = imapobj.nonsync_literal(label)
+            if literal is not None:
+                return literal
+        return imaputil.quote(label)
+
     def _messagelabels_aux(self, arg, uidlist, labels):
         """Common code to savemessagelabels and addmessagelabels"""
         labels = labels - self.ignorelabels
         uidlist = [uid for uid in uidlist if uid > 0]
         if len(uidlist) > 0:
-            imapobj = self.imapserver.acquireconnection()
+            imapobj = self.imapserver.acquireconnection(
+                self.getfullIMAPname())
             try:
-                labels_str = '(' + ' '.join([imaputil.quote(lb) for lb in labels]) + ')'
+                labels_str = '(' + ' '.join([self.__labelstring(imapobj, lb)
+                    for lb in labels]) + ')'
                 # Coalesce uid's into ranges
                 uid_str = imaputil.uid_sequence(uidlist)
                 result = self._store_to_imap(imapobj, uid_str, arg, labels_str)
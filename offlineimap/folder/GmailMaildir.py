@@ -41,6 +41,8 @@ class GmailMaildirFolder(MaildirFolder):
         # If synclabels is enabled, add a 4th pass to sync labels.
         if self.synclabels:
             self.syncmessagesto_passes.append(self.syncmessagesto_labels)
+            # The label changes are detected from the mtimes.
+            self._freshstats = True
 
     def quickchanged(self, statusfolder):
         """Returns True if the Maildir has changed.
@@ -70,7 +72,7 @@ class GmailMaildirFolder(MaildirFolder):
     # Interface from BaseFolder
     def msglist_item_initializer(self, uid):
         return {'flags': set(), 'labels': set(), 'labels_cached': False,
-                'filename': '/no-dir/no-such-file/', 'mtime': 0}
+                'filename': '/no-dir/no-such-file/', 'size': None, 'mtime': 0}
 
 
     def cachemessagelist(self, min_date=None, min_uid=None):
@@ -78,11 +80,9 @@ class GmailMaildirFolder(MaildirFolder):
             self.messagelist = self._scanfolder(min_date=min_date,
                                                 min_uid=min_uid)
 
-        # Get mtimes
-        if self.synclabels:
-            for uid, msg in list(self.messagelist.items()):
-                filepath = os.path.join(self.getfullname(), msg['filename'])
-                msg['mtime'] = int(os.stat(filepath).st_mtime)
+            # The mtimes of the scan are compared as integers.
+            for msg in self.messagelist.values():
+                msg['mtime'] = int(msg['mtime'] or 0)
 
 
     def getmessagelabels(self, uid):
@@ -98,10 +98,11 @@ class GmailMaildirFolder(MaildirFolder):
             content = file.read()
             file.close()
 
-            self.messagelist[uid]['labels'] = set()
+            labels = set()
             for hstr in self.getmessageheaderlist(content, self.labelsheader):
-                self.messagelist[uid]['labels'].update(
+                labels.update(
                     imaputil.labels_from_header(self.labelsheader, hstr))
+            self.messagelist[uid]['labels'] = labels
             self.messagelist[uid]['labels_cached'] = True
 
         return self.messagelist[uid]['labels']
@@ -138,6 +139,27 @@ class GmailMaildirFolder(MaildirFolder):
         self.messagelist[uid]['labels'] = labels
         return ret
 
+    def savemessages(self, messages):
+        """Writes a batch of new messages, see MaildirFolder.
+
+        The labels of the messages are read by savemessage() when syncing
+        labels, so they are saved one by one then."""
+
+        if self.synclabels:
+            return None
+        return super(GmailMaildirFolder, self).savemessages(messages)
+
+    def savemessagefrom(self, uid, fetchmessage, flags, rtime):
+        """Writes a new message, see folder/Base for detail.
+
+        The labels are read from the message content, hence messages are
+        not saved from files when syncing labels."""
+
+        if not self.synclabels:
+            return super(GmailMaildirFolder, self).savemessagefrom(uid,
+                fetchmessage, flags, rtime)
+        return self.savemessage(uid, fetchmessage(lambda: None), flags, rtime)
+
     def savemessagelabels(self, uid, labels, ignorelabels=set()):
         """Change a message's labels to `labels`.
 
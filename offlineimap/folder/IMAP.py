@@ -15,11 +15,13 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
+import io
 import random
 import binascii
 import re
 import time
 from sys import exc_info
+from threading import Lock
 import six
 
 from .Base import BaseFolder
@@ -63,6 +65,8 @@ class IMAPFolder(BaseFolder):
         self.randomgenerator = random.Random()
         # self.ui is set in BaseFolder.
         self.imap_query = ['BODY.PEEK[]']
+        # Data items fetched for a stub, see getmessagestub().
+        self.stub_query = ['BODY.PEEK[HEADER]', 'RFC822.SIZE']
 
         # number of times to retry fetching messages
         self.retrycount = self.repository.getconfint('retrycount', 2)
@@ -70,11 +74,25 @@ class IMAPFolder(BaseFolder):
         fh_conf = self.repository.account.getconf('filterheaders', '')
         self.filterheaders = [h for h in re.split(r'\s*,\s*', fh_conf) if h]
 
+        # Messages older than stubage days or of at least stubsize bytes are
+        # copied as stubs to the folders storing them, see wantsstub().
+        self.stubage = self.repository.account.getconfint('stubage', 0)
+        self.stubsize = self.repository.account.getconfint('stubsize', 0)
+        # The sizes are used to schedule the copies, see getlargemessages().
+        self.fetch_items = '(FLAGS UID INTERNALDATE RFC822.SIZE)'
+
         # self.copy_ignoreUIDs is used by BaseFolder.
         self.copy_ignoreUIDs = repository.get_copy_ignore_UIDs(
             self.getvisiblename())
         if self.repository.getidlefolders():
             self.idle_mode = True
+        # HIGHESTMODSEQ seen when the message list was cached, if any.
+        self._highestmodseq = None
+        # Folder state reported by the server before the sync, if any.
+        self._fingerprint = None
+        # FETCH data of messages fetched in batches, by UID.
+        self._prefetched = {}
+        self._prefetchlock = Lock()
 
     def __selectro(self, imapobj, force=False):
         """Select this folder when we do not need write access.
@@ -136,7 +154,8 @@ class IMAPFolder(BaseFolder):
         if hasattr(self, '_uidvalidity'):
             # Use cached value if existing.
             return self._uidvalidity
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         try:
             # SELECT (if not already done) and get current UIDVALIDITY.
             self.__selectro(imapobj)
@@ -148,8 +167,19 @@ class IMAPFolder(BaseFolder):
         finally:
             self.imapserver.releaseconnection(imapobj)
 
+    def setfingerprint(self, fingerprint):
+        """Set the UIDVALIDITY, UIDNEXT, MESSAGES and HIGHESTMODSEQ of the
+        folder, see IMAPRepository.cachefolderfingerprints()."""
+
+        self._fingerprint = fingerprint
+
     # Interface from BaseFolder
     def quickchanged(self, statusfolder):
+        # The folder is unchanged if its state is the one saved at the last
+        # sync. This also notices a deletion followed by an arrival.
+        if self._fingerprint is not None:
+            return self._fingerprint != statusfolder.get_fingerprint()
+
         # An IMAP folder has definitely changed if the number of
         # messages or the UID of the last message have changed.  Otherwise
         # only flag changes could have occurred.
@@ -264,15 +294,64 @@ class IMAPFolder(BaseFolder):
         return {'uid': uid, 'flags': set(), 'time': 0}
 
 
+    def __gethighestmodseq(self, imapobj):
+        """Return the HIGHESTMODSEQ of the currently selected folder.
+
+        :returns: the mod-sequence as number or None if the server does not
+            support CONDSTORE or the mailbox has no persistent
+            mod-sequences (NOMODSEQ)."""
+
+        if not self.repository.getcondstore():
+            return None
+        if 'CONDSTORE' not in imapobj.capabilities and \
+                'QRESYNC' not in imapobj.capabilities:
+            return None
+        typ, modseq = imapobj.response('HIGHESTMODSEQ')
+        if modseq == [None] or modseq is None:
+            return None
+        return int(modseq[-1])
+
+    def __cachemessages(self, response):
+        """Add the messages of a FETCH (FLAGS UID INTERNALDATE RFC822.SIZE)
+        response to the message list."""
+
+        for messagestr in response:
+            # Looks like: '1 (FLAGS (\\Seen Old) UID 4807)' or None if no msg.
+            # Discard initial message number.
+            if messagestr is None:
+                continue
+            messagestr = messagestr.split(' ', 1)[1]
+            options = imaputil.flags2hash(messagestr)
+            if 'UID' not in options:
+                self.ui.warn('No UID in message with options %s'%
+                    str(options), minor=1)
+            else:
+                uid = int(options['UID'])
+                self.messagelist[uid] = self.msglist_item_initializer(uid)
+                flags = imaputil.flagsimap2maildir(options['FLAGS'])
+                keywords = imaputil.flagsimap2keywords(options['FLAGS'])
+                rtime = imaplibutil.Internaldate2epoch(messagestr)
+                self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime,
+                    'keywords': keywords}
+                if 'RFC822.SIZE' in options:
+                    self.messagelist[uid]['size'] = int(options['RFC822.SIZE'])
+
     # Interface from BaseFolder
     def cachemessagelist(self, min_date=None, min_uid=None):
         self.ui.loadmessagelist(self.repository, self)
         self.dropmessagelistcache()
+        self._highestmodseq = None
 
         imapobj = self.imapserver.acquireconnection()
         try:
             msgsToFetch = self._msgs_to_fetch(
                 imapobj, min_date=min_date, min_uid=min_uid)
+            # Only a complete message list can be the base of the next
+            # incremental update or quick check.
+            if min_date is None and min_uid is None:
+                self._highestmodseq = self.__gethighestmodseq(imapobj)
+            else:
+                self._fingerprint = None
             if not msgsToFetch:
                 return # No messages to sync.
 
@@ -280,9 +359,8 @@ class IMAPFolder(BaseFolder):
             # imaplib2 from quoting the sequence.
             fetch_msg = "'%s'"% msgsToFetch
             self.ui.debug('imap', "calling imaplib2 fetch command: %s %s"%
-                (fetch_msg, '(FLAGS UID INTERNALDATE)'))
-            res_type, response = imapobj.fetch(
-                fetch_msg, '(FLAGS UID INTERNALDATE)')
+                (fetch_msg, self.fetch_items))
+            res_type, response = imapobj.fetch(fetch_msg, self.fetch_items)
             if res_type != 'OK':
                 raise OfflineImapError("FETCHING UIDs in folder [%s]%s failed. "
                     "Server responded '[%s] %s'"% (self.getrepository(), self,
@@ -290,25 +368,271 @@ class IMAPFolder(BaseFolder):
         finally:
             self.imapserver.releaseconnection(imapobj)
 
-        for messagestr in response:
-            # Looks like: '1 (FLAGS (\\Seen Old) UID 4807)' or None if no msg.
-            # Discard initial message number.
-            if messagestr is None:
-                continue
-            messagestr = messagestr.split(' ', 1)[1]
-            options = imaputil.flags2hash(messagestr)
-            if 'UID' not in options:
-                self.ui.warn('No UID in message with options %s'%
-                    str(options), minor=1)
-            else:
-                uid = int(options['UID'])
+        self.__cachemessages(response)
+        self.ui.messagelistloaded(self.repository, self, self.getmessagecount())
+
+    # Interface from BaseFolder
+    def cachemessagelist_incremental(self, statusfolder):
+        """Cache the message list from the status folder updated with the
+        changes on the server since the last sync (RFC 7162).
+
+        Only the messages whose flags changed since the HIGHESTMODSEQ
+        saved in the status folder are fetched. Expunged messages are found
+        with a UID SEARCH: QRESYNC is not enabled, since it would have the
+        expunges reported as VANISHED for every command of the connection.
+
+        The unchanged messages are seeded from the status folder, which
+        knows neither their internal date nor their keywords. This is not
+        done if they matter, with maxage, startdate or keywords mapped by
+        the local repository.
+
+        :returns: False if an incremental update is not possible. The
+            message list is then left empty and cachemessagelist() must be
+            used instead."""
+
+        if not self.repository.getcondstore() or \
+                self.getmaxsize() is not None or \
+                self.config.getdefault("Account %s"% self.accountname,
+                    "maxage", None) is not None or \
+                self.getstartdate() is not None:
+            return False
+        localrepos = self.repository.account.localrepos
+        if localrepos is not None:
+            if localrepos.getconf('startdate', None):
+                return False
+            try:
+                if localrepos.getkeywordmap() is not None:
+                    return False
+            except NotImplementedError:
+                pass
+        modseq = statusfolder.get_highestmodseq()
+        if modseq is None or statusfolder.getmessagecount() == 0:
+            return False
+
+        self.ui.loadmessagelist(self.repository, self)
+        self.dropmessagelistcache()
+        self._highestmodseq = None
+
+        imapobj = self.imapserver.acquireconnection()
+        try:
+            res_type, imapdata = imapobj.select(self.getfullIMAPname(),
+                True, True)
+            highestmodseq = self.__gethighestmodseq(imapobj)
+            if imapdata == [None] or highestmodseq is None or \
+                    highestmodseq < modseq:
+                return False
+            exists = max([int(msgid) for msgid in imapdata])
+
+            modifiers = "(CHANGEDSINCE %d)"% modseq
+            self.ui.debug('imap', "calling imaplib2 uid fetch command: "
+                "1:* %s %s"% (self.fetch_items, modifiers))
+            res_type, response = imapobj.uid('fetch', "'1:*'",
+                self.fetch_items, modifiers)
+            if res_type != 'OK':
+                raise OfflineImapError("FETCHING changes in folder [%s]%s "
+                    "failed. Server responded '[%s] %s'"% (self.getrepository(),
+                    self, res_type, response), OfflineImapError.ERROR.FOLDER)
+
+            res_type, search = imapobj.uid('search', 'ALL')
+            if res_type != 'OK':
+                raise OfflineImapError("UID SEARCH in folder [%s]%s "
+                    "failed. Server responded '[%s] %s'"% (
+                    self.getrepository(), self, res_type, search),
+                    OfflineImapError.ERROR.FOLDER)
+            uids = set()
+            for data in search:
+                if data:
+                    uids.update([int(uid) for uid in data.split()])
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+
+        # Unchanged messages are in the state we left them in after the
+        # last sync.
+        for uid in uids:
+            if statusfolder.uidexists(uid):
                 self.messagelist[uid] = self.msglist_item_initializer(uid)
-                flags = imaputil.flagsimap2maildir(options['FLAGS'])
-                keywords = imaputil.flagsimap2keywords(options['FLAGS'])
-                rtime = imaplibutil.Internaldate2epoch(messagestr)
-                self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime,
-                    'keywords': keywords}
+                self.messagelist[uid]['flags'] = \
+                    set(statusfolder.getmessageflags(uid))
+                self.messagelist[uid]['keywords'] = set()
+        self.__cachemessages(response)
+
+        # Messages we failed to sync last time are neither in the status
+        # folder nor changed: the server count will disagree with ours.
+        if len(self.messagelist) != exists:
+            self.ui.debug('imap', "incremental message list of %s has %d "
+                "messages, server reports %d; fetching the full list"%
+                (self, len(self.messagelist), exists))
+            self.dropmessagelistcache()
+            return False
+
+        self._highestmodseq = highestmodseq
         self.ui.messagelistloaded(self.repository, self, self.getmessagecount())
+        return True
+
+    # Interface from BaseFolder
+    def record_folderstate(self, statusfolder, changed=False):
+        """Save the HIGHESTMODSEQ of the cached message list and the
+        fingerprint of the folder to statusfolder.
+
+        This is only done if statusfolder is in sync with our message list,
+        so that the next incremental update or quick check does not miss
+        anything. The fingerprint was taken before the sync, so it is only
+        saved if the sync did not change the folder. A fresh STATUS could
+        include messages which arrived after the message list was loaded."""
+
+        if self.repository.account.dryrun:
+            return
+        if self._highestmodseq is None and self._fingerprint is None:
+            return
+        for uid in self.getmessageuidlist():
+            if not statusfolder.uidexists(uid):
+                return
+            flags = self.getmessageflags(uid)
+            statusflags = statusfolder.getmessageflags(uid)
+            # Letters of mapped keywords (a-z) only exist in the status.
+            if not flags <= statusflags or \
+                    [f for f in statusflags - flags if not f.islower()]:
+                return
+        if self._highestmodseq is not None:
+            statusfolder.save_highestmodseq(self._highestmodseq)
+        if self._fingerprint is not None and not changed:
+            statusfolder.save_fingerprint(self._fingerprint)
+
+    # Interface from BaseFolder
+    def dropmessagelistcache(self):
+        super(IMAPFolder, self).dropmessagelistcache()
+        with self._prefetchlock:
+            self._prefetched = {}
+
+    # Interface from BaseFolder
+    def getmessagebatches(self, uidlist):
+        """Split uidlist in batches of at most fetchbatchsize messages and
+        fetchbatchbytes bytes, according to the RFC822.SIZE of the messages.
+
+        A message larger than fetchbatchbytes is alone in its batch."""
+
+        batchsize = self.repository.getfetchbatchsize()
+        if batchsize < 2:
+            # Fetch the messages one by one, pipelined.
+            batchsize = self.imapserver.pipelinedepth
+        if batchsize < 2 or len(uidlist) < 2:
+            return [uidlist]
+        maxbytes = self.repository.getfetchbatchbytes()
+
+        sizes = self.__getmessagesizes(uidlist)
+
+        batches = []
+        batch, batchbytes = [], 0
+        for uid in uidlist:
+            size = sizes.get(uid, 0)
+            if batch and (len(batch) >= batchsize or
+                          batchbytes + size > maxbytes):
+                batches.append(batch)
+                batch, batchbytes = [], 0
+            batch.append(uid)
+            batchbytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __getmessagesizes(self, uidlist):
+        """Return a dict of the RFC822.SIZE of the messages of uidlist, from
+        the message list or else from the server."""
+
+        sizes = {}
+        missing = []
+        for uid in uidlist:
+            if uid in self.messagelist and \
+                    self.messagelist[uid].get('size') is not None:
+                sizes[uid] = self.messagelist[uid]['size']
+            elif uid > 0:
+                missing.append(uid)
+        if not missing:
+            return sizes
+
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname(), readonly=True)
+        try:
+            imapobj.select(self.getfullIMAPname(), readonly=True)
+            res_type, response = imapobj.uid('fetch',
+                imaputil.uid_sequence(missing), '(RFC822.SIZE)')
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        if res_type == 'OK':
+            for messagestr in response:
+                if not isinstance(messagestr, str):
+                    continue
+                options = imaputil.flags2hash(messagestr.split(' ', 1)[1])
+                if 'UID' in options and 'RFC822.SIZE' in options:
+                    uid = int(options['UID'])
+                    if uid in sizes:
+                        continue
+                    sizes[uid] = int(options['RFC822.SIZE'])
+                    # Keep it for the next callers.
+                    if uid in self.messagelist:
+                        self.messagelist[uid]['size'] = sizes[uid]
+        return sizes
+
+    # Interface from BaseFolder
+    def getlargemessages(self, uidlist):
+        """Return the set of the UIDs of uidlist of at least largemessagesize
+        bytes."""
+
+        largesize = self.repository.getlargemessagesize()
+        if largesize < 1 or not uidlist:
+            return set()
+        sizes = self.__getmessagesizes(uidlist)
+        return set(uid for uid in uidlist if sizes.get(uid, 0) >= largesize)
+
+    # Interface from BaseFolder
+    def prefetchmessages(self, uidlist):
+        """Fetch the messages of uidlist with a single UID FETCH, or with
+        one UID FETCH per message sent back-to-back if only pipelinedepth
+        is configured.
+
+        getmessage() will then hand them out without asking the server
+        again. Messages which are missing from the response are fetched
+        one by one later."""
+
+        uidlist = [uid for uid in uidlist if uid > 0]
+        if len(uidlist) < 2:
+            return
+        try:
+            if self.repository.getfetchbatchsize() > 1:
+                res_type, data = self.__uidfetch(
+                    imaputil.uid_sequence(uidlist), self.retrycount)
+                responses = [(res_type, data)]
+            elif self.imapserver.pipelinedepth > 1:
+                responses = self.__uidfetch_pipelined(uidlist)
+            else:
+                return
+        except OfflineImapError as e:
+            if e.severity > OfflineImapError.ERROR.MESSAGE:
+                raise
+            self.ui.debug('imap', "batch fetch of %d messages failed: %s"%
+                (len(uidlist), e))
+            return
+        with self._prefetchlock:
+            for res_type, data in responses:
+                if res_type != 'OK':
+                    continue
+                for res in data:
+                    # The BODY response appears as a tuple, see
+                    # _fetch_from_imap().
+                    if isinstance(res, str) or res is None:
+                        continue
+                    m = re.search(r'UID (\d+)', res[0])
+                    if m:
+                        self._prefetched[int(m.group(1))] = res
+
+    def _fetch_message(self, uid):
+        """Return the FETCH data of message uid as _fetch_from_imap() does,
+        handing out the prefetched data if available."""
+
+        with self._prefetchlock:
+            if uid in self._prefetched:
+                return [self._prefetched.pop(uid)]
+        return self._fetch_from_imap(str(uid), self.retrycount)
 
     # Interface from BaseFolder
     def getmessage(self, uid):
@@ -321,7 +645,75 @@ class IMAPFolder(BaseFolder):
                   this UID could be found.
         """
 
-        data = self._fetch_from_imap(str(uid), self.retrycount)
+        return self._messagecontent(uid, self._fetch_message(uid))
+
+    # Interface from BaseFolder
+    def fetchmessage(self, uid, openfile):
+        """Retrieve message with UID from the IMAP server like getmessage().
+
+        If the message is at least streamthreshold bytes, the body is
+        written to the file returned by openfile() while it is received,
+        and None is returned."""
+
+        threshold = self.repository.getstreamthreshold()
+        with self._prefetchlock:
+            prefetched = uid in self._prefetched
+        if threshold < 1 or prefetched:
+            return self.getmessage(uid)
+
+        writers = []
+        def sink(typ, dat, size):
+            if size < threshold:
+                return None
+            if writers:
+                # The message is sent again after a reconnect.
+                writers[0].restart()
+            else:
+                msgfile = openfile()
+                if msgfile is None:
+                    return None
+                writers.append(imaplibutil.LiteralWriter(msgfile))
+            return writers[0]
+
+        data = self._fetch_from_imap(str(uid), self.retrycount, sink)
+        if data[0][1] in writers:
+            writers[0].flush()
+            self.ui.debug('imap', "Streamed message %d to file"% uid)
+            return None
+        return self._messagecontent(uid, data)
+
+    # Interface from BaseFolder
+    def wantsstub(self, uid):
+        """Returns True if the message is older than stubage days or has at
+        least stubsize bytes."""
+
+        if uid not in self.messagelist:
+            return False
+        message = self.messagelist[uid]
+        if self.stubage > 0 and message.get('time') and \
+                message['time'] < time.time() - 60*60*24*self.stubage:
+            return True
+        return self.stubsize > 0 and \
+            message.get('size', 0) >= self.stubsize
+
+    # Interface from BaseFolder
+    def getmessagestub(self, uid):
+        """Retrieve the headers of message UID from the IMAP server and
+        return them as a stub, see emailutil.make_stub()."""
+
+        data = self._fetch_from_imap(str(uid), self.retrycount,
+            items=self.stub_query)
+        size = None
+        if uid in self.messagelist:
+            size = self.messagelist[uid].get('size')
+        if size is None:
+            m = re.search(r'RFC822\.SIZE (\d+)', data[0][0])
+            if m:
+                size = int(m.group(1))
+        return emailutil.make_stub(self._messagecontent(uid, data), size)
+
+    def _messagecontent(self, uid, data):
+        """Return the message body from the FETCH data of message uid."""
 
         # Data looks now e.g.
         # [('320 (UID 17061 BODY[] {2565}','msgbody....')]
@@ -605,6 +997,59 @@ class IMAPFolder(BaseFolder):
             self.savemessageflags(uid, flags)
             return uid
 
+        return self.__savemessage(uid, content, flags, rtime)
+
+    # Interface from BaseFolder
+    def savemessagefile(self, uid, msgfile, flags, rtime):
+        """Save the message read from msgfile on the Server like
+        savemessage().
+
+        Only the headers are loaded, the body is sent from the file to the
+        server while it is read, see imaplibutil.LiteralReader. This needs
+        the bundled imaplib2, the whole message is loaded otherwise."""
+
+        if not imaplibutil.literalsasbytes():
+            return super(IMAPFolder, self).savemessagefile(uid, msgfile,
+                flags, rtime)
+
+        self.ui.savemessage('imap', uid, flags, self)
+
+        # Already have it, just save modified flags.
+        if uid > 0 and self.uidexists(uid):
+            self.savemessageflags(uid, flags)
+            return uid
+
+        content, hasbody = self.__readheaders(msgfile)
+        if not hasbody:
+            # The file was read entirely.
+            return self.__savemessage(uid, content, flags, rtime)
+        return self.__savemessage(uid, content, flags, rtime, msgfile)
+
+    def __readheaders(self, msgfile):
+        """Read the headers of the message from msgfile, opened in binary
+        mode, up to the blank line ending them.
+
+        :returns: (headers, hasbody), the headers being decoded, see
+            emailutil.decode_message(), and hasbody telling whether the
+            body follows in msgfile."""
+
+        headers = []
+        while True:
+            line = msgfile.readline()
+            headers.append(line)
+            if not line or line in (b'\n', b'\r\n'):
+                break
+        return emailutil.decode_message(b''.join(headers)), bool(line)
+
+    def __savemessage(self, uid, content, flags, rtime, msgfile=None):
+        """Append the message to the folder, see savemessage().
+
+        If msgfile is given, content holds the headers only and the body is
+        sent from the current position of msgfile on."""
+
+        if msgfile is not None:
+            offset = msgfile.tell()
+
         content = self.deletemessageheaders(content, self.filterheaders)
 
         # Use proper CRLF all over the message.
@@ -619,7 +1064,8 @@ class IMAPFolder(BaseFolder):
             msg_id = '[unknown message-id]'
 
         retry_left = 2 # succeeded in APPENDING?
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         # NB: in the finally clause for this try we will release
         # NB: the acquired imapobj, so don't do that twice unless
         # NB: you will put another connection to imapobj.  If you
@@ -655,10 +1101,20 @@ class IMAPFolder(BaseFolder):
                     self.ui.msgtoreadonly(self, uid, content, flags)
                     return uid
 
+                if msgfile is not None:
+                    message = imaplibutil.LiteralReader(content, msgfile,
+                        offset)
+                elif imaplibutil.literalsasbytes():
+                    # The original bytes of the message, announced with
+                    # their size in octets.
+                    message = imaplibutil.encodeliteral(content)
+                else:
+                    message = content
+
                 # Do the APPEND.
                 try:
                     (typ, dat) = imapobj.append(self.getfullIMAPname(),
-                        imaputil.flagsmaildir2imap(flags), date, content)
+                        imaputil.flagsmaildir2imap(flags), date, message)
                     # This should only catch 'NO' responses since append()
                     # will raise an exception for 'BAD' responses:
                     if typ != 'OK':
@@ -678,7 +1134,8 @@ class IMAPFolder(BaseFolder):
                     # Connection has been reset, release connection and retry.
                     retry_left -= 1
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(
+                        self.getfullIMAPname())
                     if not retry_left:
                         six.reraise(OfflineImapError,
                                     OfflineImapError("Saving msg (%s) in folder '%s', "
@@ -766,23 +1223,165 @@ class IMAPFolder(BaseFolder):
         return uid
 
 
-    def _fetch_from_imap(self, uids, retry_num=1):
+    # Interface from BaseFolder
+    def getsavebatchsize(self):
+        return self.repository.getappendbatchsize()
+
+    # Interface from BaseFolder
+    def getsavebatchbytes(self):
+        return self.repository.getappendbatchbytes()
+
+    # Interface from BaseFolder
+    def savemessages(self, messages):
+        """Save a batch of messages on the server with a single APPEND
+
+        Uses the MULTIAPPEND extension (RFC 3502) and reads the new UIDs
+        from the APPENDUID response (UIDPLUS, RFC 4315). The server appends
+        all the messages or none, so that savemessage() can be used for
+        each message on failure.
+
+        This function will update the self.messagelist dict to contain
+        the new messages after sucessfully saving them.
+
+        :returns: the list of UIDs of the new messages as assigned by the
+                  server, 0 for all of them if the UIDs could not be found,
+                  or None if nothing was saved."""
+
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
+        # NB: see savemessage() about releasing imapobj.
+        try:
+            if not imaplibutil.literalsasbytes() or \
+                    'MULTIAPPEND' not in imapobj.capabilities or \
+                    'UIDPLUS' not in imapobj.capabilities:
+                return None
+
+            batch = []
+            for uid, content, flags, rtime in messages:
+                if uid > 0 and self.uidexists(uid):
+                    return None
+                self.ui.savemessage('imap', uid, flags, self)
+                msgfile = None
+                if isinstance(content, bytes):
+                    # Read from a file: only the headers are decoded, the
+                    # body is sent as is, see savemessagefile().
+                    msgfile = io.BytesIO(content)
+                    content, hasbody = self.__readheaders(msgfile)
+                    if not hasbody:
+                        msgfile = None
+                content = self.deletemessageheaders(content, self.filterheaders)
+                # Use proper CRLF all over the message.
+                content = re.sub("(?<!\r)\n", CRLF, content)
+                date = self.__getmessageinternaldate(content, rtime)
+                if msgfile is not None:
+                    content = imaplibutil.LiteralReader(content, msgfile,
+                        msgfile.tell())
+                batch.append((imaputil.flagsmaildir2imap(flags), date,
+                    content))
+
+            try:
+                # Select folder for append and make the box READ-WRITE.
+                imapobj.select(self.getfullIMAPname())
+            except imapobj.readonly:
+                return None
+
+            try:
+                (typ, dat) = imapobj.multiappend(self.getfullIMAPname(), batch)
+            except imapobj.abort as e:
+                # Connection has been reset, let savemessage() retry.
+                self.imapserver.releaseconnection(imapobj, True)
+                imapobj = None
+                self.ui.error(e, exc_info()[2])
+                return None
+            except imapobj.error as e:
+                self.ui.debug('imap', "savemessages: MULTIAPPEND of %d messages "
+                    "failed: %s"% (len(batch), e))
+                return None
+            if typ != 'OK':
+                self.ui.debug('imap', "savemessages: MULTIAPPEND of %d messages "
+                    "failed. Server responded: %s %s"% (len(batch), typ, dat))
+                return None
+
+            # Get the new UIDs from the APPENDUID response, it could look
+            # like OK [APPENDUID 38505 3955:3960] with 38505 being the folder
+            # UIDvalidity.
+            resp = imapobj._get_untagged_response('APPENDUID')
+            uids = []
+            if resp != [None] and resp is not None:
+                try:
+                    uids = imaputil.uid_sequence_expand(resp[-1].split(' ')[1])
+                except (ValueError, IndexError):
+                    pass
+            if len(uids) != len(batch):
+                self.ui.warn("savemessages: Server supports UIDPLUS, but we "
+                    "got no usable UIDs back. APPENDUID reponse was '%s'"%
+                    str(resp))
+                return [0] * len(batch)
+        finally:
+            if imapobj:
+                self.imapserver.releaseconnection(imapobj)
+
+        for (olduid, content, flags, rtime), uid in zip(messages, uids):
+            self.messagelist[uid] = self.msglist_item_initializer(uid)
+            self.messagelist[uid]['flags'] = flags
+            self.ui.debug('imap', 'savemessages: new UID %d'% uid)
+        return uids
+
+    def _fetch_from_imap(self, uids, retry_num=1, sink=None, items=None):
         """Fetches data from IMAP server.
 
         Arguments:
         - uids: message UIDS
         - retry_num: number of retries to make
+        - sink: literal_sink of the connection during the query
+        - items: data items to fetch instead of the imap_query
 
         Returns: data obtained by this query."""
 
-        imapobj = self.imapserver.acquireconnection()
+        res_type, data = self.__uidfetch(uids, retry_num, sink, items)
+
+        # Ensure to not consider unsolicited FETCH responses caused by flag
+        # changes from concurrent connections.  These appear as strings in
+        # 'data' (the BODY response appears as a tuple).  This should leave
+        # exactly one response.
+        if res_type == 'OK':
+            data = [res for res in data if not isinstance(res, str)]
+
+        # Could not fetch message.  Note: it is allowed by rfc3501 to return any
+        # data for the UID FETCH command.
+        if data == [None] or res_type != 'OK' or len(data) != 1:
+            severity = OfflineImapError.ERROR.MESSAGE
+            reason = "IMAP server '%s' failed to fetch messages UID '%s'."\
+                " Server responded: %s %s"% (self.getrepository(), uids,
+                                             res_type, data)
+            if data == [None] or len(data) < 1:
+                # IMAP server did not find a message with this UID.
+                reason = "IMAP server '%s' does not have a message "\
+                    "with UID '%s'"% (self.getrepository(), uids)
+            raise OfflineImapError(reason, severity)
+
+        return data
+
+    def __uidfetch(self, uids, retry_num, sink=None, items=None):
+        """Run UID FETCH of the imap_query, or of the given items, for
+        uids, retrying on dropped connections. Literals are passed to
+        sink, if given, see IMAP4.literal_sink.
+
+        Returns: the (res_type, data) of the query."""
+
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname(), readonly=True)
         try:
-            query = "(%s)"% (" ".join(self.imap_query))
+            query = "(%s)"% (" ".join(items or self.imap_query))
             fails_left = retry_num  # Retry on dropped connection.
             while fails_left:
                 try:
                     imapobj.select(self.getfullIMAPname(), readonly=True)
-                    res_type, data = imapobj.uid('fetch', uids, query)
+                    imapobj.literal_sink = sink
+                    try:
+                        res_type, data = imapobj.uid('fetch', uids, query)
+                    finally:
+                        imapobj.literal_sink = None
                     break
                 except imapobj.abort as e:
                     fails_left -= 1
@@ -791,7 +1390,6 @@ class IMAPFolder(BaseFolder):
                         message = ("%s, while fetching msg %r in folder %r."
                             " Max retry reached (%d)"%
                             (e, uids, self.name, retry_num))
-                        severity = OfflineImapError.ERROR.MESSAGE
                         raise OfflineImapError(message,
                             OfflineImapError.ERROR.MESSAGE)
                     self.ui.error("%s. While fetching msg %r in folder %r."
@@ -802,35 +1400,38 @@ class IMAPFolder(BaseFolder):
                         )
                     # Release dropped connection, and get a new one.
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(
+                        self.getfullIMAPname(), readonly=True)
         finally:
              # The imapobj here might be different than the one created before
              # the ``try`` clause. So please avoid transforming this to a nice
              # ``with`` without taking this into account.
             self.imapserver.releaseconnection(imapobj)
 
-        # Ensure to not consider unsolicited FETCH responses caused by flag
-        # changes from concurrent connections.  These appear as strings in
-        # 'data' (the BODY response appears as a tuple).  This should leave
-        # exactly one response.
-        if res_type == 'OK':
-            data = [res for res in data if not isinstance(res, str)]
+        return res_type, data
 
-        # Could not fetch message.  Note: it is allowed by rfc3501 to return any
-        # data for the UID FETCH command.
-        if data == [None] or res_type != 'OK' or len(data) != 1:
-            severity = OfflineImapError.ERROR.MESSAGE
-            reason = "IMAP server '%s' failed to fetch messages UID '%s'."\
-                " Server responded: %s %s"% (self.getrepository(), uids,
-                                             res_type, data)
-            if data == [None] or len(data) < 1:
-                # IMAP server did not find a message with this UID.
-                reason = "IMAP server '%s' does not have a message "\
-                    "with UID '%s'"% (self.getrepository(), uids)
-            raise OfflineImapError(reason, severity)
 
-        return data
+    def __uidfetch_pipelined(self, uids):
+        """Run one UID FETCH of the imap_query per message of uids,
+        back-to-back on one connection.
 
+        Returns: the list of the (res_type, data) of the queries."""
+
+        query = "(%s)"% (" ".join(self.imap_query))
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname(), readonly=True)
+        try:
+            imapobj.select(self.getfullIMAPname(), readonly=True)
+            return self.imapserver.pipeline(imapobj,
+                [('uid', ('fetch', str(uid), query)) for uid in uids])
+        except imapobj.abort as e:
+            # The messages will be fetched one by one with retries.
+            self.imapserver.releaseconnection(imapobj, True)
+            imapobj = None
+            raise OfflineImapError("%s, while fetching msgs %r in folder %r"%
+                (e, uids, self.name), OfflineImapError.ERROR.MESSAGE)
+        finally:
+            self.imapserver.releaseconnection(imapobj)
 
     def _store_to_imap(self, imapobj, uid, field, data):
         """Stores data to IMAP server
@@ -859,7 +1460,8 @@ class IMAPFolder(BaseFolder):
         so you need to ensure that it is never called in a
         dryrun mode."""
 
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         try:
             result = self._store_to_imap(imapobj, str(uid), 'FLAGS',
                 imaputil.flagsmaildir2imap(flags))
@@ -899,7 +1501,8 @@ class IMAPFolder(BaseFolder):
         self.__processmessagesflags('-', uidlist, flags)
 
     def __processmessagesflags_real(self, operation, uidlist, flags):
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         try:
             try:
                 imapobj.select(self.getfullIMAPname())
@@ -909,13 +1512,19 @@ class IMAPFolder(BaseFolder):
             response = imapobj.uid('store',
                 imaputil.uid_sequence(uidlist), operation + 'FLAGS',
                     imaputil.flagsmaildir2imap(flags))
-            if response[0] != 'OK':
-                raise OfflineImapError(
-                    'Error with store: %s'% '. '.join(response[1]),
-                    OfflineImapError.ERROR.MESSAGE)
-            response = response[1]
         finally:
             self.imapserver.releaseconnection(imapobj)
+        self.__updatemessagesflags(operation, uidlist, flags, response)
+
+    def __updatemessagesflags(self, operation, uidlist, flags, response):
+        """Update the flags in messagelist from the response of the STORE
+        of operation+FLAGS for uidlist."""
+
+        if response[0] != 'OK':
+            raise OfflineImapError(
+                'Error with store: %s'% '. '.join(response[1]),
+                OfflineImapError.ERROR.MESSAGE)
+        response = response[1]
         # Some IMAP servers do not always return a result.  Therefore,
         # only update the ones that it talks about, and manually fix
         # the others.
@@ -942,14 +1551,56 @@ class IMAPFolder(BaseFolder):
             elif operation == '-':
                 self.messagelist[uid]['flags'] -= flags
 
+    def __processmessagesflags_pipelined(self, stores):
+        """Send the STOREs of stores back-to-back on one connection.
+
+        :param stores: list of (operation, uidlist, flags)."""
+
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
+        try:
+            try:
+                imapobj.select(self.getfullIMAPname())
+            except imapobj.readonly:
+                for operation, uidlist, flags in stores:
+                    self.ui.flagstoreadonly(self, uidlist, flags)
+                return
+            responses = self.imapserver.pipeline(imapobj,
+                [('uid', ('store', imaputil.uid_sequence(uidlist),
+                    operation + 'FLAGS', imaputil.flagsmaildir2imap(flags)))
+                 for operation, uidlist, flags in stores])
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        errors = []
+        for (operation, uidlist, flags), response in zip(stores, responses):
+            try:
+                self.__updatemessagesflags(operation, uidlist, flags, response)
+            except OfflineImapError as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
 
     def __processmessagesflags(self, operation, uidlist, flags):
+        self.__changemessagesflags([(operation, uidlist, flags)])
+
+    def __changemessagesflags(self, changes):
         # Hack for those IMAP servers with a limited line length.
         batch_size = 100
-        for i in range(0, len(uidlist), batch_size):
-            self.__processmessagesflags_real(operation,
-              uidlist[i:i + batch_size], flags)
-        return
+        stores = [(operation, uidlist[i:i + batch_size], flags)
+                  for operation, uidlist, flags in changes
+                  for i in range(0, len(uidlist), batch_size)]
+        if self.imapserver.pipelinedepth > 1 and len(stores) > 1:
+            self.__processmessagesflags_pipelined(stores)
+            return
+        for operation, uidlist, flags in stores:
+            self.__processmessagesflags_real(operation, uidlist, flags)
+
+    # Interface from BaseFolder
+    def changemessagesflags(self, changes):
+        """Apply the flag changes with as few round-trips as possible, see
+        BaseFolder.changemessagesflags()."""
+
+        self.__changemessagesflags(changes)
 
 
     # Interface from BaseFolder
@@ -974,7 +1625,8 @@ class IMAPFolder(BaseFolder):
             return
 
         self.__addmessagesflags_noconvert(uidlist, set('T'))
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            self.getfullIMAPname())
         try:
             try:
                 imapobj.select(self.getfullIMAPname())
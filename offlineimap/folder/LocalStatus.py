@@ -28,13 +28,24 @@ class LocalStatusFolder(BaseFolder):
 
     cur_version = 2
     magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT %d"
+    # Minimum number of journal records before the journal is compacted
+    # into the status file. The journal is also allowed to grow up to the
+    # number of messages in the folder, which keeps the cost of rewriting
+    # the status file linear in the number of changes.
+    journalsize = 1000
 
     def __init__(self, name, repository):
         self.sep = '.' #needs to be set before super.__init__()
         super(LocalStatusFolder, self).__init__(name, repository)
         self.root = repository.root
         self.filename = os.path.join(self.getroot(), self.getfolderbasename())
+        self.modseqfilename = self.filename + ".modseq"
+        self.fingerprintfilename = self.filename + ".fingerprint"
+        self.lastsyncfilename = self.filename + ".lastsync"
+        self.journalfilename = self.filename + ".journal"
         self.savelock = threading.Lock()
+        self._journalfd = None
+        self._journalled = 0
         # Should we perform fsyncs as often as possible?
         self.doautosave = self.config.getdefaultboolean(
             "general", "fsync", False)
@@ -44,7 +55,8 @@ class LocalStatusFolder(BaseFolder):
         return 0
 
     def isnewfolder(self):
-        return not os.path.exists(self.filename)
+        return not (os.path.exists(self.filename) or
+                    os.path.exists(self.journalfilename))
 
     # Interface from BaseFolder
     def getfullname(self):
@@ -83,23 +95,65 @@ class LocalStatusFolder(BaseFolder):
         """
 
         for line in fp:
-            line = line.strip()
-            try:
-                uid, flags, mtime, labels = line.split('|')
-                uid = int(uid)
-                flags = set(flags)
-                mtime = int(mtime)
-                labels = set([lb.strip() for lb in labels.split(',') if len(lb.strip()) > 0])
-            except ValueError as e:
-                errstr = "Corrupt line '%s' in cache file '%s'"% \
-                    (line, self.filename)
-                self.ui.warn(errstr)
-                six.reraise(ValueError, ValueError(errstr), exc_info()[2])
-            self.messagelist[uid] = self.msglist_item_initializer(uid)
-            self.messagelist[uid]['flags'] = flags
-            self.messagelist[uid]['mtime'] = mtime
-            self.messagelist[uid]['labels'] = labels
+            self.__readrecord(line.strip(), self.filename)
 
+    def __readrecord(self, line, filename):
+        """Apply one 'uid|flags|mtime|labels' line to the messagelist."""
+
+        try:
+            uid, flags, mtime, labels = line.split('|')
+            uid = int(uid)
+            flags = set(flags)
+            mtime = int(mtime)
+            labels = set([lb.strip() for lb in labels.split(',') if len(lb.strip()) > 0])
+        except ValueError as e:
+            errstr = "Corrupt line '%s' in cache file '%s'"% \
+                (line, filename)
+            self.ui.warn(errstr)
+            six.reraise(ValueError, ValueError(errstr), exc_info()[2])
+        self.messagelist[uid] = self.msglist_item_initializer(uid)
+        self.messagelist[uid]['flags'] = flags
+        self.messagelist[uid]['mtime'] = mtime
+        self.messagelist[uid]['labels'] = labels
+
+    def readjournal(self):
+        """Replay the journal of the changes made since the status file
+        was last written.
+
+        Each line of the journal holds either the full record of a message,
+        in the format of the status file, or '-uid' for a deleted message.
+        A crash while appending may leave an incomplete last line, which is
+        dropped from the journal."""
+
+        self._journalled = 0
+        if not os.path.exists(self.journalfilename):
+            return
+        with open(self.journalfilename, "rb") as journalfd:
+            data = journalfd.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            self.ui.warn("Dropping incomplete record at the end of '%s'"%
+                self.journalfilename)
+            with open(self.journalfilename, "r+b") as journalfd:
+                journalfd.truncate(end)
+            data = data[:end]
+        if six.PY3:
+            data = data.decode('utf-8')
+
+        for line in data.splitlines():
+            line = line.strip()
+            if line.startswith('-'):
+                try:
+                    uid = int(line[1:])
+                except ValueError as e:
+                    errstr = "Corrupt line '%s' in cache file '%s'"% \
+                        (line, self.journalfilename)
+                    self.ui.warn(errstr)
+                    six.reraise(ValueError, ValueError(errstr), exc_info()[2])
+                self.messagelist.pop(uid, None)
+            else:
+                self.__readrecord(line, self.journalfilename)
+            self._journalled += 1
 
     # Interface from BaseFolder
     def cachemessagelist(self):
@@ -107,6 +161,13 @@ class LocalStatusFolder(BaseFolder):
             self.dropmessagelistcache()
             return
 
+        if os.path.exists(self.filename):
+            self.__readstatusfile()
+        else:
+            self.dropmessagelistcache()
+        self.readjournal()
+
+    def __readstatusfile(self):
         # Loop as many times as version, and update format.
         for i in range(1, self.cur_version + 1):
             self.dropmessagelistcache()
@@ -152,27 +213,78 @@ class LocalStatusFolder(BaseFolder):
         cachefd.close()
 
     def openfiles(self):
-        pass # Closing files is done on a per-transaction basis.
+        pass # The journal is opened on the first change.
 
     def closefiles(self):
-        pass # Closing files is done on a per-transaction basis.
+        with self.savelock:
+            self.__closejournal()
+
+    def __closejournal(self):
+        if self._journalfd is not None:
+            self._journalfd.close()
+            self._journalfd = None
+
+    def __journal(self, uids):
+        """Append the records of the changed uids to the journal.
+
+        The status file is rewritten instead once the journal holds more
+        records than the folder has messages."""
+
+        if self._journalled + len(uids) > max(self.journalsize,
+                                              len(self.messagelist)):
+            self.saveall()
+            return
+
+        records = []
+        for uid in uids:
+            if uid in self.messagelist:
+                msg = self.messagelist[uid]
+                flags = ''.join(sorted(msg['flags']))
+                labels = ', '.join(sorted(msg['labels']))
+                records.append("%s|%s|%d|%s\n"% (uid, flags, msg['mtime'], labels))
+            else:
+                records.append("-%s\n"% uid)
+        data = ''.join(records)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        with self.savelock:
+            if self._journalfd is None:
+                created = not os.path.exists(self.journalfilename)
+                self._journalfd = open(self.journalfilename, "ab")
+                if created and self.doautosave:
+                    fd = os.open(os.path.dirname(self.journalfilename), os.O_RDONLY)
+                    os.fsync(fd)
+                    os.close(fd)
+            self._journalfd.write(data)
+            self._journalfd.flush()
+            if self.doautosave:
+                os.fsync(self._journalfd.fileno())
+            self._journalled += len(uids)
 
     def purge(self):
         """Remove any pre-existing database."""
 
-        try:
-            os.unlink(self.filename)
-        except OSError as e:
-            self.ui.debug('', "could not remove file %s: %s"%
-                (self.filename, e))
+        with self.savelock:
+            self.__closejournal()
+        for filename in (self.filename, self.journalfilename,
+                         self.modseqfilename, self.fingerprintfilename,
+                         self.lastsyncfilename):
+            try:
+                os.unlink(filename)
+            except OSError as e:
+                self.ui.debug('', "could not remove file %s: %s"%
+                    (filename, e))
 
     def save(self):
-        """Save changed data to disk. For this backend it is the same as saveall."""
+        """Save changed data to disk. For this backend it is the same as
+        saveall: changes are journalled as they are made, and save()
+        compacts the journal into the status file."""
 
         self.saveall()
 
     def saveall(self):
-        """Saves the entire messagelist to disk."""
+        """Saves the entire messagelist to disk and empties the journal."""
 
         with self.savelock:
             cachefd = open(self.filename + ".tmp", "wt")
@@ -187,11 +299,68 @@ class LocalStatusFolder(BaseFolder):
             cachefd.close()
             os.rename(self.filename + ".tmp", self.filename)
 
+            # The journal only holds changes already in the new status file.
+            self.__closejournal()
+            if os.path.exists(self.journalfilename):
+                os.unlink(self.journalfilename)
+            self._journalled = 0
+
             if self.doautosave:
                 fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
                 os.fsync(fd)
                 os.close(fd)
 
+    def get_highestmodseq(self):
+        """Return the HIGHESTMODSEQ of the remote folder saved at the last
+        sync or None."""
+
+        if not os.path.exists(self.modseqfilename):
+            return None
+        with open(self.modseqfilename, "rt") as modseqfile:
+            return int(modseqfile.readline().strip())
+
+    def save_highestmodseq(self, modseq):
+        """Save the HIGHESTMODSEQ of the remote folder."""
+
+        with self.savelock:
+            with open(self.modseqfilename + ".tmp", "wt") as modseqfile:
+                modseqfile.write("%d\n"% modseq)
+            os.rename(self.modseqfilename + ".tmp", self.modseqfilename)
+
+    def get_fingerprint(self):
+        """Return the fingerprint of the remote folder saved at the last
+        sync or None."""
+
+        if not os.path.exists(self.fingerprintfilename):
+            return None
+        with open(self.fingerprintfilename, "rt") as fingerprintfile:
+            return fingerprintfile.readline().strip()
+
+    def save_fingerprint(self, fingerprint):
+        """Save the fingerprint of the remote folder."""
+
+        with self.savelock:
+            with open(self.fingerprintfilename + ".tmp", "wt") as fingerprintfile:
+                fingerprintfile.write("%s\n"% fingerprint)
+            os.rename(self.fingerprintfilename + ".tmp",
+                      self.fingerprintfilename)
+
+    def get_lastsync(self):
+        """Return the time the last sync of the folder started or None."""
+
+        if not os.path.exists(self.lastsyncfilename):
+            return None
+        with open(self.lastsyncfilename, "rt") as lastsyncfile:
+            return int(lastsyncfile.readline().strip())
+
+    def save_lastsync(self, lastsync):
+        """Save the time the last sync of the folder started."""
+
+        with self.savelock:
+            with open(self.lastsyncfilename + ".tmp", "wt") as lastsyncfile:
+                lastsyncfile.write("%d\n"% lastsync)
+            os.rename(self.lastsyncfilename + ".tmp", self.lastsyncfilename)
+
     # Interface from BaseFolder
     def savemessage(self, uid, content, flags, rtime, mtime=0, labels=set()):
         """Writes a new message, with the specified uid.
@@ -213,7 +382,7 @@ class LocalStatusFolder(BaseFolder):
         self.messagelist[uid]['time'] = rtime
         self.messagelist[uid]['mtime'] = mtime
         self.messagelist[uid]['labels'] = labels
-        self.save()
+        self.__journal([uid])
         return uid
 
     # Interface from BaseFolder
@@ -227,29 +396,29 @@ class LocalStatusFolder(BaseFolder):
     # Interface from BaseFolder
     def savemessageflags(self, uid, flags):
         self.messagelist[uid]['flags'] = flags
-        self.save()
+        self.__journal([uid])
 
     def savemessagelabels(self, uid, labels, mtime=None):
         self.messagelist[uid]['labels'] = labels
         if mtime: self.messagelist[uid]['mtime'] = mtime
-        self.save()
+        self.__journal([uid])
 
     def savemessageslabelsbulk(self, labels):
         """Saves labels from a dictionary in a single database operation."""
 
         for uid, lb in labels.items():
             self.messagelist[uid]['labels'] = lb
-        self.save()
+        self.__journal(list(labels))
 
     def addmessageslabels(self, uids, labels):
         for uid in uids:
             self.messagelist[uid]['labels'] = self.messagelist[uid]['labels'] | labels
-        self.save()
+        self.__journal(uids)
 
     def deletemessageslabels(self, uids, labels):
         for uid in uids:
             self.messagelist[uid]['labels'] = self.messagelist[uid]['labels'] - labels
-        self.save()
+        self.__journal(uids)
 
     def getmessagelabels(self, uid):
         return self.messagelist[uid]['labels']
@@ -259,7 +428,7 @@ class LocalStatusFolder(BaseFolder):
 
         for uid, mt in mtimes.items():
             self.messagelist[uid]['mtime'] = mt
-        self.save()
+        self.__journal(list(mtimes))
 
     def getmessagemtime(self, uid):
         return self.messagelist[uid]['mtime']
@@ -277,4 +446,4 @@ class LocalStatusFolder(BaseFolder):
 
         for uid in uidlist:
             del(self.messagelist[uid])
-        self.save()
+        self.__journal(uidlist)
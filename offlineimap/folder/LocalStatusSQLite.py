@@ -17,20 +17,29 @@
 
 import os
 import sqlite3 as sqlite
+from array import array
+from bisect import bisect_left
 from sys import exc_info
-from threading import Lock
+from threading import RLock
+try:
+    from collections.abc import Mapping
+except ImportError: # Python 2.
+    from collections import Mapping
 
 import six
 
-from .Base import BaseFolder
+from .Base import BaseFolder, flagmask
 
 
 class DatabaseFileLock(object):
-    """Lock at database file level."""
+    """Lock at database file level.
+
+    Also holds the connection to the database shared by its users."""
 
     def __init__(self):
-        self._lock = Lock()
+        self._lock = RLock()
         self._counter = 0
+        self.connection = None
 
     def __enter__(self):
         self._lock.acquire()
@@ -51,14 +60,113 @@ class DatabaseFileLock(object):
         return self._counter < 1
 
 
+class LazyMessageList(Mapping):
+    """Messagelist of a LocalStatusSQLiteFolder in lazy mode.
+
+    Only the sorted array of the UIDs is kept in memory, the items are
+    read from the database when they are looked up. As the folder writes
+    each change to the database, the items are read-only: the folder
+    only adds and removes UIDs, with add() and del."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.uids = array('L',
+            (row[0] for row in folder._select('id') if row[0] >= 0))
+
+    def __contains__(self, uid):
+        i = bisect_left(self.uids, uid)
+        return i < len(self.uids) and self.uids[i] == uid
+
+    def __getitem__(self, uid):
+        if uid in self:
+            for row in self.folder._select('id,flags,mtime,labels', uid):
+                return LazyMessageItem(self.folder._rowitem(row))
+        raise KeyError(uid)
+
+    def __setitem__(self, uid, item):
+        raise TypeError("the items of a LazyMessageList are read-only, "
+            "write UID %s to the database and add() it"% uid)
+
+    def add(self, uid):
+        """Add uid, whose row the folder wrote to the database."""
+
+        i = bisect_left(self.uids, uid)
+        if i == len(self.uids) or self.uids[i] != uid:
+            self.uids.insert(i, uid)
+
+    def __delitem__(self, uid):
+        i = bisect_left(self.uids, uid)
+        if i == len(self.uids) or self.uids[i] != uid:
+            raise KeyError(uid)
+        del self.uids[i]
+
+    def __iter__(self):
+        return iter(array('L', self.uids))
+
+    def __len__(self):
+        return len(self.uids)
+
+    def items(self):
+        """Iterate over the items in a single query."""
+
+        for row in self.folder._select('id,flags,mtime,labels'):
+            if row[0] in self:
+                yield row[0], LazyMessageItem(self.folder._rowitem(row))
+
+    def values(self):
+        for uid, item in self.items():
+            yield item
+
+    def flagmasks(self):
+        """Return a dict mapping the UIDs to the bitmask of their flags,
+        read in a single query.
+
+        The bitmask is None for messages with flags that have no bit."""
+
+        return dict((row[0], flagmask(row[1]))
+                    for row in self.folder._select('id,flags')
+                    if row[0] in self)
+
+
+class LazyMessageItem(Mapping):
+    """Read-only message item of a LazyMessageList.
+
+    The set values are frozen, so that changing them fails instead of
+    being lost."""
+
+    def __init__(self, item):
+        self._item = dict((field, frozenset(value)
+                           if isinstance(value, set) else value)
+                          for field, value in item.items())
+
+    def __getitem__(self, field):
+        return self._item[field]
+
+    def __iter__(self):
+        return iter(self._item)
+
+    def __len__(self):
+        return len(self._item)
+
+    def __repr__(self):
+        return repr(self._item)
+
+    def copy(self):
+        return dict(self)
+
+
 class LocalStatusSQLiteFolder(BaseFolder):
     """LocalStatus backend implemented with an SQLite database
 
-    As python-sqlite currently does not allow to access the same sqlite
-    objects from various threads, we need to open get and close a db
-    connection and cursor for all operations. This is a big disadvantage
-    and we might want to investigate if we cannot hold an object open
-    for a thread somehow."""
+    All the folder instances of a database file share one connection,
+    which is kept open as long as any of them uses it, so that sqlite
+    caches the prepared statements. The database is in WAL journal mode
+    and the synchronous setting depends on the statusdurability option.
+    Writers which find the database locked wait for up to busytimeout
+    seconds.
+
+    In lazy mode (see the lazystatus option), the messagelist is a
+    LazyMessageList which is never loaded as a whole."""
     # Though. According to sqlite docs, you need to commit() before
     # the connection is closed or your changes will be lost!
     # get db connection which autocommits
@@ -68,6 +176,10 @@ class LocalStatusSQLiteFolder(BaseFolder):
 
     # Current version of our db format.
     cur_version = 2
+    # Seconds to wait for a lock on the database.
+    busytimeout = 60
+    # Value of the synchronous pragma by statusdurability.
+    synchronous = {'full': 'FULL', 'normal': 'NORMAL'}
     # Keep track on how many threads need access to the database.
     locks = {} # Key: filename, value: DatabaseFileLock instance.
 
@@ -75,9 +187,11 @@ class LocalStatusSQLiteFolder(BaseFolder):
         self.sep = '.' # Needs to be set before super().__init__().
         super(LocalStatusSQLiteFolder, self).__init__(name, repository)
         self.root = repository.root
-        self.filename = os.path.join(self.getroot(), self.getfolderbasename())
+        self.filename = self._getdbfilename()
 
         self._newfolder = False        # Flag if the folder is new.
+        self._durability = repository.getstatusdurability()
+        self._lazy = repository.getlazystatus()
 
         dirname = os.path.dirname(self.filename)
         if not os.path.exists(dirname):
@@ -93,6 +207,9 @@ class LocalStatusSQLiteFolder(BaseFolder):
         self._databaseFileLock = LocalStatusSQLiteFolder.locks[self.filename]
         self._in_transactions = 0
 
+    def _getdbfilename(self):
+        return os.path.join(self.getroot(), self.getfolderbasename())
+
     def __enter__(self):
         if not self.dofsync():
             assert self.connection is not None
@@ -106,14 +223,20 @@ class LocalStatusSQLiteFolder(BaseFolder):
                 self.connection.commit()
 
     def openfiles(self):
-        # Make sure sqlite is in multithreading SERIALIZE mode.
-        assert sqlite.threadsafety == 1, 'Your sqlite is not multithreading safe.'
+        # Make sure sqlite may be used from several threads. Python 3.11
+        # reports SERIALIZED mode as 3, older versions always report 1.
+        assert sqlite.threadsafety in (1, 3), \
+            'Your sqlite is not multithreading safe.'
 
         with self._databaseFileLock.getLock():
+            if self._databaseFileLock.connection is not None:
+                self.connection = self._databaseFileLock.connection
+                self._databaseFileLock.registerNewUser()
+                return
+
             # Try to establish connection, no need for threadsafety in __init__.
             try:
-                self.connection = sqlite.connect(self.filename,
-                                                 check_same_thread=False)
+                self.connection = self.__connect()
                 self._databaseFileLock.registerNewUser()
             except sqlite.OperationalError as e:
                 # Operation had failed.
@@ -125,27 +248,45 @@ class LocalStatusSQLiteFolder(BaseFolder):
                                 (self.filename, e)),
                             exc_info()[2])
 
-            # Test if db version is current enough and if db is readable.
-            try:
-                cursor = self.connection.execute(
-                    "SELECT value from metadata WHERE key='db_version'")
-            except sqlite.DatabaseError:
-                # db file missing or corrupt, recreate it.
-                self.__create_db()
-            else:
-                # Fetch db version and upgrade if needed.
-                version = int(cursor.fetchone()[0])
-                if version < LocalStatusSQLiteFolder.cur_version:
-                    self.__upgrade_db(version)
+            self._checkdb()
+            self._databaseFileLock.connection = self.connection
+
+    def _checkdb(self):
+        """Test if db version is current enough and if db is readable."""
+
+        try:
+            cursor = self.connection.execute(
+                "SELECT value from metadata WHERE key='db_version'")
+        except sqlite.DatabaseError:
+            # db file missing or corrupt, recreate it.
+            self.__create_db()
+        else:
+            # Fetch db version and upgrade if needed.
+            version = int(cursor.fetchone()[0])
+            if version < LocalStatusSQLiteFolder.cur_version:
+                self.__upgrade_db(version)
+
+    def __connect(self):
+        """Open a connection to the database and set it up."""
+
+        connection = sqlite.connect(self.filename, check_same_thread=False,
+            timeout=self.busytimeout)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=%s"%
+            self.synchronous[self._durability])
+        return connection
 
     def purge(self):
         """Remove any pre-existing database. Do not call in dry-run mode."""
 
-        try:
-            os.unlink(self.filename)
-        except OSError as e:
-            self.ui.debug('', "could not remove file %s: %s"%
-                (self.filename, e))
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self.filename + suffix)
+            except OSError as e:
+                if suffix:
+                    continue # Only there while the database is in use.
+                self.ui.debug('', "could not remove file %s: %s"%
+                    (self.filename, e))
 
     def storesmessages(self):
         return False
@@ -155,10 +296,10 @@ class LocalStatusSQLiteFolder(BaseFolder):
 
     # Interface from LocalStatusFolder
     def isnewfolder(self):
-        return self._newfolder
+        return self._newfolder or not os.path.exists(self.filename)
 
-    def __sql_write(self, sql, args=None, executemany=False):
-        """Execute some SQL, retrying if the db was locked.
+    def _sql_write(self, sql, args=None, executemany=False):
+        """Execute some SQL, waiting for busytimeout if the db is locked.
 
         :param sql: the SQL string passed to execute()
         :param args: the variable values to `sql`. E.g. (1,2) or {uid:1,
@@ -167,39 +308,31 @@ class LocalStatusSQLiteFolder(BaseFolder):
             perform conn.executemany() or conn.execute().
         :returns: None or raises an Exception."""
 
-        success = False
-        while not success:
-            try:
-                with self._databaseFileLock.getLock():
-                    if args is None:
-                        if executemany:
-                            self.connection.executemany(sql)
-                        else:
-                            self.connection.execute(sql)
+        try:
+            # The lock serializes the threads sharing the connection.
+            with self._databaseFileLock.getLock():
+                if args is None:
+                    if executemany:
+                        self.connection.executemany(sql)
                     else:
-                        if executemany:
-                            self.connection.executemany(sql, args)
-                        else:
-                            self.connection.execute(sql, args)
-                    success = True
-                    if not self._in_transactions:
-                        self.connection.commit()
-            except sqlite.OperationalError as e:
-                if e.args[0] == 'cannot commit - no transaction is active':
-                    pass
-                elif e.args[0] == 'database is locked':
-                    self.ui.debug('', "Locked sqlite database, retrying.")
-                    success = False
+                        self.connection.execute(sql)
                 else:
-                    raise
+                    if executemany:
+                        self.connection.executemany(sql, args)
+                    else:
+                        self.connection.execute(sql, args)
+                if not self._in_transactions:
+                    self.connection.commit()
+        except sqlite.OperationalError as e:
+            if e.args[0] != 'cannot commit - no transaction is active':
+                raise
 
     def __upgrade_db(self, from_ver):
         """Upgrade the sqlite format from version 'from_ver' to current"""
 
         if self.connection is not None:
             self.connection.close() # Close old connections first.
-        self.connection = sqlite.connect(self.filename,
-                                         check_same_thread=False)
+        self.connection = self.__connect()
 
         # Upgrade from database version 1 to version 2
         # This change adds labels and mtime columns, to be used by Gmail IMAP and Maildir folders.
@@ -233,6 +366,57 @@ class LocalStatusSQLiteFolder(BaseFolder):
         self._newfolder = True
 
 
+    def get_highestmodseq(self):
+        """Return the HIGHESTMODSEQ of the remote folder saved at the last
+        sync or None."""
+
+        cursor = self.connection.execute(
+            "SELECT value from metadata WHERE key='highestmodseq'")
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return int(row[0])
+
+    def save_highestmodseq(self, modseq):
+        """Save the HIGHESTMODSEQ of the remote folder."""
+
+        self._sql_write("INSERT OR REPLACE INTO metadata VALUES "
+            "('highestmodseq', ?)", (str(modseq),))
+
+    def get_fingerprint(self):
+        """Return the fingerprint of the remote folder saved at the last
+        sync or None."""
+
+        cursor = self.connection.execute(
+            "SELECT value from metadata WHERE key='fingerprint'")
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def save_fingerprint(self, fingerprint):
+        """Save the fingerprint of the remote folder."""
+
+        self._sql_write("INSERT OR REPLACE INTO metadata VALUES "
+            "('fingerprint', ?)", (fingerprint,))
+
+    def get_lastsync(self):
+        """Return the time the last sync of the folder started or None."""
+
+        cursor = self.connection.execute(
+            "SELECT value from metadata WHERE key='lastsync'")
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return int(row[0])
+
+    def save_lastsync(self, lastsync):
+        """Save the time the last sync of the folder started."""
+
+        self._sql_write("INSERT OR REPLACE INTO metadata VALUES "
+            "('lastsync', ?)", (str(int(lastsync)),))
+
+
     # Interface from BaseFolder
     def msglist_item_initializer(self, uid):
         return {'uid': uid, 'flags': set(), 'labels': set(), 'time': 0, 'mtime': 0}
@@ -241,38 +425,77 @@ class LocalStatusSQLiteFolder(BaseFolder):
     # Interface from BaseFolder
     def cachemessagelist(self):
         self.dropmessagelistcache()
-        cursor = self.connection.execute('SELECT id,flags,mtime,labels from status')
-        for row in cursor:
-            uid = row[0]
-            self.messagelist[uid] = self.msglist_item_initializer(uid)
-            flags = set(row[1])
-            try:
-                labels = set([lb.strip() for lb in
-                    row[3].split(',') if len(lb.strip()) > 0])
-            except AttributeError:
-                # FIXME: This except clause was introduced because row[3] from
-                # database can be found of unexpected type NoneType. See
-                # https://github.com/OfflineIMAP/offlineimap/issues/103
-                #
-                # We are fixing the type here but this would require more
-                # researches to find the true root cause. row[3] is expected to
-                # be a (empty) string, not None.
-                #
-                # Also, since database might return None, we have to fix the
-                # database, too.
-                labels = set()
-            self.messagelist[uid]['flags'] = flags
-            self.messagelist[uid]['labels'] = labels
-            self.messagelist[uid]['mtime'] = row[2]
+        if self._lazy:
+            self.messagelist = LazyMessageList(self)
+            return
+        for row in self._select('id,flags,mtime,labels'):
+            self.messagelist[row[0]] = self._rowitem(row)
+
+    # Interface from BaseFolder
+    def getmessageuidlist(self):
+        if self._lazy:
+            return array('L', self.messagelist.uids)
+        return super(LocalStatusSQLiteFolder, self).getmessageuidlist()
+
+    # Interface from BaseFolder
+    def getmessageflagmasks(self):
+        if self._lazy:
+            return self.messagelist.flagmasks()
+        return super(LocalStatusSQLiteFolder, self).getmessageflagmasks()
+
+    def _cachefield(self, uid, field, value):
+        """Set field of the item of uid in the messagelist, which in lazy
+        mode is read from the database instead."""
+
+        if not self._lazy:
+            self.messagelist[uid][field] = value
+
+    def _select(self, columns, uid=None):
+        """Return a cursor on the columns of the status rows, ordered by
+        UID, or of the row of uid only."""
+
+        if uid is None:
+            return self.connection.execute(
+                'SELECT %s FROM status ORDER BY id'% columns)
+        return self.connection.execute(
+            'SELECT %s FROM status WHERE id=?'% columns, (uid,))
+
+    def _rowitem(self, row):
+        """Return the messagelist item of an (id,flags,mtime,labels) row."""
+
+        uid = row[0]
+        item = self.msglist_item_initializer(uid)
+        flags = set(row[1])
+        try:
+            labels = set([lb.strip() for lb in
+                row[3].split(',') if len(lb.strip()) > 0])
+        except AttributeError:
+            # FIXME: This except clause was introduced because row[3] from
+            # database can be found of unexpected type NoneType. See
+            # https://github.com/OfflineIMAP/offlineimap/issues/103
+            #
+            # We are fixing the type here but this would require more
+            # researches to find the true root cause. row[3] is expected to
+            # be a (empty) string, not None.
+            #
+            # Also, since database might return None, we have to fix the
+            # database, too.
+            labels = set()
+        item['flags'] = flags
+        item['labels'] = labels
+        item['mtime'] = row[2]
+        return item
 
     def closefiles(self):
         with self._databaseFileLock.getLock():
             self._databaseFileLock.removeOneUser()
             if self._databaseFileLock.shouldClose():
+                self._databaseFileLock.connection = None
                 try:
                     self.connection.close()
                 except:
                     pass
+            self.connection = None
 
     # Interface from LocalStatusFolder
     def save(self):
@@ -290,7 +513,7 @@ class LocalStatusSQLiteFolder(BaseFolder):
                 labels = ', '.join(sorted(msg['labels']))
                 data.append((uid, flags, mtime, labels))
 
-            self.__sql_write('INSERT OR REPLACE INTO status '
+            self._sql_write('INSERT OR REPLACE INTO status '
                 '(id,flags,mtime,labels) VALUES (?,?,?,?)',
                 data, executemany=True)
 
@@ -348,27 +571,29 @@ class LocalStatusSQLiteFolder(BaseFolder):
             self.savemessageflags(uid, flags)
             return uid
 
-        self.messagelist[uid] = self.msglist_item_initializer(uid)
-        self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime, 'mtime': mtime, 'labels': labels}
+        if not self._lazy:
+            self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime, 'mtime': mtime, 'labels': labels}
         flags = ''.join(sorted(flags))
         labels = ', '.join(sorted(labels))
         try:
-            self.__sql_write('INSERT INTO status (id,flags,mtime,labels) VALUES (?,?,?,?)',
+            self._sql_write('INSERT INTO status (id,flags,mtime,labels) VALUES (?,?,?,?)',
                             (uid,flags,mtime,labels))
         except Exception as e:
             six.reraise(UserWarning,
                         UserWarning("%s while inserting UID %s"%
                             (str(e), str(uid))),
                         exc_info()[2])
+        if self._lazy:
+            self.messagelist.add(uid)
         return uid
 
 
     # Interface from BaseFolder
     def savemessageflags(self, uid, flags):
         assert self.uidexists(uid)
-        self.messagelist[uid]['flags'] = flags
+        self._cachefield(uid, 'flags', flags)
         flags = ''.join(sorted(flags))
-        self.__sql_write('UPDATE status SET flags=? WHERE id=?',(flags,uid))
+        self._sql_write('UPDATE status SET flags=? WHERE id=?',(flags,uid))
 
 
     def getmessageflags(self, uid):
@@ -376,14 +601,14 @@ class LocalStatusSQLiteFolder(BaseFolder):
 
 
     def savemessagelabels(self, uid, labels, mtime=None):
-        self.messagelist[uid]['labels'] = labels
-        if mtime: self.messagelist[uid]['mtime'] = mtime
+        self._cachefield(uid, 'labels', labels)
+        if mtime: self._cachefield(uid, 'mtime', mtime)
 
         labels = ', '.join(sorted(labels))
         if mtime:
-            self.__sql_write('UPDATE status SET labels=?, mtime=? WHERE id=?',(labels,mtime,uid))
+            self._sql_write('UPDATE status SET labels=?, mtime=? WHERE id=?',(labels,mtime,uid))
         else:
-            self.__sql_write('UPDATE status SET labels=? WHERE id=?',(labels,uid))
+            self._sql_write('UPDATE status SET labels=? WHERE id=?',(labels,uid))
 
 
     def savemessageslabelsbulk(self, labels):
@@ -392,9 +617,9 @@ class LocalStatusSQLiteFolder(BaseFolder):
 
         """
         data = [(', '.join(sorted(l)), uid) for uid, l in labels.items()]
-        self.__sql_write('UPDATE status SET labels=? WHERE id=?', data, executemany=True)
+        self._sql_write('UPDATE status SET labels=? WHERE id=?', data, executemany=True)
         for uid, l in labels.items():
-            self.messagelist[uid]['labels'] = l
+            self._cachefield(uid, 'labels', l)
 
 
     def addmessageslabels(self, uids, labels):
@@ -402,9 +627,10 @@ class LocalStatusSQLiteFolder(BaseFolder):
         for uid in uids:
             newlabels = self.messagelist[uid]['labels'] | labels
             data.append((', '.join(sorted(newlabels)), uid))
-        self.__sql_write('UPDATE status SET labels=? WHERE id=?', data, executemany=True)
+        self._sql_write('UPDATE status SET labels=? WHERE id=?', data, executemany=True)
         for uid in uids:
-            self.messagelist[uid]['labels'] = self.messagelist[uid]['labels'] | labels
+            self._cachefield(uid, 'labels',
+                self.messagelist[uid]['labels'] | labels)
 
 
     def deletemessageslabels(self, uids, labels):
@@ -412,9 +638,10 @@ class LocalStatusSQLiteFolder(BaseFolder):
         for uid in uids:
             newlabels = self.messagelist[uid]['labels'] - labels
             data.append((', '.join(sorted(newlabels)), uid))
-        self.__sql_write('UPDATE status SET labels=? WHERE id=?', data, executemany=True)
+        self._sql_write('UPDATE status SET labels=? WHERE id=?', data, executemany=True)
         for uid in uids:
-            self.messagelist[uid]['labels'] = self.messagelist[uid]['labels'] - labels
+            self._cachefield(uid, 'labels',
+                self.messagelist[uid]['labels'] - labels)
 
 
     def getmessagelabels(self, uid):
@@ -425,9 +652,9 @@ class LocalStatusSQLiteFolder(BaseFolder):
         """Saves mtimes from the mtimes dictionary in a single database operation."""
 
         data = [(mt, uid) for uid, mt in mtimes.items()]
-        self.__sql_write('UPDATE status SET mtime=? WHERE id=?', data, executemany=True)
+        self._sql_write('UPDATE status SET mtime=? WHERE id=?', data, executemany=True)
         for uid, mt in mtimes.items():
-            self.messagelist[uid]['mtime'] = mt
+            self._cachefield(uid, 'mtime', mt)
 
 
     def getmessagemtime(self, uid):
@@ -438,7 +665,7 @@ class LocalStatusSQLiteFolder(BaseFolder):
     def deletemessage(self, uid):
         if not uid in self.messagelist:
             return
-        self.__sql_write('DELETE FROM status WHERE id=?', (uid, ))
+        self._sql_write('DELETE FROM status WHERE id=?', (uid, ))
         del(self.messagelist[uid])
 
     # Interface from BaseFolder
@@ -454,6 +681,6 @@ class LocalStatusSQLiteFolder(BaseFolder):
         if not len(uidlist):
             return
         # arg2 needs to be an iterable of 1-tuples [(1,),(2,),...]
-        self.__sql_write('DELETE FROM status WHERE id=?', list(zip(uidlist, )), True)
+        self._sql_write('DELETE FROM status WHERE id=?', list(zip(uidlist, )), True)
         for uid in uidlist:
             del(self.messagelist[uid])
@@ -0,0 +1,289 @@
+# Local status cache virtual folder: account-wide SQLite backend
+# Copyright (C) 2002-2017 John Goerzen & contributors.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os
+import sqlite3 as sqlite
+from sys import exc_info
+
+import six
+
+from .LocalStatusSQLite import LocalStatusSQLiteFolder
+
+
+class LocalStatusSQLiteAccountFolder(LocalStatusSQLiteFolder):
+    """LocalStatus backend keeping all the folders of an account in a
+    single SQLite database.
+
+    The rows of the status table carry the name of their folder. A folder
+    exists in the database once it has a row in the folders table, which
+    also holds its HIGHESTMODSEQ and fingerprint. All the folders share the
+    connection to the database, see LocalStatusSQLiteFolder."""
+
+    # Current version of our db format.
+    cur_version = 2
+    # Name of the database file in the account metadata directory.
+    dbname = 'LocalStatus.db'
+
+    def _getdbfilename(self):
+        return os.path.join(self.getroot(), self.dbname)
+
+    def openfiles(self):
+        super(LocalStatusSQLiteAccountFolder, self).openfiles()
+
+        with self._databaseFileLock.getLock():
+            cursor = self.connection.execute(
+                "SELECT name FROM folders WHERE name=?", (self.name,))
+            if cursor.fetchone() is None:
+                self._sql_write("INSERT INTO folders (name) VALUES (?)",
+                    (self.name,))
+                self._newfolder = True
+
+    def _checkdb(self):
+        try:
+            cursor = self.connection.execute(
+                "SELECT value from metadata WHERE key='db_version'")
+        except sqlite.DatabaseError:
+            # db file missing or corrupt, recreate it.
+            self.__create_db()
+        else:
+            version = int(cursor.fetchone()[0])
+            if version < self.cur_version:
+                self.__upgrade_db(version)
+
+    def __upgrade_db(self, from_ver):
+        """Upgrade the sqlite format from version 'from_ver' to current"""
+
+        # Upgrade from database version 1 to version 2
+        # This change adds the lastsync column of the folders.
+        if from_ver <= 1:
+            self.ui._msg('Upgrading LocalStatus db from version 1 to '
+                'version 2 for account %s'% self.accountname)
+            self.connection.executescript("""ALTER TABLE folders ADD lastsync INTEGER;
+                                             UPDATE metadata SET value='2' WHERE key='db_version';
+                                          """)
+            self.connection.commit()
+
+        # Future version upgrades come here...
+
+    def __create_db(self):
+        """Create a new db file.
+
+        self.connection must point to the opened and valid SQlite
+        database connection."""
+
+        self.ui._msg('Creating new Local Status db for account %s'%
+                     self.accountname)
+        self.connection.executescript("""
+        CREATE TABLE metadata (key VARCHAR(50) PRIMARY KEY, value VARCHAR(128));
+        INSERT INTO metadata VALUES('db_version', '2');
+        CREATE TABLE folders (name VARCHAR(256) PRIMARY KEY, highestmodseq INTEGER, fingerprint VARCHAR(128), lastsync INTEGER);
+        CREATE TABLE status (folder VARCHAR(256), id INTEGER, flags VARCHAR(50), mtime INTEGER, labels VARCHAR(256), PRIMARY KEY (folder, id));
+        """)
+        self.connection.commit()
+
+    def purge(self):
+        """Remove the folder from the database. Do not call in dry-run mode."""
+
+        opened = self.connection is None
+        if opened:
+            if not os.path.exists(self.filename):
+                return
+            self.openfiles()
+        try:
+            with self._databaseFileLock.getLock():
+                self._sql_write('DELETE FROM status WHERE folder=?',
+                    (self.name,))
+                self._sql_write('DELETE FROM folders WHERE name=?',
+                    (self.name,))
+        finally:
+            if opened:
+                self.closefiles()
+
+    # Interface from LocalStatusFolder
+    def isnewfolder(self):
+        if self.connection is not None:
+            return self._newfolder
+        if not os.path.exists(self.filename):
+            return True
+        # Do not add the folder to the database by opening it.
+        connection = sqlite.connect(self.filename,
+            timeout=self.busytimeout)
+        try:
+            cursor = connection.execute(
+                "SELECT name FROM folders WHERE name=?", (self.name,))
+            return cursor.fetchone() is None
+        except sqlite.DatabaseError:
+            return True
+        finally:
+            connection.close()
+
+    def get_highestmodseq(self):
+        cursor = self.connection.execute(
+            "SELECT highestmodseq FROM folders WHERE name=?", (self.name,))
+        return cursor.fetchone()[0]
+
+    def save_highestmodseq(self, modseq):
+        self._sql_write("UPDATE folders SET highestmodseq=? WHERE name=?",
+            (modseq, self.name))
+
+    def get_fingerprint(self):
+        cursor = self.connection.execute(
+            "SELECT fingerprint FROM folders WHERE name=?", (self.name,))
+        return cursor.fetchone()[0]
+
+    def save_fingerprint(self, fingerprint):
+        self._sql_write("UPDATE folders SET fingerprint=? WHERE name=?",
+            (fingerprint, self.name))
+
+    def get_lastsync(self):
+        cursor = self.connection.execute(
+            "SELECT lastsync FROM folders WHERE name=?", (self.name,))
+        return cursor.fetchone()[0]
+
+    def save_lastsync(self, lastsync):
+        self._sql_write("UPDATE folders SET lastsync=? WHERE name=?",
+            (int(lastsync), self.name))
+
+    def _select(self, columns, uid=None):
+        if uid is None:
+            return self.connection.execute(
+                'SELECT %s FROM status WHERE folder=? ORDER BY id'% columns,
+                (self.name,))
+        return self.connection.execute(
+            'SELECT %s FROM status WHERE folder=? AND id=?'% columns,
+            (self.name, uid))
+
+    def saveall(self):
+        """Saves the entire messagelist to the database."""
+
+        with self._databaseFileLock.getLock():
+            data = []
+            for uid, msg in self.messagelist.items():
+                mtime = msg['mtime']
+                flags = ''.join(sorted(msg['flags']))
+                labels = ', '.join(sorted(msg['labels']))
+                data.append((self.name, uid, flags, mtime, labels))
+
+            self._sql_write('INSERT OR REPLACE INTO status '
+                '(folder,id,flags,mtime,labels) VALUES (?,?,?,?,?)',
+                data, executemany=True)
+
+    # Interface from BaseFolder
+    def savemessage(self, uid, content, flags, rtime, mtime=0, labels=set()):
+        """Writes a new message, with the specified uid.
+
+        See folder/Base for detail. Note that savemessage() does not
+        check against dryrun settings, so you need to ensure that
+        savemessage is never called in a dryrun mode."""
+
+        if uid < 0:
+            # We cannot assign a uid.
+            return uid
+
+        if self.uidexists(uid):     # Already have it.
+            self.savemessageflags(uid, flags)
+            return uid
+
+        if not self._lazy:
+            self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime, 'mtime': mtime, 'labels': labels}
+        flags = ''.join(sorted(flags))
+        labels = ', '.join(sorted(labels))
+        try:
+            self._sql_write('INSERT INTO status (folder,id,flags,mtime,labels) '
+                'VALUES (?,?,?,?,?)', (self.name,uid,flags,mtime,labels))
+        except Exception as e:
+            six.reraise(UserWarning,
+                        UserWarning("%s while inserting UID %s"%
+                            (str(e), str(uid))),
+                        exc_info()[2])
+        if self._lazy:
+            self.messagelist.add(uid)
+        return uid
+
+    # Interface from BaseFolder
+    def savemessageflags(self, uid, flags):
+        assert self.uidexists(uid)
+        self._cachefield(uid, 'flags', flags)
+        flags = ''.join(sorted(flags))
+        self._sql_write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+            (flags,self.name,uid))
+
+    def savemessagelabels(self, uid, labels, mtime=None):
+        self._cachefield(uid, 'labels', labels)
+        if mtime: self._cachefield(uid, 'mtime', mtime)
+
+        labels = ', '.join(sorted(labels))
+        if mtime:
+            self._sql_write('UPDATE status SET labels=?, mtime=? '
+                'WHERE folder=? AND id=?', (labels,mtime,self.name,uid))
+        else:
+            self._sql_write('UPDATE status SET labels=? '
+                'WHERE folder=? AND id=?', (labels,self.name,uid))
+
+    def __savelabels(self, labels):
+        """Saves the labels of the uid:labels dictionary."""
+
+        data = [(', '.join(sorted(l)), self.name, uid)
+                for uid, l in labels.items()]
+        self._sql_write('UPDATE status SET labels=? WHERE folder=? AND id=?',
+            data, executemany=True)
+        for uid, l in labels.items():
+            self._cachefield(uid, 'labels', l)
+
+    def savemessageslabelsbulk(self, labels):
+        """Saves labels from a dictionary in a single database operation."""
+
+        self.__savelabels(labels)
+
+    def addmessageslabels(self, uids, labels):
+        self.__savelabels(dict((uid, self.messagelist[uid]['labels'] | labels)
+                               for uid in uids))
+
+    def deletemessageslabels(self, uids, labels):
+        self.__savelabels(dict((uid, self.messagelist[uid]['labels'] - labels)
+                               for uid in uids))
+
+    def savemessagesmtimebulk(self, mtimes):
+        """Saves mtimes from the mtimes dictionary in a single database operation."""
+
+        data = [(mt, self.name, uid) for uid, mt in mtimes.items()]
+        self._sql_write('UPDATE status SET mtime=? WHERE folder=? AND id=?',
+            data, executemany=True)
+        for uid, mt in mtimes.items():
+            self._cachefield(uid, 'mtime', mt)
+
+    # Interface from BaseFolder
+    def deletemessage(self, uid):
+        if not uid in self.messagelist:
+            return
+        self._sql_write('DELETE FROM status WHERE folder=? AND id=?',
+            (self.name, uid))
+        del(self.messagelist[uid])
+
+    # Interface from BaseFolder
+    def deletemessages(self, uidlist):
+        """Delete list of UIDs from status cache, see
+        LocalStatusSQLiteFolder.deletemessages()."""
+
+        # Weed out ones not in self.messagelist
+        uidlist = [uid for uid in uidlist if uid in self.messagelist]
+        if not len(uidlist):
+            return
+        self._sql_write('DELETE FROM status WHERE folder=? AND id=?',
+            [(self.name, uid) for uid in uidlist], True)
+        for uid in uidlist:
+            del(self.messagelist[uid])
@@ -30,9 +30,16 @@ try: # python 2.6 has set() built in
     set
 except NameError:
     from sets import Set as set
+try:
+    from os import scandir
+except ImportError: # python2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from offlineimap import OfflineImapError, emailutil
-from .Base import BaseFolder
+from .Base import BaseFolder, MessageList
 
 
 # Find the UID in a message filename
@@ -44,6 +51,19 @@ timehash = {}
 timelock = Lock()
 
 
+def _listdir(path):
+    """List the directory path with os.scandir() if available, which may
+    save the stat() syscalls on some platforms.
+
+    :returns: list of (name, stat) where stat() returns the os.stat() of
+        the entry."""
+
+    if scandir is None:
+        return [(name, lambda name=name: os.stat(os.path.join(path, name)))
+                for name in os.listdir(path)]
+    return [(entry.name, entry.stat) for entry in scandir(path)]
+
+
 def _gettimeseq(date=None):
     global timehash, timelock
     timelock.acquire()
@@ -74,7 +94,10 @@ class MaildirFolder(BaseFolder):
         # Everything up to the first comma or colon (or ! if Windows):
         self.re_prefixmatch = re.compile('([^'+ self.infosep + ',]*)')
         # folder's md, so we can match with recorded file md5 for validity.
-        self._foldermd5 = md5(self.getvisiblename()).hexdigest()
+        visiblename = self.getvisiblename()
+        if not isinstance(visiblename, bytes):
+            visiblename = visiblename.encode('utf-8')
+        self._foldermd5 = md5(visiblename).hexdigest()
         # Cache the full folder path, as we use getfullname() very often.
         self._fullname = os.path.join(self.getroot(), self.getname())
         # Modification time from 'Date' header.
@@ -86,6 +109,14 @@ class MaildirFolder(BaseFolder):
         self.sep_subst = '-'
         if os.path.sep == self.sep_subst:
             self.sep_subst = '_'
+        # Whether the size and mtime of the files must be read at every scan
+        # rather than taken from the scan index.
+        self._freshstats = False
+        # Where the files of new and cur are indexed between syncs, if enabled.
+        self._scanindexfile = None
+        if repository.getscanindexdir() is not None:
+            self._scanindexfile = os.path.join(repository.getscanindexdir(),
+                self.getfolderbasename())
 
     # Interface from BaseFolder
     def getfullname(self):
@@ -167,42 +198,31 @@ class MaildirFolder(BaseFolder):
         Maildir flags are:
             D (draft) F (flagged) R (replied) S (seen) T (trashed),
         plus lower-case letters for custom flags.
-        :returns: dict that can be used as self.messagelist.
+        :returns: MessageList that can be used as self.messagelist.
         """
 
         maxsize = self.getmaxsize()
 
-        retval = {}
-        files = []
+        retval = MessageList()
         nouidcounter = -1   # Messages without UIDs get negative UIDs.
-        for dirannex in ['new', 'cur']:
-            fulldirname = os.path.join(self.getfullname(), dirannex)
-            files.extend((dirannex, filename) for
-                         filename in os.listdir(fulldirname))
-
         date_excludees = {}
-        for dirannex, filename in files:
-            if filename.startswith('.'):
-                continue # Ignore dot files.
+        # The sizes and mtimes are kept in the scan index, so they are
+        # read once for all. Otherwise only the messages without a UID,
+        # which are about to be uploaded, are stat()ed, see
+        # getmessagetime().
+        withstats = bool(maxsize) or self._freshstats or \
+            self._scanindexfile is not None
+        for dirannex, filename, uid, flags, size, mtime in \
+                self.__scanfiles(withstats):
             # We store just dirannex and filename, ie 'cur/123...'
             filepath = os.path.join(dirannex, filename)
             # Check maxsize if this message should be considered.
-            if maxsize and (os.path.getsize(
-                    os.path.join(self.getfullname(), filepath)) > maxsize):
+            if maxsize and size > maxsize:
                 continue
 
-            prefix, uid, fmd5, flags = self._parse_filename(filename)
             if uid is None: # Assign negative uid to upload it.
                 uid = nouidcounter
                 nouidcounter -= 1
-            else:                       # It comes from our folder.
-                uidmatch = re_uidmatch.search(filename)
-                uid = None
-                if not uidmatch:
-                    uid = nouidcounter
-                    nouidcounter -= 1
-                else:
-                    uid = int(uidmatch.group(1))
             if min_uid != None and uid > 0 and uid < min_uid:
                 continue
             if min_date != None and not self._iswithintime(filename, min_date):
@@ -217,11 +237,15 @@ class MaildirFolder(BaseFolder):
                 date_excludees[uid] = self.msglist_item_initializer(uid)
                 date_excludees[uid]['flags'] = flags
                 date_excludees[uid]['filename'] = filepath
+                date_excludees[uid]['size'] = size
+                date_excludees[uid]['mtime'] = mtime
             else:
                 # 'filename' is 'dirannex/filename', e.g. cur/123,U=1,FMD5=1:2,S
                 retval[uid] = self.msglist_item_initializer(uid)
                 retval[uid]['flags'] = flags
                 retval[uid]['filename'] = filepath
+                retval[uid]['size'] = size
+                retval[uid]['mtime'] = mtime
         if min_date != None:
             # Re-include messages with high enough uid's.
             positive_uids = [uid for uid in retval if uid > 0]
@@ -235,6 +259,147 @@ class MaildirFolder(BaseFolder):
                         retval[uid] = date_excludees[uid]
         return retval
 
+    def __scanfiles(self, withstats):
+        """List the messages of new and cur.
+
+        With the scan index, a directory is only listed again if its
+        mtime changed since the last scan, and only the new files are
+        parsed and stat()ed then, unless _freshstats is set.
+
+        The stats come from the directory listing, see _listdir().
+
+        :param withstats: whether the file sizes and mtimes are needed.
+        :returns: list of (dirannex, filename, uid, flags, size, mtime), uid
+            as found by _parse_filename(), size and mtime are None unless
+            withstats or uid is None."""
+
+        index = self.__loadscanindex()
+        changed = False
+        files = []
+        for dirannex in ['new', 'cur']:
+            fulldirname = os.path.join(self.getfullname(), dirannex)
+            scantime = time.time()
+            mtime = os.stat(fulldirname).st_mtime
+            oldmtime, entries = index.get(dirannex, (None, {}))
+            stats = {}
+            if oldmtime is None or oldmtime != mtime:
+                oldentries, entries = entries, {}
+                for filename, stat in _listdir(fulldirname):
+                    if filename.startswith('.'):
+                        continue # Ignore dot files.
+                    entry = oldentries.get(filename)
+                    if entry is None:
+                        prefix, uid, fmd5, flags = \
+                            self._parse_filename(filename)
+                        entry = [uid, ''.join(sorted(flags)), None, None]
+                    entries[filename] = entry
+                    stats[filename] = stat
+                # A change within the same second could go unnoticed,
+                # list the directory again next time.
+                if mtime >= scantime - 1:
+                    mtime = None
+                index[dirannex] = (mtime, entries)
+                changed = True
+            for filename, entry in entries.items():
+                if (withstats or entry[0] is None) and \
+                        (entry[2] is None or self._freshstats):
+                    if filename in stats:
+                        st = stats[filename]()
+                    else:
+                        st = os.stat(os.path.join(fulldirname, filename))
+                    if entry[2:] != [st.st_size, st.st_mtime]:
+                        entry[2:] = [st.st_size, st.st_mtime]
+                        changed = True
+                files.append((dirannex, filename, entry[0], set(entry[1]),
+                    entry[2], entry[3]))
+        if changed:
+            self.__savescanindex(index)
+        return files
+
+    def __loadscanindex(self):
+        """Return the scan index of the folder, read once for all if the
+        repository keeps them in memory."""
+
+        indexes = self.repository.getscanindexes()
+        if indexes is None:
+            return self.__readscanindex()
+        if self._scanindexfile not in indexes:
+            indexes[self._scanindexfile] = self.__readscanindex()
+        return indexes[self._scanindexfile]
+
+    def __readscanindex(self):
+        """Read the scan index of the folder.
+
+        :returns: dict of dirannex: (mtime, {filename: [uid, flags, size,
+            mtime]}), empty if there is no usable index."""
+
+        index = {}
+        if self._scanindexfile is None or \
+                not os.path.exists(self._scanindexfile):
+            return index
+        try:
+            with open(self._scanindexfile, 'rt') as indexfd:
+                if indexfd.readline() != self.__scanindexmagic():
+                    return {}
+                entries = None
+                for line in indexfd:
+                    line = line[:-1]
+                    if line.startswith('dir '):
+                        dirannex, mtime = line.split(' ')[1:]
+                        entries = {}
+                        index[dirannex] = (None if mtime == '-' else
+                            float(mtime), entries)
+                        continue
+                    uid, flags, size, mtime, filename = line.split('|', 4)
+                    entries[filename] = [None if uid == '-' else int(uid),
+                        flags, None if size == '-' else int(size),
+                        None if mtime == '-' else float(mtime)]
+        except (IOError, ValueError, TypeError) as e:
+            self.ui.debug('maildir', "Ignoring scan index '%s': %s"%
+                (self._scanindexfile, e))
+            return {}
+        return index
+
+    def __savescanindex(self, index):
+        if self._scanindexfile is None:
+            return
+        tmpname = self._scanindexfile + ".tmp"
+        with open(tmpname, 'wt') as indexfd:
+            indexfd.write(self.__scanindexmagic())
+            for dirannex, (mtime, entries) in index.items():
+                indexfd.write("dir %s %s\n"% (dirannex,
+                    '-' if mtime is None else repr(mtime)))
+                for filename, (uid, flags, size, mtime) in entries.items():
+                    if '\n' in filename:
+                        # Can't be indexed, scan the folder again next time.
+                        indexfd.close()
+                        os.unlink(tmpname)
+                        return
+                    indexfd.write("%s|%s|%s|%s|%s\n"% (
+                        '-' if uid is None else uid, flags,
+                        '-' if size is None else size,
+                        '-' if mtime is None else repr(mtime), filename))
+        os.rename(tmpname, self._scanindexfile)
+
+    def __scanindexmagic(self):
+        # The UIDs and flags of the file names depend on these.
+        return "OFFLINEIMAP SCANINDEX 2 %s %s\n"% (self._foldermd5,
+            self.infosep)
+
+    # Interface from BaseFolder
+    def getwarmsize(self):
+        indexes = self.repository.getscanindexes()
+        if indexes is None or self._scanindexfile not in indexes:
+            return 0
+        return sum(len(entries) for mtime, entries in
+                   indexes[self._scanindexfile].values())
+
+    # Interface from BaseFolder
+    def dropwarmdata(self):
+        indexes = self.repository.getscanindexes()
+        if indexes is not None:
+            indexes.pop(self._scanindexfile, None)
+
     # Interface from BaseFolder
     def quickchanged(self, statusfolder):
         """Returns True if the Maildir has changed
@@ -253,7 +418,8 @@ class MaildirFolder(BaseFolder):
 
     # Interface from BaseFolder
     def msglist_item_initializer(self, uid):
-        return {'flags': set(), 'filename': '/no-dir/no-such-file/'}
+        return {'flags': set(), 'filename': '/no-dir/no-such-file/',
+                'size': None, 'mtime': None}
 
     # Interface from BaseFolder
     def cachemessagelist(self, min_date=None, min_uid=None):
@@ -267,17 +433,31 @@ class MaildirFolder(BaseFolder):
     def getmessage(self, uid):
         """Return the content of the message."""
 
+        with self.openmessagefile(uid) as file:
+            return emailutil.decode_message(file.read())
+
+    # Interface from BaseFolder
+    def openmessagefile(self, uid):
         filename = self.messagelist[uid]['filename']
         filepath = os.path.join(self.getfullname(), filename)
-        file = open(filepath, 'rt')
-        retval = file.read()
-        file.close()
-        #TODO: WHY are we replacing \r\n with \n here? And why do we
-        #      read it as text?
-        return retval.replace("\r\n", "\n")
+        return open(filepath, 'rb')
+
+    # Interface from BaseFolder
+    def storesstubs(self):
+        return True
+
+    # Interface from BaseFolder
+    def isstub(self, uid):
+        with self.openmessagefile(uid) as msgfile:
+            return emailutil.is_stub(emailutil.read_headers(msgfile))
 
     # Interface from BaseFolder
     def getmessagetime(self, uid):
+        # The mtime of the scan, if any, is still valid as renaming the file
+        # does not change it. The scan has it for all the messages without
+        # a UID.
+        if self.messagelist[uid].get('mtime'):
+            return self.messagelist[uid]['mtime']
         filename = self.messagelist[uid]['filename']
         filepath = os.path.join(self.getfullname(), filename)
         return os.path.getmtime(filepath)
@@ -307,6 +487,36 @@ class MaildirFolder(BaseFolder):
         Returns: relative path to the temporary file
         that was created."""
 
+        fd, tmpname = self.__write_tmp_file(filename, content)
+        # Make sure the data hits the disk.
+        if self.dofsync():
+            os.fsync(fd)
+        fd.close()
+
+        return tmpname
+
+    def __write_tmp_file(self, filename, content):
+        """Writes content to the named temporary file like
+        save_to_tmp_file(), without syncing it.
+
+        Returns: (open file object, relative path to the temporary file)."""
+
+        fd, tmpname = self.__create_tmp_file(filename)
+        fd = os.fdopen(fd, 'wt')
+        try:
+            fd.write(content)
+            fd.flush()
+        except:
+            fd.close()
+            os.unlink(os.path.join(self.getfullname(), tmpname))
+            raise
+        return fd, tmpname
+
+    def __create_tmp_file(self, filename):
+        """Creates the named temporary file in the 'tmp' subdirectory.
+
+        Returns: (fd, relative path to the temporary file)."""
+
         tmpname = os.path.join('tmp', filename)
         # Open file and write it out.
         # XXX: why do we need to loop 7 times?
@@ -333,15 +543,7 @@ class MaildirFolder(BaseFolder):
                 else:
                     raise
 
-        fd = os.fdopen(fd, 'wt')
-        fd.write(content)
-        # Make sure the data hits the disk.
-        fd.flush()
-        if self.dofsync():
-            os.fsync(fd)
-        fd.close()
-
-        return tmpname
+        return fd, tmpname
 
 
     # Interface from BaseFolder
@@ -366,10 +568,194 @@ class MaildirFolder(BaseFolder):
 
         # Otherwise, save the message in tmp/ and then call savemessageflags()
         # to give it a permanent home.
-        tmpdir = os.path.join(self.getfullname(), 'tmp')
+        message_timestamp = self.__getmessagetimestamp(uid, content)
+        messagename = self.new_message_filename(uid, flags, date=message_timestamp)
+        tmpname = self.save_to_tmp_file(messagename, content)
+        return self.__savetmpmessage(uid, tmpname, content, flags)
+
+    # Interface from BaseFolder
+    def getsavebatchsize(self):
+        return self.repository.getsavebatchsize()
+
+    # Interface from BaseFolder
+    def getsavebatchbytes(self):
+        return self.repository.getsavebatchbytes()
+
+    # Interface from BaseFolder
+    def savemessages(self, messages):
+        """Writes a batch of new messages with a single group commit.
+
+        All the messages are written to tmp/ first, then fsync()ed one
+        after the other, moved to cur/ or new/ and these directories are
+        fsync()ed once. The messages are thus on disk when this returns,
+        before the status is updated, as with savemessage().
+
+        Returns None, to save them one by one, if a message has no UID or
+        exists already."""
+
+        for uid, content, flags, rtime in messages:
+            if uid < 0 or uid in self.messagelist:
+                return None
+        # Messages read from files are written as text like the others.
+        messages = [(uid, emailutil.decode_message(content), flags, rtime)
+                    for uid, content, flags, rtime in messages]
+
+        tmpfiles = []
+        try:
+            for uid, content, flags, rtime in messages:
+                self.ui.savemessage('maildir', uid, flags, self)
+                message_timestamp = self.__getmessagetimestamp(uid, content)
+                messagename = self.new_message_filename(uid, flags,
+                    date=message_timestamp)
+                tmpfiles.append(self.__write_tmp_file(messagename, content))
+            for fd, tmpname in tmpfiles:
+                if self.dofsync():
+                    os.fsync(fd)
+                fd.close()
+        except:
+            for fd, tmpname in tmpfiles:
+                fd.close()
+                os.unlink(os.path.join(self.getfullname(), tmpname))
+            raise
+
+        uids = []
+        for (uid, content, flags, rtime), (fd, tmpname) in \
+                zip(messages, tmpfiles):
+            uids.append(self.__savetmpmessage(uid, tmpname, content, flags))
+        if self.dofsync():
+            for dirannex in set(os.path.dirname(
+                    self.messagelist[uid]['filename']) for uid in uids):
+                dirfd = os.open(os.path.join(self.getfullname(), dirannex),
+                    os.O_RDONLY)
+                try:
+                    os.fsync(dirfd)
+                finally:
+                    os.close(dirfd)
+        return uids
+
+    # Interface from BaseFolder
+    def savemessagefrom(self, uid, fetchmessage, flags, rtime):
+        """Writes a new message, with the specified uid.
+
+        Large messages are written straight to the file in tmp/ by
+        fetchmessage(), see folder/Base for detail."""
+
+        if uid < 0 or uid in self.messagelist:
+            return self.savemessage(uid, fetchmessage(lambda: None), flags,
+                                    rtime)
+
+        # The mail timestamp is not known before the headers are written.
+        tmpfile = []
+        def openfile():
+            fd, tmpname = self.__create_tmp_file(
+                self.new_message_filename(uid, flags))
+            tmpfile.append((tmpname, os.fdopen(fd, 'wt')))
+            return tmpfile[0][1]
+
+        try:
+            content = fetchmessage(openfile)
+            if tmpfile:
+                tmpname, fd = tmpfile[0]
+                fd.flush()
+                if self.dofsync():
+                    os.fsync(fd)
+                fd.close()
+        except:
+            if tmpfile:
+                tmpname, fd = tmpfile[0]
+                fd.close()
+                os.unlink(os.path.join(self.getfullname(), tmpname))
+            raise
+
+        if content is not None:
+            if tmpfile:
+                os.unlink(os.path.join(self.getfullname(), tmpname))
+            return self.savemessage(uid, content, flags, rtime)
+
+        self.ui.savemessage('maildir', uid, flags, self)
+        headers = self.__readheaders(tmpname)
+        message_timestamp = self.__getmessagetimestamp(uid, headers)
+        if message_timestamp is not None:
+            messagename = self.new_message_filename(uid, flags,
+                date=message_timestamp)
+            newtmpname = os.path.join('tmp', messagename)
+            os.rename(os.path.join(self.getfullname(), tmpname),
+                      os.path.join(self.getfullname(), newtmpname))
+            tmpname = newtmpname
+        return self.__savetmpmessage(uid, tmpname, headers, flags)
+
+    # Interface from BaseFolder
+    def replacemessagefrom(self, uid, fetchmessage):
+        """Replaces the content of message uid, see folder/Base for detail.
+
+        The new content is written to tmp/ and moved over the message, which
+        is then renamed so that the scan index notices its new size."""
+
+        filename = self.messagelist[uid]['filename']
+        filepath = os.path.join(self.getfullname(), filename)
+        tmpfile = []
+        def openfile():
+            fd, tmpname = self.__create_tmp_file(os.path.basename(filename))
+            tmpfile.append((tmpname, os.fdopen(fd, 'wt')))
+            return tmpfile[0][1]
+
+        try:
+            content = fetchmessage(openfile)
+            if content is not None:
+                if not tmpfile:
+                    openfile()
+                fd = tmpfile[0][1]
+                fd.seek(0)
+                fd.truncate()
+                fd.write(content)
+            tmpname, fd = tmpfile[0]
+            fd.flush()
+            if self.dofsync():
+                os.fsync(fd)
+            fd.close()
+        except:
+            if tmpfile:
+                tmpname, fd = tmpfile[0]
+                fd.close()
+                os.unlink(os.path.join(self.getfullname(), tmpname))
+            raise
+
+        # Keep the times of the message.
+        st = os.stat(filepath)
+        tmppath = os.path.join(self.getfullname(), tmpname)
+        os.utime(tmppath, (st.st_atime, st.st_mtime))
+        os.rename(tmppath, filepath)
+        message_timestamp = self.__getmessagetimestamp(uid,
+            self.__readheaders(filename))
+        newfilename = os.path.join(os.path.dirname(filename),
+            self.new_message_filename(uid, self.messagelist[uid]['flags'],
+                date=message_timestamp))
+        os.rename(filepath, os.path.join(self.getfullname(), newfilename))
+        if self.dofsync():
+            dirfd = os.open(os.path.dirname(filepath), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        self.messagelist[uid]['filename'] = newfilename
+        self.messagelist[uid]['size'] = None
+        self.ui.debug('maildir', 'replacemessagefrom: replaced uid %d'% uid)
+
+    def __readheaders(self, tmpname):
+        """Returns the header part of the message in tmpname."""
+
+        headers = []
+        with open(os.path.join(self.getfullname(), tmpname), 'rt') as fd:
+            for line in fd:
+                headers.append(line)
+                if line in ('\n', '\r\n'):
+                    break
+        return ''.join(headers)
+
+    def __getmessagetimestamp(self, uid, content):
+        """Returns the mail timestamp to prefix the filename with, given by
+        either Date or Delivery-date mail headers, or None."""
 
-        # Use the mail timestamp given by either Date or Delivery-date mail
-        # headers.
         message_timestamp = None
         if self._filename_use_mail_timestamp is not False:
             try:
@@ -389,8 +775,11 @@ class MaildirFolder(BaseFolder):
                     (uid, datestr, e))
                 # No need to check if message_timestamp is None here since it
                 # would be overridden by _gettimeseq.
-        messagename = self.new_message_filename(uid, flags, date=message_timestamp)
-        tmpname = self.save_to_tmp_file(messagename, content)
+        return message_timestamp
+
+    def __savetmpmessage(self, uid, tmpname, content, flags):
+        """Registers the message saved in tmpname and moves it to its
+        permanent home. Content needs only to hold the headers."""
 
         if self._utime_from_header is True:
             try:
@@ -23,6 +23,7 @@ from threading import Lock
 import six
 
 from offlineimap import OfflineImapError
+from .Base import BaseFolder
 from .IMAP import IMAPFolder
 
 
@@ -173,6 +174,11 @@ class MappedIMAPFolder(IMAPFolder):
                     self.l2r[luid] = ruid
                     self.r2l[ruid] = luid
 
+    # Interface from BaseFolder
+    def cachemessagelist_incremental(self, statusfolder):
+        # The status folder knows about mapped UIDs only.
+        return False
+
     def dropmessagelistcache(self):
         self._mb.dropmessagelistcache()
 
@@ -228,6 +234,15 @@ class MappedIMAPFolder(IMAPFolder):
                 retval[key] = value
             return retval
 
+    # Interface from BaseFolder
+    def getmessagebatches(self, uidlist):
+        batches = self._mb.getmessagebatches([self.r2l[uid] for uid in uidlist])
+        return [[self.l2r[luid] for luid in batch] for batch in batches]
+
+    # Interface from BaseFolder
+    def prefetchmessages(self, uidlist):
+        self._mb.prefetchmessages([self.r2l[uid] for uid in uidlist])
+
     # Interface from BaseFolder
     def getmessage(self, uid):
         """Returns the content of the specified message."""
@@ -281,6 +296,16 @@ class MappedIMAPFolder(IMAPFolder):
             self._savemaps()
         return uid
 
+    # Interface from BaseFolder
+    def savemessagefile(self, uid, msgfile, flags, rtime):
+        # New messages must be mapped by savemessage().
+        return BaseFolder.savemessagefile(self, uid, msgfile, flags, rtime)
+
+    # Interface from BaseFolder
+    def savemessages(self, messages):
+        # New messages must be mapped one by one by savemessage().
+        return None
+
     # Interface from BaseFolder
     def getmessageflags(self, uid):
         return self._mb.getmessageflags(self.r2l[uid])
@@ -353,6 +378,12 @@ class MappedIMAPFolder(IMAPFolder):
         self._mb.deletemessagesflags(self._uidlist(self.r2l, uidlist),
             flags)
 
+    # Interface from BaseFolder
+    def changemessagesflags(self, changes):
+        self._mb.changemessagesflags([(operation,
+            self._uidlist(self.r2l, uidlist), flags)
+            for operation, uidlist, flags in changes])
+
     # Interface from BaseFolder
     def deletemessage(self, uid):
         self._mb.deletemessage(self.r2l[uid])
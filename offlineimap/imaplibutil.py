@@ -15,6 +15,7 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 import os
+import re
 import fcntl
 import time
 import subprocess
@@ -31,6 +32,7 @@ import six
 from offlineimap import OfflineImapError
 from offlineimap.ui import getglobalui
 from offlineimap.virtual_imaplib2 import IMAP4, IMAP4_SSL, InternalDate, Mon2num
+from offlineimap.virtual_imaplib2 import DESC as IMAPLIB_DESC
 
 
 class UsefulIMAPMixIn(object):
@@ -39,15 +41,20 @@ class UsefulIMAPMixIn(object):
             return self.mailbox
         return None
 
+    def isselected(self, mailbox, readonly=False):
+        """Whether mailbox is selected in the readonly mode, so that
+        select() has nothing to do."""
+
+        return self.__getselectedfolder() == mailbox and \
+            self.is_readonly == readonly
+
     def select(self, mailbox='INBOX', readonly=False, force=False):
         """Selects a mailbox on the IMAP server
 
         :returns: 'OK' on success, nothing if the folder was already
         selected or raises an :exc:`OfflineImapError`."""
 
-        if self.__getselectedfolder() == mailbox and \
-            self.is_readonly == readonly and \
-            not force:
+        if self.isselected(mailbox, readonly) and not force:
             # No change; return.
             return
         try:
@@ -71,6 +78,162 @@ class UsefulIMAPMixIn(object):
             raise OfflineImapError(errstr, severity)
         return result
 
+    def literal_plus(self, size):
+        """Whether a literal of size octets may be sent as non-synchronizing
+        literal, i.e. without waiting for the server to accept it.
+
+        Servers announce this with LITERAL+ (any size) or LITERAL- (up to
+        4096 octets), see RFC 7888."""
+
+        if 'LITERAL+' in self.capabilities:
+            return True
+        return 'LITERAL-' in self.capabilities and size <= 4096
+
+    def nonsync_literal(self, data):
+        """Return data as a non-synchronizing literal to be put in a
+        command line, or None if literal_plus() does not allow it."""
+
+        if isinstance(data, bytes):
+            size = len(data)
+        else:
+            size = len(data.encode('utf-8', 'surrogateescape'))
+        if not self.literal_plus(size):
+            return None
+        return "{%d+}\r\n%s"% (size, data)
+
+    def pipeline(self, commands, depth=0):
+        """Run several commands back-to-back on this connection
+
+        The commands are sent without waiting for the previous responses,
+        their responses are matched by tag. Only independent commands for
+        the same selected mailbox may be pipelined.
+
+        :param commands: list of (name, args) of the IMAP4 methods to call,
+            e.g. ('uid', ('store', '1:3', '+FLAGS', '(\\Seen)')).
+        :param depth: maximum number of commands in flight, 0 for no limit.
+        :returns: list of the (typ, dat) responses in the order of commands.
+            If a command raised an error, the first error is raised once
+            all the commands are done."""
+
+        results = [None] * len(commands)
+        errors = []
+        done = threading.Semaphore(0)
+        window = threading.Semaphore(depth) if depth > 0 else None
+
+        def callback(cb_arg_list):
+            response, num, error = cb_arg_list
+            if error is not None:
+                errors.append(error)
+            else:
+                results[num] = response
+            if window is not None:
+                window.release()
+            done.release()
+
+        sent = 0
+        try:
+            for num, (name, args) in enumerate(commands):
+                if window is not None:
+                    window.acquire()
+                getattr(self, name)(*args, callback=callback, cb_arg=num)
+                sent += 1
+        finally:
+            for num in range(sent):
+                done.acquire()
+        if errors:
+            typ, val = errors[0]
+            raise typ(val)
+        return results
+
+    def multistatus(self, mailboxes, names):
+        """Request the status of several mailboxes at once
+
+        All the STATUS commands are sent before waiting for the first
+        response, so that this takes a single round-trip.
+
+        :returns: list of the data of the STATUS responses, mailboxes the
+            server refused are missing."""
+
+        results = []
+        for typ, dat in self.pipeline([('status', (mailbox, names))
+                                       for mailbox in mailboxes]):
+            if typ == 'OK':
+                results.extend([d for d in dat if d is not None])
+        return results
+
+    def liststatus(self, directory, pattern, names):
+        """Request the status of the mailboxes matching pattern with a
+        single LIST command (LIST-STATUS extension, RFC 5819). The caller
+        must check for the LIST-STATUS capability.
+
+        :returns: list of the data of the STATUS responses."""
+
+        typ, dat = self._simple_command('LIST', directory, pattern,
+            "'RETURN (STATUS %s)'"% names)
+        # Don't leave the LIST responses to the next list().
+        self._untagged_response(typ, dat, 'LIST')
+        if typ != 'OK':
+            return []
+        typ, dat = self._untagged_response(typ, dat, 'STATUS')
+        return [d for d in dat if d is not None]
+
+    def multiappend(self, mailbox, messages):
+        """Append several messages to mailbox with a single command
+
+        Implements the MULTIAPPEND extension (RFC 3502), the server appends
+        either all the messages or none of them. The caller must check for
+        the MULTIAPPEND capability and for literalsasbytes().
+        Non-synchronizing literals are used if possible, saving a
+        round-trip per message.
+
+        :param messages: list of (flags, date_time, message) tuples, flags
+            and date_time being an IMAP flag list and a quoted INTERNALDATE
+            string or None, message a string or a LiteralReader.
+        :returns: (typ, [data]) as append()."""
+
+        # Sizes are announced in octets, so measure the encoded messages.
+        literals = [message if isinstance(message, LiteralReader)
+                    else encodeliteral(message)
+                    for flags, date_time, message in messages]
+        nonsync = all([self.literal_plus(len(literal)) for literal in literals])
+        plus = '+' if nonsync else ''
+        heads = []
+        for (flags, date_time, message), literal in zip(messages, literals):
+            head = [arg for arg in (flags, date_time) if arg]
+            head.append("{%d%s}"% (len(literal), plus))
+            heads.append(' '.join(head))
+        # The announce of each message but the first follows the literal of
+        # the previous one.
+        follows = [(' ' + head + '\r\n').encode('ascii') for head in heads[1:]]
+
+        if nonsync:
+            # The whole command goes out at once. The command line holds
+            # the flags and date of the first message, _command() adds the
+            # announce of its literal, which carries the others.
+            first = ' '.join([arg for arg in messages[0][:2] if arg])
+            self.literal = MultiLiteral(literals, follows)
+            try:
+                return self._simple_command('APPEND', mailbox,
+                    "'%s'"% first if first else None)
+            finally:
+                self._release_state_change()
+
+        # Each literal sent on a continuation request is followed by the
+        # announce of the next message.
+        chunks = [(literal, follow[:-2])
+                  for literal, follow in zip(literals[:-1], follows)]
+        chunks.append(literals[-1])
+        chunks = iter(chunks)
+
+        def literator(data, rqb):
+            return next(chunks, None)
+
+        self.literal = literator
+        try:
+            return self._simple_command('APPEND', mailbox, "'%s'"% heads[0])
+        finally:
+            self._release_state_change()
+
     # Overrides private function from IMAP4 (@imaplib2)
     def _mesg(self, s, tn=None, secs=None):
         new_mesg(self, s, tn, secs)
@@ -126,6 +289,9 @@ class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
         if "use_socket" in kwargs:
             self.socket = kwargs['use_socket']
             del kwargs['use_socket']
+        if "shared_io" in kwargs:
+            self.shared_io = kwargs['shared_io']
+            del kwargs['shared_io']
         IMAP4.__init__(self, tunnelcmd, **kwargs)
 
     def open(self, host, port):
@@ -194,6 +360,9 @@ class WrappedIMAP4_SSL(UsefulIMAPMixIn, IMAP4_SSL):
         if "use_socket" in kwargs:
             self.socket = kwargs['use_socket']
             del kwargs['use_socket']
+        if "shared_io" in kwargs:
+            self.shared_io = kwargs['shared_io']
+            del kwargs['shared_io']
         self._fingerprint = kwargs.get('fingerprint', None)
         if type(self._fingerprint) != type([]):
             self._fingerprint = [self._fingerprint]
@@ -234,9 +403,149 @@ class WrappedIMAP4(UsefulIMAPMixIn, IMAP4):
         if "use_socket" in kwargs:
             self.socket = kwargs['use_socket']
             del kwargs['use_socket']
+        if "shared_io" in kwargs:
+            self.shared_io = kwargs['shared_io']
+            del kwargs['shared_io']
         IMAP4.__init__(self, *args, **kwargs)
 
 
+def literalsasbytes():
+    """Whether literals may be passed to imaplib2 as bytes or as sized
+    iterables of bytes, which only the bundled imaplib2 supports."""
+
+    return IMAPLIB_DESC == "bundled"
+
+
+def encodeliteral(message):
+    """Return message as the bytes of an IMAP literal, with CRLF line
+    endings. Messages are decoded with surrogateescape (see
+    emailutil.decode_message), so that this gives back their original
+    bytes."""
+
+    if not isinstance(message, bytes):
+        message = message.encode('utf-8', 'surrogateescape')
+    return LiteralReader.lineend_re.sub(b'\r\n', message)
+
+
+class MultiLiteral(object):
+    """Sized iterable to be passed as the literal of a MULTIAPPEND command
+    sent at once, see UsefulIMAPMixIn.multiappend().
+
+    Its size is the one of the first literal, which the command line
+    announces. Each following literal comes after its announce."""
+
+    def __init__(self, literals, follows):
+        self.literals = literals
+        self.follows = follows
+
+    def __len__(self):
+        return len(self.literals[0])
+
+    def __iter__(self):
+        yield self.literals[0]
+        for follow, literal in zip(self.follows, self.literals[1:]):
+            yield follow
+            yield literal
+
+
+class LiteralWriter(object):
+    """File-like object to be returned by an IMAP4 literal_sink.
+
+    Writes the literal data to fileobj as it is received, converting CRLF
+    line endings to '\\n'. A CR at the end of a chunk is held back until
+    the next chunk tells whether a LF follows."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pending_cr = False
+
+    def write(self, data):
+        if self.pending_cr:
+            data = '\r' + data
+            self.pending_cr = False
+        if data.endswith('\r'):
+            data = data[:-1]
+            self.pending_cr = True
+        self.fileobj.write(data.replace('\r\n', '\n'))
+
+    def restart(self):
+        """Drop the data written so far, e.g. when the literal is sent
+        again after a reconnect."""
+
+        self.pending_cr = False
+        self.fileobj.seek(0)
+        self.fileobj.truncate()
+
+    def flush(self):
+        if self.pending_cr:
+            self.fileobj.write('\r')
+            self.pending_cr = False
+        self.fileobj.flush()
+
+
+class LiteralReader(object):
+    """Sized iterable to be passed to IMAP4.append() as the message.
+
+    Sends prefix, then the rest of fileobj from offset on, converting all
+    line endings to CRLF chunk by chunk, as the literal is written to the
+    socket. Iterating again starts over, e.g. when the message is sent
+    again after a reconnect."""
+
+    chunksize = 65536
+    lineend_re = re.compile(b'\r\n|\r|\n')
+
+    def __init__(self, prefix, fileobj, offset):
+        if not isinstance(prefix, bytes):
+            prefix = prefix.encode('utf-8', 'surrogateescape')
+        self.prefix = prefix
+        self.fileobj = fileobj
+        self.offset = offset
+        self.size = None
+
+    def __len__(self):
+        if self.size is None:
+            self.size = len(self.prefix) + self.__convertedsize()
+        return self.size
+
+    def __convertedsize(self):
+        """Size of the data from offset on once converted, counted in a
+        single pass over a reused buffer."""
+
+        buf = bytearray(self.chunksize)
+        size = crlf = cr = lf = 0
+        pending_cr = False
+        self.fileobj.seek(self.offset)
+        while True:
+            n = self.fileobj.readinto(buf)
+            if not n:
+                break
+            if pending_cr and buf[0:1] == b'\n':
+                crlf += 1 # Split across chunks.
+            size += n
+            crlf += buf.count(b'\r\n', 0, n)
+            cr += buf.count(b'\r', 0, n)
+            lf += buf.count(b'\n', 0, n)
+            pending_cr = buf[n-1:n] == b'\r'
+        # Each lone CR or LF becomes CRLF.
+        return size + (cr - crlf) + (lf - crlf)
+
+    def __iter__(self):
+        self.fileobj.seek(self.offset)
+        yield self.prefix
+        held = b''
+        while True:
+            data = self.fileobj.read(self.chunksize)
+            if not data:
+                break
+            data = held + data
+            held = b''
+            if data.endswith(b'\r'):
+                data, held = data[:-1], b'\r'
+            yield self.lineend_re.sub(b'\r\n', data)
+        if held:
+            yield b'\r\n'
+
+
 def Internaldate2epoch(resp):
     """Convert IMAP4 INTERNALDATE to UT.
 
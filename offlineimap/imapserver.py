@@ -32,6 +32,7 @@ import six
 
 import offlineimap.accounts
 from offlineimap import imaplibutil, imaputil, threadutil, OfflineImapError
+from offlineimap.virtual_imaplib2 import DESC as IMAPLIB_DESC
 from offlineimap.ui import getglobalui
 
 
@@ -50,6 +51,8 @@ class IMAPServer(object):
 
     Public instance variables are: self.:
      delim The server's folder delimiter. Only valid after acquireconnection()
+     selecthits, selectmisses Number of connections acquired for a mailbox
+       which had it selected already, or not.
     """
 
     def __init__(self, repos):
@@ -120,10 +123,21 @@ class IMAPServer(object):
         self.availableconnections = []
         self.assignedconnections = []
         self.lastowner = {}
+        # Acquired connections which had the requested mailbox selected
+        # already, or not.
+        self.selecthits = 0
+        self.selectmisses = 0
         self.semaphore = BoundedSemaphore(self.maxconnections)
         self.connectionlock = Lock()
         self.reference = repos.getreference()
         self.idlefolders = repos.getidlefolders()
+        self.sharedio = repos.getsharedio()
+        if self.sharedio and IMAPLIB_DESC != "bundled":
+            self.ui.warn("Repository '%s': sharedio requires the bundled "
+                "imaplib2, ignoring it with the %s one."%
+                (repos.getname(), IMAPLIB_DESC))
+            self.sharedio = False
+        self.pipelinedepth = repos.getpipelinedepth()
         self.gss_vc = None
         self.gssapi = False
 
@@ -503,11 +517,15 @@ class IMAPServer(object):
 
         return ('%s no matching domain name found in certificate'% errstr)
 
-    def acquireconnection(self):
+    def acquireconnection(self, mailbox=None, readonly=False):
         """Fetches a connection from the pool, making sure to create a new one
         if needed, to obey the maximum connection limits, etc.
         Opens a connection to the server and returns an appropriate
-        object."""
+        object.
+
+        :param mailbox: the mailbox the caller is about to select, in the
+            readonly mode. A connection which has it selected this way
+            already is preferred to save the SELECT."""
 
         self.semaphore.acquire()
         self.connectionlock.acquire()
@@ -515,23 +533,40 @@ class IMAPServer(object):
         imapobj = None
 
         if len(self.availableconnections): # One is available.
-            # Try to find one that previously belonged to this thread
-            # as an optimization.  Start from the back since that's where
-            # they're popped on.
-            for i in range(len(self.availableconnections) - 1, -1, -1):
-                tryobj = self.availableconnections[i]
-                if self.lastowner[tryobj] == curThread.ident:
-                    imapobj = tryobj
-                    del(self.availableconnections[i])
-                    break
+            # Try to find one that has the mailbox selected already, or else
+            # one that previously belonged to this thread as an
+            # optimization.  Start from the back since that's where they're
+            # popped on.
+            if mailbox is not None:
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if tryobj.isselected(mailbox, readonly):
+                        imapobj = tryobj
+                        del(self.availableconnections[i])
+                        break
+            if not imapobj:
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if self.lastowner[tryobj] == curThread.ident:
+                        imapobj = tryobj
+                        del(self.availableconnections[i])
+                        break
             if not imapobj:
                 imapobj = self.availableconnections[0]
                 del(self.availableconnections[0])
             self.assignedconnections.append(imapobj)
             self.lastowner[imapobj] = curThread.ident
+            if mailbox is not None:
+                if imapobj.isselected(mailbox, readonly):
+                    self.selecthits += 1
+                else:
+                    self.selectmisses += 1
             self.connectionlock.release()
             return imapobj
 
+        if mailbox is not None:
+            # A new connection has nothing selected.
+            self.selectmisses += 1
         self.connectionlock.release()   # Release until need to modify data
 
         # Must be careful here that if we fail we should bail out gracefully
@@ -547,6 +582,7 @@ class IMAPServer(object):
                         self.tunnel,
                         timeout=socket.getdefaulttimeout(),
                         use_socket=self.proxied_socket,
+                        shared_io=self.sharedio,
                         )
                     success = True
                 elif self.usessl:
@@ -567,6 +603,7 @@ class IMAPServer(object):
                         use_socket=self.proxied_socket,
                         tls_level=self.tlslevel,
                         af=self.af,
+                        shared_io=self.sharedio,
                         )
                 else:
                     self.ui.connecting(
@@ -576,6 +613,7 @@ class IMAPServer(object):
                         timeout=socket.getdefaulttimeout(),
                         use_socket=self.proxied_socket,
                         af=self.af,
+                        shared_io=self.sharedio,
                         )
 
                 if not self.preauth_tunnel:
@@ -705,6 +743,8 @@ class IMAPServer(object):
             self.assignedconnections = []
             self.availableconnections = []
             self.lastowner = {}
+            self.ui.debug('imap', "SELECT hits: %d, misses: %d"%
+                (self.selecthits, self.selectmisses))
             # reset GSSAPI state
             self.gss_vc = None
             self.gssapi = False
@@ -769,6 +809,15 @@ class IMAPServer(object):
         self.connectionlock.release()
         self.semaphore.release()
 
+    def pipeline(self, connection, commands):
+        """Runs independent commands for the selected mailbox of an
+        acquired connection back-to-back, with at most pipelinedepth of
+        them in flight.
+
+        :returns: list of the (typ, dat) responses in the order of commands."""
+
+        return connection.pipeline(commands, self.pipelinedepth)
+
 
 class IdleThread(object):
     def __init__(self, parent, folder=None):
@@ -825,7 +874,8 @@ class IdleThread(object):
 
         hook = account.getconf('presynchook', '')
         account.callhook(hook)
-        offlineimap.accounts.syncfolder(account, remotefolder, quick=False)
+        offlineimap.accounts.syncfolder(account, remotefolder, quick=False,
+            force=True)
         hook = account.getconf('postsynchook', '')
         account.callhook(hook)
 
@@ -868,7 +918,7 @@ class IdleThread(object):
 
             success = False # Successfully selected FOLDER?
             while not success:
-                imapobj = self.parent.acquireconnection()
+                imapobj = self.parent.acquireconnection(self.folder)
                 try:
                     imapobj.select(self.folder)
                 except OfflineImapError as e:
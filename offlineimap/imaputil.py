@@ -252,6 +252,26 @@ def uid_sequence(uidlist):
     return ",".join(retval)
 
 
+def uid_sequence_expand(sequence):
+    """Expand a sequence set into the list of UIDs it contains
+
+    "1:5,10,12:13" will return [1,2,3,4,5,10,12,13]. This is the inverse
+    of uid_sequence(). Open ranges ('*') are not supported.
+    :returns: The sorted list of UIDs."""
+
+    uids = set()
+    for item in sequence.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if ':' in item:
+            start, end = sorted(map(int, item.split(':', 1)))
+            uids.update(range(start, end + 1))
+        else:
+            uids.add(int(item))
+    return sorted(uids)
+
+
 def __split_quoted(s):
     """Looks for the ending quote character in the string that starts
     with quote character, splitting out quoted component and the
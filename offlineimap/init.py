@@ -97,6 +97,8 @@ class OfflineImap(object):
             mbnames.write()
         elif options.deletefolder:
             return self.__deletefolder(options)
+        elif options.hydrate or options.hydrate_uids:
+            return self.__hydrate(options)
         else:
             return self.__sync(options)
 
@@ -179,6 +181,16 @@ class OfflineImap(object):
                   metavar="FOLDERNAME",
                   help="Delete a folder (on the remote repository)")
 
+        parser.add_option("--hydrate",
+                  action="store_true", dest="hydrate", default=False,
+                  help="download the bodies of the stub messages of the "
+                  "folders given with -f (default: all folders)")
+
+        parser.add_option("--hydrate-uids", dest="hydrate_uids",
+                  default=None,
+                  metavar="uid1[,uid2[,...]]",
+                  help="like --hydrate, for the messages with these UIDs only")
+
         parser.add_option("--migrate-fmd5-using-nametrans",
                   action="store_true", dest="migrate_fmd5", default=False,
                   help="migrate FMD5 hashes from versions prior to 6.3.5")
@@ -530,6 +542,20 @@ class OfflineImap(object):
         account = accounts.Account(self.config, list_accounts.pop())
         return account.deletefolder(options.deletefolder)
 
+    def __hydrate(self, options):
+        uids = None
+        if options.hydrate_uids:
+            try:
+                uids = set(int(uid) for uid in options.hydrate_uids.split(","))
+            except ValueError:
+                self.ui.error("invalid list of UIDs '%s'"% options.hydrate_uids)
+                return 1
+        result = 0
+        for accountname in self._get_activeaccounts(options):
+            account = accounts.SyncableAccount(self.config, accountname)
+            result |= account.hydrate(uids)
+        return result
+
     def __migratefmd5(self, options):
         for accountname in self._get_activeaccounts(options):
             account = accounts.Account(self.config, accountname)
@@ -137,6 +137,12 @@ class BaseRepository(CustomConfig.ConfigHelperMixin):
 
         pass
 
+    def cachefolderfingerprints(self):
+        """Fetches the state of all the folders at once for their
+        quickchanged() check, if the backend supports it."""
+
+        pass
+
     def getsep(self):
         raise NotImplementedError
 
@@ -372,6 +372,36 @@ class IMAPRepository(BaseRepository):
     def getexpunge(self):
         return self.getconfboolean('expunge', True)
 
+    def getcondstore(self):
+        return self.getconfboolean('usecondstore', False)
+
+    def getfetchbatchsize(self):
+        return self.getconfint('fetchbatchsize', 1)
+
+    def getfetchbatchbytes(self):
+        return self.getconfint('fetchbatchbytes', 10000000)
+
+    def getappendbatchsize(self):
+        return self.getconfint('appendbatchsize', 1)
+
+    def getappendbatchbytes(self):
+        return self.getconfint('appendbatchbytes', 10000000)
+
+    def getstreamthreshold(self):
+        return self.getconfint('streamthreshold', 0)
+
+    def getlargemessagesize(self):
+        return self.getconfint('largemessagesize', 0)
+
+    def getstatusfingerprint(self):
+        return self.getconfboolean('usestatusfingerprint', False)
+
+    def getsharedio(self):
+        return self.getconfboolean('sharedio', False)
+
+    def getpipelinedepth(self):
+        return self.getconfint('pipelinedepth', 1)
+
     def getpassword(self):
         """Return the IMAP password for this repository.
 
@@ -521,6 +551,67 @@ class IMAPRepository(BaseRepository):
         self.folders = retval
         return self.folders
 
+    def cachefolderfingerprints(self):
+        """Ask the server for the state of all the folders at once.
+
+        The UIDVALIDITY, UIDNEXT, MESSAGES and HIGHESTMODSEQ of each folder
+        are handed to the folder, which compares them to the state saved at
+        the last sync in quickchanged() instead of selecting itself. This
+        takes a single LIST command if the server supports LIST-STATUS,
+        else the STATUS commands are sent at once."""
+
+        if not self.getstatusfingerprint():
+            return
+        folders = [f for f in self.getfolders() if f.sync_this]
+        if not folders:
+            return
+
+        imapobj = self.imapserver.acquireconnection()
+        # NB: see IMAPFolder.savemessage() about releasing imapobj.
+        try:
+            names = ['UIDVALIDITY', 'UIDNEXT', 'MESSAGES']
+            if 'CONDSTORE' in imapobj.capabilities:
+                names.append('HIGHESTMODSEQ')
+            names = '(%s)'% ' '.join(names)
+            if 'LIST-STATUS' in imapobj.capabilities:
+                statuses = imapobj.liststatus(self.imapserver.reference,
+                    '"*"', names)
+            else:
+                statuses = imapobj.multistatus(
+                    [f.getfullIMAPname() for f in folders], names)
+        except imapobj.abort:
+            # The folders select themselves in quickchanged() then.
+            self.imapserver.releaseconnection(imapobj, True)
+            imapobj = None
+            return
+        except imapobj.error as e:
+            self.ui.debug('imap', "cachefolderfingerprints: STATUS of the "
+                "folders failed: %s"% e)
+            return
+        finally:
+            if imapobj:
+                self.imapserver.releaseconnection(imapobj)
+
+        fingerprints = {}
+        for status in statuses:
+            # Names sent as literals come as tuples, ignore them.
+            if not isinstance(status, str):
+                continue
+            try:
+                name, items = imaputil.imapsplit(status)
+            except ValueError:
+                continue
+            items = imaputil.flags2hash(items)
+            if not ('UIDVALIDITY' in items and 'UIDNEXT' in items and
+                    'MESSAGES' in items):
+                continue
+            fingerprints[imaputil.dequote(name)] = ' '.join([items.get(key, '0')
+                for key in ('UIDVALIDITY', 'UIDNEXT', 'MESSAGES',
+                            'HIGHESTMODSEQ')])
+        for imapfolder in folders:
+            imapfolder.setfingerprint(
+                fingerprints.get(imapfolder.getfullIMAPname()))
+
     def deletefolder(self, foldername):
         """Delete a folder on the IMAP server."""
 
@@ -16,9 +16,12 @@
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
 import os
+from collections import OrderedDict
 
 from offlineimap.folder.LocalStatus import LocalStatusFolder
 from offlineimap.folder.LocalStatusSQLite import LocalStatusSQLiteFolder
+from offlineimap.folder.LocalStatusSQLiteAccount import \
+    LocalStatusSQLiteAccountFolder
 from offlineimap.repository.Base import BaseRepository
 from offlineimap.error import OfflineImapError
 
@@ -27,12 +30,17 @@ class LocalStatusRepository(BaseRepository):
     def __init__(self, reposname, account):
         BaseRepository.__init__(self, reposname, account)
 
-        # class and root for all backends.
-        self.backends = {}
+        # class and root for all backends, in the order they are looked
+        # up by import_other_backend().
+        self.backends = OrderedDict()
         self.backends['sqlite'] = {
             'class': LocalStatusSQLiteFolder,
             'root': os.path.join(account.getaccountmeta(), 'LocalStatus-sqlite')
         }
+        self.backends['sqlite-account'] = {
+            'class': LocalStatusSQLiteAccountFolder,
+            'root': account.getaccountmeta()
+        }
         self.backends['plain'] = {
             'class': LocalStatusFolder,
             'root': os.path.join(account.getaccountmeta(), 'LocalStatus')
@@ -45,7 +53,10 @@ class LocalStatusRepository(BaseRepository):
                 OfflineImapError.ERROR.REPO
             )
         # Set class and root for sqlite.
-        self.setup_backend('sqlite')
+        if self.account.getconfboolean('accountstatusdb', False):
+            self.setup_backend('sqlite-account')
+        else:
+            self.setup_backend('sqlite')
 
         if not os.path.exists(self.root):
             os.mkdir(self.root, 0o700)
@@ -63,6 +74,13 @@ class LocalStatusRepository(BaseRepository):
             self.LocalStatusFolderClass = self.backends[backend]['class']
 
     def import_other_backend(self, folder):
+        """Import the data of folder from the first other backend which
+        has it, then remove it there, so that it cannot be imported again
+        once stale.
+
+        Returns the folder to use: in dry-run mode nothing is imported and
+        the folder of the other backend is returned as is."""
+
         for bk, dic in self.backends.items():
             # Skip folder's own type.
             if dic['class'] == type(folder):
@@ -74,14 +92,53 @@ class LocalStatusRepository(BaseRepository):
 
             # If backend contains data, import it to folder.
             if not folderbk.isnewfolder():
+                if self.account.dryrun:
+                    self.ui._msg("Would migrate LocalStatus cache from %s "
+                        "to %s status folder for %s:%s"%
+                        (bk, self._backend, self.name, folder.name))
+                    return folderbk
+
                 self.ui._msg("Migrating LocalStatus cache from %s to %s "
                     "status folder for %s:%s"%
                     (bk, self._backend, self.name, folder.name))
 
-                folderbk.cachemessagelist()
-                folder.messagelist = folderbk.messagelist
-                folder.saveall()
+                folderbk.openfiles()
+                try:
+                    folderbk.cachemessagelist()
+                    messagelist = dict(folderbk.getmessagelist().items())
+                    highestmodseq = folderbk.get_highestmodseq()
+                    fingerprint = folderbk.get_fingerprint()
+                    lastsync = folderbk.get_lastsync()
+                finally:
+                    folderbk.closefiles()
+
+                folder.openfiles()
+                try:
+                    folder.messagelist = messagelist
+                    folder.saveall()
+                    if highestmodseq is not None:
+                        folder.save_highestmodseq(highestmodseq)
+                    if fingerprint is not None:
+                        folder.save_fingerprint(fingerprint)
+                    if lastsync is not None:
+                        folder.save_lastsync(lastsync)
+                finally:
+                    folder.closefiles()
+                folderbk.purge()
                 break
+        return folder
+
+    def getstatusdurability(self):
+        durability = self.account.getconf('statusdurability', 'normal').lower()
+        if durability not in ('full', 'normal'):
+            raise OfflineImapError("invalid statusdurability value '%s' for "
+                "account '%s', use 'full' or 'normal'"%
+                (durability, self.account.getname()),
+                OfflineImapError.ERROR.REPO)
+        return durability
+
+    def getlazystatus(self):
+        return self.account.getconfboolean('lazystatus', False)
 
     def getsep(self):
         return '.'
@@ -117,7 +174,7 @@ class LocalStatusRepository(BaseRepository):
 
         # If folder is empty, try to import data from an other backend.
         if folder.isnewfolder():
-            self.import_other_backend(folder)
+            folder = self.import_other_backend(folder)
 
         self._folders[foldername] = folder
         return folder
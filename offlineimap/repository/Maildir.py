@@ -39,6 +39,19 @@ class MaildirRepository(BaseRepository):
         if not os.path.isdir(self.root):
             os.makedirs(self.root, 0o700)
 
+        # Directory of the scan indexes of the folders.
+        self.scanindexdir = None
+        if self.getconfboolean('scanindex', False):
+            self.scanindexdir = os.path.join(self.config.getmetadatadir(),
+                'Repository-' + self.name, 'ScanIndex')
+            if not os.path.exists(self.scanindexdir):
+                os.mkdir(self.scanindexdir, 0o700)
+        # Scan indexes kept in memory between syncs by the warm cache.
+        self.scanindexes = None
+        if self.scanindexdir is not None and \
+                self.account.getconfboolean('warmcache', False):
+            self.scanindexes = {}
+
         # Create the keyword->char mapping
         self.keyword2char = dict()
         for c in 'abcdefghijklmnopqrstuvwxyz':
@@ -80,6 +93,18 @@ class MaildirRepository(BaseRepository):
     def getsep(self):
         return self.getconf('sep', '.').strip()
 
+    def getscanindexdir(self):
+        return self.scanindexdir
+
+    def getscanindexes(self):
+        return self.scanindexes
+
+    def getsavebatchsize(self):
+        return self.getconfint('savebatchsize', 1)
+
+    def getsavebatchbytes(self):
+        return self.getconfint('savebatchbytes', 10000000)
+
     def getkeywordmap(self):
         return self.keyword2char if len(self.keyword2char) > 0 else None
 
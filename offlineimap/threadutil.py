@@ -15,11 +15,12 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from threading import Lock, Thread, BoundedSemaphore, currentThread
+from threading import Lock, Thread, BoundedSemaphore, Condition, current_thread
 try:
     from Queue import Queue, Empty
 except ImportError: # python3
     from queue import Queue, Empty
+import time
 import traceback
 import os.path
 from offlineimap.ui import getglobalui
@@ -192,6 +193,7 @@ class ExitNotifyThread(Thread):
 ######################################################################
 
 limitedNamespaces = {}
+instanceLimits = {}
 
 def initInstanceLimit(limitNamespace, instancemax):
     """Initialize the instance-limited thread implementation.
@@ -203,6 +205,7 @@ def initInstanceLimit(limitNamespace, instancemax):
 
     if not limitNamespace in limitedNamespaces:
         limitedNamespaces[limitNamespace] = BoundedSemaphore(instancemax)
+        instanceLimits[limitNamespace] = instancemax
 
 
 class InstanceLimitedThread(ExitNotifyThread):
@@ -225,3 +228,111 @@ class InstanceLimitedThread(ExitNotifyThread):
         finally:
             if limitedNamespaces and limitedNamespaces[self.limitNamespace]:
                 limitedNamespaces[self.limitNamespace].release()
+
+
+######################################################################
+# Worker pools
+######################################################################
+
+workerPools = {}
+workerPoolsLock = Lock()
+
+def getWorkerPool(limitNamespace):
+    """Return the WorkerPool of limitNamespace, with as many workers as
+    instance-limited threads are allowed in this namespace.
+
+    The pool is created on first use and its workers are shared by all
+    the folders of the namespace."""
+
+    with workerPoolsLock:
+        if not limitNamespace in workerPools:
+            workerPools[limitNamespace] = WorkerPool(limitNamespace,
+                instanceLimits.get(limitNamespace, 1))
+        return workerPools[limitNamespace]
+
+
+class JobGroup(object):
+    """Jobs submitted to a WorkerPool together, to wait for all of them."""
+
+    def __init__(self):
+        self.cond = Condition()
+        self.pending = 0
+        self.done = 0
+        self.starttime = time.time()
+
+    def add(self):
+        with self.cond:
+            self.pending += 1
+
+    def finish(self):
+        with self.cond:
+            self.pending -= 1
+            self.done += 1
+            if self.pending == 0:
+                self.cond.notify_all()
+
+    def wait(self):
+        """Block until all the jobs of the group are done.
+
+        :returns: the number of jobs done per second since the group was
+            created."""
+
+        with self.cond:
+            while self.pending > 0:
+                self.cond.wait()
+            elapsed = time.time() - self.starttime
+            return self.done / elapsed if elapsed > 0 else 0.0
+
+
+class WorkerPool(object):
+    """A fixed number of ExitNotifyThread workers running the jobs of a
+    bounded queue.
+
+    submit() blocks while the queue is full, so that the producer does not
+    run ahead of the workers. Workers are started on demand and live for
+    the whole run. A job raising an exception ends its worker like any
+    other ExitNotifyThread, which is reported by the monitor."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = max(size, 1)
+        self.queue = Queue(self.size)
+        self.lock = Lock()
+        self.workers = []
+        self.count = 0
+        self.maxqueued = 0
+
+    def __startworker(self):
+        self.count += 1
+        worker = ExitNotifyThread(target=self.__work,
+            name="Worker %d of %s"% (self.count, self.name))
+        self.workers.append(worker)
+        worker.start()
+
+    def __work(self):
+        try:
+            while True:
+                group, target, args, kwargs = self.queue.get()
+                try:
+                    target(*args, **kwargs)
+                finally:
+                    group.finish()
+        finally:
+            with self.lock:
+                self.workers.remove(current_thread())
+
+    def submit(self, group, target, *args, **kwargs):
+        """Queue target(*args, **kwargs) as a job of group."""
+
+        group.add()
+        with self.lock:
+            if len(self.workers) < self.size:
+                self.__startworker()
+        self.queue.put((group, target, args, kwargs))
+        self.maxqueued = max(self.maxqueued, self.queue.qsize())
+
+    def qsize(self):
+        """Number of jobs waiting for a worker."""
+
+        return self.queue.qsize()
+
@@ -364,9 +364,9 @@ class UIBase(object):
             self.getnicename(srcrepos),
             self.getnicename(destrepos)))
 
-    def skippingfolder(self, folder):
-        """Called when a folder sync operation is started."""
-        self.logger.info("Skipping %s (not changed)" % folder)
+    def skippingfolder(self, folder, reason="not changed"):
+        """Called when a folder sync operation is skipped."""
+        self.logger.info("Skipping %s (%s)" % (folder, reason))
 
     def validityproblem(self, folder):
         self.uidval_problem = True
@@ -0,0 +1,64 @@
+# Test accounts of the unit tests
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+
+import six
+
+from offlineimap import accounts
+from offlineimap.CustomConfig import CustomConfigParser
+from offlineimap.ui import UI_LIST, setglobalui
+
+account_conf = """
+[general]
+metadata = %(dir)s/meta
+accounts = Test
+dry-run = %(dryrun)s
+
+[Account Test]
+localrepository = Local
+remoterepository = Remote
+%(account)s
+
+[Repository Local]
+type = Maildir
+localfolders = %(dir)s/mail
+%(local)s
+
+[Repository Remote]
+type = IMAP
+remotehost = localhost
+remoteuser = user
+remotepass = pass
+"""
+
+def make_account(tmpdir, dryrun=False, account="", local=""):
+    """Return an account keeping its metadata under tmpdir, with the lines
+    of account and local added to the configuration of the account and of
+    its Maildir repository."""
+
+    config = CustomConfigParser()
+    text = account_conf % {'dir': tmpdir, 'dryrun': dryrun,
+        'account': account, 'local': local}
+    if six.PY2:
+        config.readfp(six.StringIO(text))
+    else:
+        config.read_string(text)
+    setglobalui(UI_LIST['quiet'](config))
+    account = accounts.Account(config, 'Test')
+    if not os.path.exists(account.getaccountmeta()):
+        os.makedirs(account.getaccountmeta())
+    return account
@@ -15,7 +15,7 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-__all__ = ['OLITestLib', 'TextTestRunner','TestLoader']
+__all__ = ['OLITestLib', 'TextTestRunner','TestLoader', 'make_account']
 
 __productname__ = 'OfflineIMAP Test suite'
 __version__     = '0'
@@ -32,3 +32,4 @@ import unittest
 from unittest import TestLoader, TextTestRunner
 from .globals import default_conf
 from .TestRunner import OLITestLib
+from .Account import make_account
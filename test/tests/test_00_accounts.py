@@ -0,0 +1,177 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+from offlineimap import accounts
+from test.OLItest import make_account
+
+
+class Folder(object):
+    """Folder known by its name only."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def getname(self):
+        return self.name
+
+    def getrepository(self):
+        return Folder('Repository')
+
+    def __repr__(self):
+        return self.name
+
+
+class TestFolderScheduler(unittest.TestCase):
+    """Test accounts.FolderScheduler"""
+
+    names = ['Archive', 'Big', 'INBOX', 'Lists', 'Sent', 'Small']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def order(self, scheduler, stats={}):
+        scheduler.stats = stats
+        return [folder.getname() for folder in
+                scheduler.order([Folder(name) for name in self.names])]
+
+    def test_01_priorityfolders(self):
+        """The priority folders come first, in their order"""
+        scheduler = accounts.FolderScheduler(make_account(self.tmpdir,
+            account="priorityfolders = Sent, INBOX"))
+        stats = {'Small': {'seconds': 0.0, 'rate': 1000.0, 'synced': 0}}
+        self.assertEqual(self.order(scheduler, stats)[:3],
+            ['Sent', 'INBOX', 'Small'])
+        # Without stats, the others keep their order.
+        self.assertEqual(self.order(scheduler),
+            ['Sent', 'INBOX', 'Archive', 'Big', 'Lists', 'Small'])
+
+    def test_02_weights(self):
+        """The folderpriority weights and the changes per hour raise the
+        urgency, the sync time lowers it"""
+        scheduler = accounts.FolderScheduler(make_account(self.tmpdir,
+            account="folderpriority = "
+                "lambda name: 10 if name == 'Lists' else 0"))
+        now = time.time()
+        stats = {
+            'Archive': {'seconds': 1.0, 'rate': 4.0, 'synced': now},
+            'Big': {'seconds': 99.0, 'rate': 50.0, 'synced': now},
+            'Small': {'seconds': 1.0, 'rate': 2.0, 'synced': now},
+        }
+        # Lists: 10, Archive: 4 / 2, Small: 2 / 2, Big: 50 / 100.
+        self.assertEqual(self.order(scheduler, stats),
+            ['INBOX', 'Lists', 'Archive', 'Small', 'Big', 'Sent'])
+
+    def test_03_age(self):
+        """A folder put off for long comes first"""
+        scheduler = accounts.FolderScheduler(make_account(self.tmpdir,
+            account="folderpriority = "
+                "lambda name: 10 if name == 'Lists' else 0"))
+        now = time.time()
+        stats = {
+            'Archive': {'seconds': 99.0, 'rate': 0.0,
+                        'synced': now - 30 * 24 * 3600},
+            'Small': {'seconds': 1.0, 'rate': 2.0, 'synced': now},
+        }
+        # Archive: 720 hours / 100.
+        self.assertEqual(self.order(scheduler, stats)[:4],
+            ['INBOX', 'Lists', 'Archive', 'Small'])
+        # Its urgency grows as long as it is not synced.
+        stats['Archive']['synced'] = now - 2 * 24 * 3600
+        self.assertEqual(self.order(scheduler, stats)[:4],
+            ['INBOX', 'Lists', 'Small', 'Archive'])
+
+    def test_04_record(self):
+        """The history of the syncs is saved and read back"""
+        account = make_account(self.tmpdir)
+        scheduler = accounts.FolderScheduler(account)
+        scheduler.record('Small', 0, 4.0)
+        scheduler.stats['Small']['synced'] -= 3600
+        scheduler.record('Small', 10, 2.0)
+        scheduler.save()
+        with open(scheduler.filename) as statsfd:
+            stat = json.load(statsfd)['Small']
+        self.assertEqual(stat['seconds'], 3.0)
+        self.assertAlmostEqual(stat['rate'], 10.0, places=2)
+        scheduler = accounts.FolderScheduler(account)
+        self.assertEqual(scheduler.order([Folder('Small')])[0].getname(),
+            'Small')
+        self.assertEqual(scheduler.stats['Small'], stat)
+
+
+class TestWarmCache(unittest.TestCase):
+    """Test accounts.WarmCache"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = accounts.WarmCache(make_account(self.tmpdir,
+            account="warmcachesize = 10"))
+        self.dropped = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def keep(self, folder, size):
+        self.cache.keep(folder, size,
+            lambda: self.dropped.append(folder.getname()))
+
+    def test_01_take(self):
+        """Only the very folder instance kept is taken back"""
+        folder = Folder('A')
+        self.assertFalse(self.cache.take(folder))
+        self.keep(folder, 4)
+        self.assertTrue(self.cache.take(folder))
+        self.assertFalse(self.cache.take(folder))
+        self.keep(folder, 4)
+        self.assertFalse(self.cache.take(Folder('A')))
+        self.assertEqual(self.cache.size, 0)
+        self.assertEqual(self.dropped, [])
+
+    def test_02_eviction(self):
+        """The folders kept the longest time ago are dropped first"""
+        folders = dict((name, Folder(name)) for name in 'ABCD')
+        for name in 'ABC':
+            self.keep(folders[name], 4)
+        self.assertEqual(self.dropped, ['A'])
+        self.assertEqual(self.cache.size, 8)
+        # B is synced again, C is now the oldest.
+        self.assertTrue(self.cache.take(folders['B']))
+        self.keep(folders['B'], 4)
+        self.keep(folders['D'], 4)
+        self.assertEqual(self.dropped, ['A', 'C'])
+        self.assertEqual(self.cache.size, 8)
+        # A folder larger than the cache doesn't stay.
+        self.keep(folders['A'], 11)
+        self.assertEqual(self.dropped, ['A', 'C', 'B', 'D', 'A'])
+        self.assertEqual(self.cache.size, 0)
+
+    def test_03_syncing(self):
+        """A folder taken out for its sync is not dropped"""
+        folders = dict((name, Folder(name)) for name in 'ABC')
+        self.keep(folders['A'], 4)
+        self.assertTrue(self.cache.take(folders['A']))
+        self.keep(folders['B'], 6)
+        self.keep(folders['C'], 4)
+        self.assertEqual(self.dropped, [])
+        self.keep(folders['A'], 4)
+        self.assertEqual(self.dropped, ['B'])
@@ -0,0 +1,61 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import io
+import unittest
+
+from offlineimap import emailutil
+
+
+class TestStub(unittest.TestCase):
+    """Test emailutil.make_stub() and emailutil.is_stub()"""
+
+    headers = ("Subject: s\n"
+        "Content-Type: multipart/mixed;\n"
+        "\tboundary=b\n"
+        "Content-Transfer-Encoding: 7bit\n"
+        "To: a@example.com,\n"
+        " b@example.com\n")
+
+    def test_01_make_stub(self):
+        """The stub keeps the headers not describing the body"""
+        stub = emailutil.make_stub(self.headers, 1234)
+        headers, body = stub.split('\n\n', 1)
+        self.assertEqual(headers.split('\n'), [
+            "Subject: s",
+            "To: a@example.com,",
+            " b@example.com",
+            "%s: 1234"% emailutil.STUB_HEADER])
+        self.assertTrue('--hydrate' in body)
+        self.assertTrue(emailutil.make_stub(self.headers).endswith(
+            "%s: unknown\n\n"% emailutil.STUB_HEADER + body))
+
+    def test_02_is_stub(self):
+        """Only the header part of a message is looked at"""
+        self.assertTrue(emailutil.is_stub(emailutil.make_stub(self.headers)))
+        self.assertTrue(emailutil.is_stub(
+            "subject: s\nx-offlineimap-stub: 10\n"))
+        self.assertFalse(emailutil.is_stub(self.headers))
+        self.assertFalse(emailutil.is_stub(
+            self.headers + "\n%s: 10\n"% emailutil.STUB_HEADER))
+
+    def test_03_read_headers(self):
+        """The headers are read up to the blank line"""
+        stub = emailutil.make_stub(self.headers, 10).encode('utf-8')
+        msgfile = io.BytesIO(stub.replace(b'\n', b'\r\n'))
+        headers = emailutil.read_headers(msgfile)
+        self.assertTrue(emailutil.is_stub(headers))
+        self.assertFalse('\r' in headers)
+        self.assertTrue(msgfile.read().startswith(b'The body'))
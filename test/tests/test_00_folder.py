@@ -0,0 +1,155 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import random
+import unittest
+
+from offlineimap.folder.Base import MessageList, SyncPlan, flagmask
+
+
+class FakeFolder(object):
+    """Folder holding the flags of its messages, by UID, in a MessageList.
+
+    With masks False, it doesn't give the flag masks to SyncPlan."""
+
+    def __init__(self, messages, masks=True):
+        self.messagelist = MessageList()
+        for uid, flags in messages.items():
+            self.messagelist[uid] = {'uid': uid, 'flags': set(flags)}
+        self.masks = masks
+
+    def getrepository(self):
+        return self
+
+    def getkeywordmap(self):
+        return None
+
+    def getmessageuidlist(self):
+        return sorted(self.messagelist)
+
+    def getmessageflagmasks(self):
+        if self.masks:
+            return self.messagelist.flagmasks()
+        return None
+
+    def uidexists(self, uid):
+        return uid in self.messagelist
+
+    def getmessageflags(self, uid):
+        return self.messagelist[uid]['flags']
+
+    def combine_flags_and_keywords(self, uid, dstfolder):
+        return set(self.getmessageflags(uid))
+
+
+class TestMessageList(unittest.TestCase):
+    """Test offlineimap.folder.Base.MessageList"""
+
+    def test_01_mapping(self):
+        """UIDs added in any order are found, counted and iterated sorted"""
+        uids = list(range(-5, 2000))
+        random.Random(1).shuffle(uids)
+        messagelist = MessageList()
+        for uid in uids:
+            messagelist[uid] = {'uid': uid}
+        self.assertEqual(len(messagelist), len(uids))
+        self.assertEqual(list(messagelist), sorted(uids))
+        for uid in uids[:500]:
+            del messagelist[uid]
+        self.assertEqual(list(messagelist), sorted(uids[500:]))
+        for uid in uids[:500]:
+            self.assertFalse(uid in messagelist)
+            self.assertRaises(KeyError, messagelist.__getitem__, uid)
+            self.assertRaises(KeyError, messagelist.__delitem__, uid)
+        for uid in uids[500:]:
+            self.assertEqual(messagelist[uid]['uid'], uid)
+        messagelist[uids[0]] = {'uid': uids[0]}
+        self.assertEqual(len(messagelist), len(uids) - 499)
+
+    def test_02_fields(self):
+        """Values of all kinds read back as they were stored"""
+        messagelist = MessageList()
+        item = {'uid': 1, 'flags': set('FS'), 'time': 2 ** 70,
+                'mtime': 1.5, 'size': 10, 'filename': 'a:2,FS',
+                'labels': set(['a', 'b'])}
+        messagelist[1] = item
+        messagelist[2] = {'uid': 2, 'flags': set(['S', '$Junk'])}
+        self.assertEqual(dict(messagelist[1]), item)
+        self.assertEqual(messagelist[2]['flags'], set(['S', '$Junk']))
+        messagelist[1] = {'uid': 1}
+        self.assertEqual(dict(messagelist[1]), {'uid': 1})
+        self.assertRaises(KeyError, messagelist[1].__getitem__, 'flags')
+
+    def test_03_frozen(self):
+        """Sets read from an item can't be changed, only assigned back"""
+        messagelist = MessageList()
+        messagelist[1] = {'uid': 1, 'flags': set('S'), 'labels': set('a')}
+        item = messagelist[1]
+        with self.assertRaises(AttributeError):
+            item['flags'].add('T')
+        with self.assertRaises(AttributeError):
+            item['labels'].add('b')
+        item['flags'] |= set('T')
+        item['labels'] -= set('a')
+        self.assertEqual(messagelist[1]['flags'], set('ST'))
+        self.assertEqual(messagelist[1]['labels'], set())
+
+    def test_04_flagmasks(self):
+        """The masks are None for flags without a bit"""
+        messagelist = MessageList()
+        messagelist[3] = {'uid': 3, 'flags': set('FS')}
+        messagelist[1] = {'uid': 1, 'flags': set()}
+        messagelist[2] = {'uid': 2, 'flags': set(['S', '$Junk'])}
+        messagelist[4] = {'uid': 4}
+        self.assertEqual(messagelist.flagmasks(),
+            {1: 0, 2: None, 3: flagmask('FS'), 4: None})
+        self.assertEqual(flagmask('S') | flagmask('F'), flagmask('FS'))
+
+
+class TestSyncPlan(unittest.TestCase):
+    """Test offlineimap.folder.Base.SyncPlan"""
+
+    def test_01_copylist(self):
+        """New messages of the source are copied, except the ignored ones"""
+        plan = SyncPlan(FakeFolder({-1: '', 1: '', 2: '', 3: ''}),
+            FakeFolder({1: ''}), FakeFolder({1: ''}))
+        self.assertEqual(plan.copylist(), ([-1, 2, 3], []))
+        self.assertEqual(plan.copylist([3, 4]), ([-1, 2], [3]))
+        self.assertEqual(plan.changes, 5)
+
+    def test_02_deletelist(self):
+        """Messages of the status deleted in the source are deleted"""
+        src = FakeFolder({1: ''})
+        dst = FakeFolder({1: '', 2: ''})
+        status = FakeFolder({1: '', 2: '', 3: ''})
+        plan = SyncPlan(src, dst, status)
+        self.assertEqual(plan.deletelist(), ([2, 3], [2]))
+        self.assertEqual(plan.changes, 2)
+        plan = SyncPlan(src, dst, status)
+        self.assertEqual(plan.deletelist(sync_deletes=False), ([3], []))
+        self.assertEqual(plan.changes, 1)
+
+    def test_03_flagchanges(self):
+        """Flags are compared as bitmasks or as sets, with the same result"""
+        src = {1: 'S', 2: 'FS', 3: 'T', 4: 'S', 5: ['S', '$Junk'], 6: 'D'}
+        dst = {1: '', 2: '', 3: '', 5: '', 6: ''}
+        status = {1: 'S', 2: 'S', 3: 'ST', 4: '', 5: ['$Junk']}
+        expected = ({'F': [2], 'S': [5], 'D': [6]}, {'S': [3]})
+        for masks in (True, False):
+            plan = SyncPlan(FakeFolder(src, masks), FakeFolder(dst),
+                FakeFolder(status, masks))
+            addflaglist, delflaglist = plan.flagchanges()
+            self.assertEqual((addflaglist, delflaglist), expected, masks)
+            self.assertEqual(plan.changes, 4, masks)
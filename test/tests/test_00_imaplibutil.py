@@ -0,0 +1,211 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import io
+import unittest
+
+import six
+
+from offlineimap import emailutil, imaplibutil
+from offlineimap import bundled_imaplib2 as imaplib2
+
+
+class FakeIMAP(imaplibutil.UsefulIMAPMixIn):
+    """Records the commands instead of sending them."""
+
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+        self.literal = None
+        self.commands = []
+
+    def _simple_command(self, name, *args):
+        self.commands.append((name, args, self.literal))
+        self.literal = None
+        return 'OK', [None]
+
+    def _release_state_change(self):
+        pass
+
+
+class Sender(object):
+    """Records the data sent by the bundled imaplib2."""
+
+    _send_data = six.get_unbound_function(imaplib2.IMAP4._send_data)
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+
+class TestMultiappend(unittest.TestCase):
+    """Test UsefulIMAPMixIn.multiappend()"""
+
+    messages = [
+        ('(\\Seen)', '"01-Jan-2020 00:00:00 +0000"',
+            emailutil.decode_message(b'Subject: caf\xc3\xa9\n\nA\n')),
+        (None, None, b'Subject: b\r\n\r\n\xff\r'),
+    ]
+
+    def test_01_encodeliteral(self):
+        """Literals are the original bytes with CRLF line endings"""
+        self.assertEqual(imaplibutil.encodeliteral(b'a\nb\rc\r\n'),
+            b'a\r\nb\r\nc\r\n')
+        data = b'caf\xc3\xa9 \xff\r\n'
+        self.assertEqual(
+            imaplibutil.encodeliteral(emailutil.decode_message(data)), data)
+
+    def test_02_nonsync(self):
+        """With LITERAL+ the command goes out at once, sizes in octets"""
+        imapobj = FakeIMAP(('IMAP4REV1', 'LITERAL+'))
+        imapobj.multiappend('INBOX', self.messages)
+        ((name, args, literal),) = imapobj.commands
+        self.assertEqual(name, 'APPEND')
+        self.assertEqual(args,
+            ('INBOX', '\'(\\Seen) "01-Jan-2020 00:00:00 +0000"\''))
+        first = b'Subject: caf\xc3\xa9\r\n\r\nA\r\n'
+        self.assertEqual(len(literal), len(first))
+        self.assertEqual(b''.join(literal),
+            first + b' {17+}\r\n' + b'Subject: b\r\n\r\n\xff\r\n')
+
+    def test_03_sync(self):
+        """Without LITERAL+ each literal waits for a continuation"""
+        imapobj = FakeIMAP(('IMAP4REV1',))
+        imapobj.multiappend('INBOX', self.messages)
+        ((name, args, literator),) = imapobj.commands
+        self.assertEqual(args, ('INBOX',
+            '\'(\\Seen) "01-Jan-2020 00:00:00 +0000" {21}\''))
+        chunks = []
+        while True:
+            chunk = literator('', None)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+        self.assertEqual(chunks, [
+            (b'Subject: caf\xc3\xa9\r\n\r\nA\r\n', b' {17}'),
+            b'Subject: b\r\n\r\n\xff\r\n'])
+
+    def test_04_literalminus(self):
+        """LITERAL- only covers batches of small literals"""
+        imapobj = FakeIMAP(('IMAP4REV1', 'LITERAL-'))
+        imapobj.multiappend('INBOX', [(None, None, 'x' * 5000)])
+        ((name, args, literal),) = imapobj.commands
+        self.assertTrue(callable(literal))
+
+    def test_05_literalreader(self):
+        """Messages read from files are sent chunk by chunk"""
+        fileobj = io.BytesIO(b'Subject: r\n\nB\n')
+        reader = imaplibutil.LiteralReader(b'Subject: r\r\n\r\n', fileobj, 12)
+        imapobj = FakeIMAP(('IMAP4REV1', 'LITERAL+'))
+        imapobj.multiappend('INBOX', [self.messages[0], (None, None, reader)])
+        ((name, args, literal),) = imapobj.commands
+        sender = Sender()
+        sender._send_data(['prefix', literal, '\r\n'])
+        self.assertIs(list(literal)[2], reader)
+        self.assertEqual(b''.join(sender.sent[1:-1]),
+            b'Subject: caf\xc3\xa9\r\n\r\nA\r\n {17+}\r\n'
+            b'Subject: r\r\n\r\nB\r\n')
+
+
+class TestLiteralPlus(unittest.TestCase):
+    """Test the choice of non-synchronizing literals"""
+
+    def test_01_literal_plus(self):
+        """LITERAL+ allows any size, LITERAL- up to 4096 octets"""
+        self.assertTrue(FakeIMAP(('LITERAL+',)).literal_plus(5000))
+        self.assertTrue(FakeIMAP(('LITERAL-',)).literal_plus(4096))
+        self.assertFalse(FakeIMAP(('LITERAL-',)).literal_plus(4097))
+        self.assertFalse(FakeIMAP(('IMAP4REV1',)).literal_plus(1))
+
+    def test_02_nonsync_literal(self):
+        """The announced size counts octets"""
+        label = emailutil.decode_message(b'caf\xc3\xa9')
+        self.assertEqual(FakeIMAP(('LITERAL+',)).nonsync_literal(label),
+            "{5+}\r\n" + label)
+        self.assertEqual(FakeIMAP(('IMAP4REV1',)).nonsync_literal(label), None)
+
+
+class TestLiteralWriter(unittest.TestCase):
+    """Test imaplibutil.LiteralWriter"""
+
+    def test_01_crlf(self):
+        """CRLF becomes LF, lone CRs are kept"""
+        fileobj = six.StringIO()
+        writer = imaplibutil.LiteralWriter(fileobj)
+        writer.write('a\r\nb\rc\r\n')
+        writer.flush()
+        self.assertEqual(fileobj.getvalue(), 'a\nb\rc\n')
+
+    def test_02_split_crlf(self):
+        """A CR ending a chunk waits for the next one"""
+        fileobj = six.StringIO()
+        writer = imaplibutil.LiteralWriter(fileobj)
+        for chunk in ('a\r', '\nb\r', 'c\r'):
+            writer.write(chunk)
+        self.assertEqual(fileobj.getvalue(), 'a\nb\rc')
+        writer.flush()
+        self.assertEqual(fileobj.getvalue(), 'a\nb\rc\r')
+
+    def test_03_restart(self):
+        """restart() drops what was written"""
+        fileobj = six.StringIO()
+        writer = imaplibutil.LiteralWriter(fileobj)
+        writer.write('a\r')
+        writer.restart()
+        writer.write('b')
+        writer.flush()
+        self.assertEqual(fileobj.getvalue(), 'b')
+
+
+class TestLiteralReader(unittest.TestCase):
+    """Test imaplibutil.LiteralReader"""
+
+    body = b'l1\r\nl2\rl3\nl4\r' + b'x' * 10 + b'\r\n\r\r\n\n'
+    expected = b'Subject: s\r\n\r\n' + \
+        b'l1\r\nl2\r\nl3\r\nl4\r\n' + b'x' * 10 + b'\r\n\r\n\r\n\r\n'
+
+    def reader(self, chunksize):
+        fileobj = io.BytesIO(b'Subject: s\n\n' + self.body)
+        reader = imaplibutil.LiteralReader(b'Subject: s\r\n\r\n', fileobj, 12)
+        reader.chunksize = chunksize
+        return reader
+
+    def test_01_crlf(self):
+        """All line endings become CRLF, whatever the chunk size"""
+        for chunksize in range(1, len(self.body) + 2):
+            reader = self.reader(chunksize)
+            self.assertEqual(b''.join(reader), self.expected, chunksize)
+
+    def test_02_size(self):
+        """The size is the one of the data sent, also when a CRLF is split
+        across chunks"""
+        for chunksize in range(1, len(self.body) + 2):
+            reader = self.reader(chunksize)
+            self.assertEqual(len(reader), len(self.expected), chunksize)
+
+    def test_03_restart(self):
+        """Iterating again sends the same literal"""
+        reader = self.reader(4)
+        self.assertEqual(b''.join(reader), self.expected)
+        self.assertEqual(b''.join(reader), self.expected)
+
+    def test_04_prefix(self):
+        """The headers may be given decoded"""
+        data = b'Subject: caf\xc3\xa9 \xff'
+        reader = imaplibutil.LiteralReader(emailutil.decode_message(data),
+            io.BytesIO(b''), 0)
+        self.assertEqual(b''.join(reader), data)
+        self.assertEqual(len(reader), len(data))
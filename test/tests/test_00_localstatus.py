@@ -0,0 +1,203 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import shutil
+import tempfile
+import unittest
+
+from offlineimap.folder.Base import flagmask
+from offlineimap.repository.LocalStatus import LocalStatusRepository
+from test.OLItest import make_account
+
+
+class TestBackendMigration(unittest.TestCase):
+    """Test the import of the status of a folder from another backend"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        repository = self.getrepository('plain')
+        os.mkdir(repository.root)
+        folder = repository.getfolder('INBOX')
+        folder.openfiles()
+        folder.cachemessagelist()
+        for uid, flags in ((1, 'S'), (2, 'FS')):
+            folder.savemessage(uid, None, set(flags), 0, mtime=uid)
+        folder.save()
+        folder.save_highestmodseq(42)
+        folder.save_lastsync(1000)
+        folder.closefiles()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def getrepository(self, backend, dryrun=False):
+        account = make_account(self.tmpdir, dryrun)
+        repository = LocalStatusRepository('Test', account)
+        repository.setup_backend(backend)
+        return repository
+
+    def getstatus(self, folder):
+        folder.openfiles()
+        try:
+            folder.cachemessagelist()
+            return (sorted((uid, sorted(folder.getmessageflags(uid)))
+                           for uid in folder.getmessageuidlist()),
+                    folder.get_highestmodseq(), folder.get_lastsync())
+        finally:
+            folder.closefiles()
+
+    expected = ([(1, ['S']), (2, ['F', 'S'])], 42, 1000)
+
+    def test_01_migrate(self):
+        """The status moves to the new backend"""
+        folder = self.getrepository('sqlite').getfolder('INBOX')
+        self.assertEqual(type(folder).__name__, 'LocalStatusSQLiteFolder')
+        self.assertEqual(self.getstatus(folder), self.expected)
+        # The status of the old backend is gone.
+        old = self.getrepository('plain')._instanciatefolder('INBOX')
+        self.assertTrue(old.isnewfolder())
+        # A new instance reads the migrated status.
+        folder = self.getrepository('sqlite').getfolder('INBOX')
+        self.assertEqual(self.getstatus(folder), self.expected)
+
+    def test_02_dryrun(self):
+        """In dry-run mode the status is read where it is and nothing is
+        written"""
+        repository = self.getrepository('sqlite', dryrun=True)
+        folder = repository.getfolder('INBOX')
+        self.assertEqual(type(folder).__name__, 'LocalStatusFolder')
+        self.assertEqual(self.getstatus(folder), self.expected)
+        self.assertTrue(repository._instanciatefolder('INBOX').isnewfolder())
+        old = self.getrepository('plain')._instanciatefolder('INBOX')
+        self.assertFalse(old.isnewfolder())
+
+
+class TestLazyMessageList(unittest.TestCase):
+    """Test the messagelist of SQLite status folders in lazy mode"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.folder = self.getfolder(True)
+        self.folder.openfiles()
+        self.folder.cachemessagelist()
+        for uid, flags in ((3, 'S'), (1, 'FS'), (2, '')):
+            self.folder.savemessage(uid, None, set(flags), 0, mtime=uid)
+
+    def tearDown(self):
+        self.folder.closefiles()
+        shutil.rmtree(self.tmpdir)
+
+    def getfolder(self, lazy):
+        account = make_account(self.tmpdir,
+            account="lazystatus = %s"% lazy)
+        return LocalStatusRepository('Test', account).getfolder('INBOX')
+
+    def test_01_database(self):
+        """The items are read from the database"""
+        folder = self.folder
+        self.assertEqual(list(folder.getmessageuidlist()), [1, 2, 3])
+        folder.savemessageflags(2, set('T'))
+        folder.savemessagelabels(3, set(['a']), mtime=30)
+        folder.deletemessage(1)
+        self.assertEqual(list(folder.getmessageuidlist()), [2, 3])
+        self.assertEqual(folder.getmessageflags(2), set('T'))
+        self.assertEqual(folder.getmessagelabels(3), set(['a']))
+        self.assertEqual(folder.getmessagemtime(3), 30)
+        self.assertEqual(sorted((uid, sorted(item['flags']))
+                                for uid, item in folder.messagelist.items()),
+            [(2, ['T']), (3, ['S'])])
+
+    def test_02_readonly(self):
+        """Changing an item fails instead of being lost"""
+        messagelist = self.folder.messagelist
+        with self.assertRaises(TypeError):
+            messagelist[1]['flags'] = set('T')
+        with self.assertRaises(AttributeError):
+            messagelist[1]['flags'].add('T')
+        with self.assertRaises(TypeError):
+            messagelist[4] = {'uid': 4, 'flags': set()}
+        self.assertEqual(self.folder.getmessageflags(1), set('FS'))
+        self.assertFalse(4 in messagelist)
+
+    def test_03_flagmasks(self):
+        """The flag masks are the ones of a loaded messagelist"""
+        masks = self.folder.getmessageflagmasks()
+        self.assertEqual(masks, {1: flagmask('FS'), 2: 0, 3: flagmask('S')})
+        folder = self.getfolder(False)
+        folder.openfiles()
+        try:
+            folder.cachemessagelist()
+            self.assertEqual(folder.getmessageflagmasks(), masks)
+        finally:
+            folder.closefiles()
+
+
+class TestJournal(unittest.TestCase):
+    """Test the journal of plain-text status folders"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(self.getrepository().root)
+        folder = self.getfolder()
+        for uid, flags in ((1, 'S'), (2, 'FS')):
+            folder.savemessage(uid, None, set(flags), 0, mtime=uid)
+        folder.save()
+        folder.savemessageflags(1, set('ST'))
+        folder.deletemessage(2)
+        folder.savemessage(3, None, set(), 0, mtime=3)
+        folder.closefiles()
+        self.journalfilename = folder.journalfilename
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def getrepository(self):
+        account = make_account(self.tmpdir)
+        repository = LocalStatusRepository('Test', account)
+        repository.setup_backend('plain')
+        return repository
+
+    def getfolder(self):
+        folder = self.getrepository().getfolder('INBOX')
+        folder.openfiles()
+        folder.cachemessagelist()
+        return folder
+
+    def getmessages(self, folder):
+        return sorted((uid, sorted(folder.getmessageflags(uid)),
+                       folder.getmessagemtime(uid))
+                      for uid in folder.getmessageuidlist())
+
+    expected = [(1, ['S', 'T'], 1), (3, [], 3)]
+
+    def test_01_replay(self):
+        """The changes since the status file was written are replayed"""
+        self.assertTrue(os.path.exists(self.journalfilename))
+        self.assertEqual(self.getmessages(self.getfolder()), self.expected)
+
+    def test_02_truncated(self):
+        """An incomplete last line is dropped, and the journal can be
+        appended to again"""
+        with open(self.journalfilename, 'ab') as journalfd:
+            journalfd.write(b'4|S|4|')
+        folder = self.getfolder()
+        self.assertEqual(self.getmessages(folder), self.expected)
+        with open(self.journalfilename, 'rb') as journalfd:
+            self.assertTrue(journalfd.read().endswith(b'\n'))
+        folder.savemessage(5, None, set('D'), 0, mtime=5)
+        folder.closefiles()
+        self.assertEqual(self.getmessages(self.getfolder()),
+            self.expected + [(5, ['D'], 5)])
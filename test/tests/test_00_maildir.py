@@ -0,0 +1,127 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from offlineimap.repository import Repository
+from test.OLItest import make_account
+
+
+class TestScanIndex(unittest.TestCase):
+    """Test the scan index of Maildir folders"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.account = make_account(self.tmpdir, local="scanindex = yes")
+        repository = Repository(self.account, 'local')
+        repository.makefolder('INBOX')
+        self.folder = self.getfolder()
+        self.folder.cachemessagelist()
+        for uid, flags in ((1, 'S'), (2, 'FS'), (3, '')):
+            self.folder.savemessage(uid, 'Subject: %d\n\nbody\n'% uid,
+                set(flags), 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def getfolder(self):
+        """Return a new instance of the folder, which reads the index."""
+
+        return Repository(self.account, 'local').getfolder('INBOX')
+
+    def agedirs(self, age):
+        """Date the directories of the folder back, so that the index keeps
+        their mtime."""
+
+        mtime = time.time() - age
+        for dirannex in ('new', 'cur'):
+            os.utime(os.path.join(self.folder.getfullname(), dirannex),
+                (mtime, mtime))
+
+    def getmessages(self, folder):
+        folder.cachemessagelist()
+        return sorted((uid, sorted(folder.getmessageflags(uid)),
+                       folder.messagelist[uid]['size'])
+                      for uid in folder.getmessageuidlist())
+
+    def test_01_round_trip(self):
+        """A scan from the index gives the same messages as a full scan"""
+        self.agedirs(100)
+        self.folder.dropmessagelistcache()
+        full = self.getmessages(self.folder)
+        self.assertEqual([(uid, flags) for uid, flags, size in full],
+            [(1, ['S']), (2, ['F', 'S']), (3, [])])
+        self.assertTrue(os.path.exists(self.folder._scanindexfile))
+        self.assertEqual(self.getmessages(self.getfolder()), full)
+
+    def test_02_external_changes(self):
+        """Messages added, renamed or removed by others are noticed"""
+        self.agedirs(100)
+        folder = self.getfolder()
+        self.getmessages(folder)
+        path = lambda uid: os.path.join(folder.getfullname(),
+            folder.messagelist[uid]['filename'])
+        os.unlink(path(1))
+        os.rename(path(3), path(3) + 'R')
+        cur = os.path.join(folder.getfullname(), 'cur')
+        with open(os.path.join(cur, '123.host:2,T'), 'w') as msgfile:
+            msgfile.write('Subject: new\n\nbody\n')
+        self.agedirs(50)
+        self.assertEqual([(uid, flags) for uid, flags, size in
+                          self.getmessages(self.getfolder())],
+            [(-1, ['T']), (2, ['F', 'S']), (3, ['R'])])
+
+    def test_03_unusable_index(self):
+        """An index which doesn't match the folder is ignored"""
+        self.agedirs(100)
+        full = self.getmessages(self.getfolder())
+        with open(self.folder._scanindexfile, 'w') as indexfile:
+            indexfile.write("OFFLINEIMAP SCANINDEX 2 other :\ndir cur 1.0\n")
+        self.assertEqual(self.getmessages(self.getfolder()), full)
+        with open(self.folder._scanindexfile, 'w') as indexfile:
+            indexfile.write("garbage")
+        self.assertEqual(self.getmessages(self.getfolder()), full)
+
+
+class TestScanStats(unittest.TestCase):
+    """Test the file stats read by the scan of Maildir folders"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.account = make_account(self.tmpdir)
+        Repository(self.account, 'local').makefolder('INBOX')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_01_new_messages(self):
+        """The messages to upload get their mtime from the scan"""
+        folder = Repository(self.account, 'local').getfolder('INBOX')
+        folder.cachemessagelist()
+        folder.savemessage(1, 'Subject: 1\n\nbody\n', set('S'), 0)
+        new = os.path.join(folder.getfullname(), 'new', '123.host')
+        with open(new, 'w') as msgfile:
+            msgfile.write('Subject: new\n\nbody\n')
+        os.utime(new, (1000, 1000))
+        folder = Repository(self.account, 'local').getfolder('INBOX')
+        folder.cachemessagelist()
+        self.assertEqual(folder.messagelist[1]['mtime'], None)
+        self.assertEqual(folder.messagelist[-1]['mtime'], 1000)
+        self.assertEqual(folder.messagelist[-1]['size'], 19)
+        self.assertEqual(folder.getmessagetime(-1), 1000)
@@ -0,0 +1,102 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import threading
+import unittest
+
+from offlineimap import threadutil
+
+
+class TestWorkerPool(unittest.TestCase):
+    """Test threadutil.WorkerPool and threadutil.JobGroup"""
+
+    def test_01_runs_all_jobs(self):
+        """wait() returns once all the jobs of the group ran"""
+        pool = threadutil.WorkerPool('test_01', 3)
+        group = threadutil.JobGroup()
+        done = []
+        lock = threading.Lock()
+
+        def job(num):
+            with lock:
+                done.append(num)
+
+        for num in range(20):
+            pool.submit(group, job, num)
+        self.assertTrue(group.wait() >= 0)
+        self.assertEqual(sorted(done), list(range(20)))
+        self.assertEqual(group.pending, 0)
+        self.assertEqual(group.done, 20)
+
+    def test_02_bounded(self):
+        """No more workers than the size of the pool, and submit() blocks
+        while the queue is full"""
+        pool = threadutil.WorkerPool('test_02', 2)
+        group = threadutil.JobGroup()
+        release = threading.Event()
+        running = []
+        lock = threading.Lock()
+
+        def job():
+            with lock:
+                running.append(threading.current_thread())
+            release.wait()
+
+        for num in range(4):
+            pool.submit(group, job)
+        submitter = threading.Thread(target=pool.submit, args=(group, job))
+        submitter.start()
+        submitter.join(0.2)
+        # Two jobs run, two wait in the queue, the fifth can't be queued.
+        self.assertTrue(submitter.is_alive())
+        self.assertEqual(len(pool.workers), 2)
+        self.assertEqual(pool.qsize(), 2)
+        release.set()
+        submitter.join()
+        group.wait()
+        self.assertEqual(len(running), 5)
+        self.assertEqual(len(set(running)), 2)
+
+    def test_03_groups(self):
+        """Groups sharing a pool wait for their own jobs only"""
+        pool = threadutil.WorkerPool('test_03', 2)
+        slow, fast = threadutil.JobGroup(), threadutil.JobGroup()
+        release = threading.Event()
+        pool.submit(slow, release.wait)
+        pool.submit(fast, lambda: None)
+        fast.wait()
+        self.assertEqual(slow.pending, 1)
+        release.set()
+        slow.wait()
+        self.assertEqual(slow.pending, 0)
+
+    def test_04_failing_job(self):
+        """A failing job is done for its group and ends its worker"""
+        pool = threadutil.WorkerPool('test_04', 1)
+        group = threadutil.JobGroup()
+
+        def fail():
+            raise ValueError("job failed")
+
+        pool.submit(group, fail)
+        workers = list(pool.workers)
+        group.wait()
+        self.assertEqual(group.done, 1)
+        for worker in workers:
+            worker.join()
+        self.assertEqual(pool.workers, [])
+        pool.submit(group, lambda: None)
+        group.wait()
+        self.assertEqual(group.done, 2)